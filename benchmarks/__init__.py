@@ -0,0 +1,11 @@
+'''
+Stand-alone benchmarks, run with `python -m benchmarks.<name>`
+'''
+import math
+
+
+def percentile(timings, fraction: float):
+    """Nearest-rank percentile of sorted timings, e.g. fraction=0.95 for
+    the p95: the smallest timing at least that share of them is under
+    """
+    return timings[math.ceil(fraction * len(timings)) - 1]
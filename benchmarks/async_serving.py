@@ -0,0 +1,198 @@
+"""
+Concurrent connections and tail latency, threaded against async serving
+
+Seeds a catalog, then starts `python -m qbay serve` once with threaded
+workers and once with --async, and for each level of --concurrency keeps
+that many keep-alive connections busy for --seconds with logged in GETs
+of the home, booking, My Bookings and My Listings pages. Reports the
+requests per second, median and p99 latency and failed requests of each.
+
+The gap widens with the time spent waiting on the database: point
+db_string at a MySQL server over the network to measure it, the default
+SQLite file has next to no round trip.
+
+Usage:
+    python -m benchmarks.async_serving [--concurrency 16,64,256]
+
+Requires gunicorn, asgiref, uvicorn and aiosqlite (aiomysql for MySQL).
+Runs against a throw-away SQLite file unless db_string is set; the
+database is dropped and re-seeded either way.
+"""
+import os
+import sys
+import socket
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from time import perf_counter, sleep
+from benchmarks import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--concurrency', default='16,64,256',
+                        help='comma separated numbers of connections')
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='duration of each measurement')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes of each server')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads per worker of the threaded server')
+    parser.add_argument('--listings', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=327)
+    return parser.parse_args()
+
+
+def seed(database, db, args, rng):
+    """Bulk inserts users, listings and a few bookings per user"""
+    from sqlalchemy import insert
+    db.session.execute(insert(database.User), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@bench.com',
+         'password': 'Password123!', 'balance_snapshot': 100}
+        for i in range(1, args.users + 1)])
+    db.session.execute(insert(database.Listing), [
+        {'id': i, 'title': f'Listing {i}', 'price': rng.randint(20, 300) * 100,
+         'description': f'Description of listing number {i}', 'address': '',
+         'date_created': '2022-01-01', 'last_modified_date': '2022-01-01',
+         'next_available_date': '2022-01-01',
+         'owner_id': rng.randint(1, args.users)}
+        for i in range(1, args.listings + 1)])
+    db.session.execute(insert(database.Booking), [
+        {'owner_id': 1, 'buyer_id': user_id,
+         'listing_id': rng.randint(1, args.listings),
+         'start_date': '2030-01-01', 'end_date': '2030-01-02'}
+        for user_id in range(1, args.users + 1) for _ in range(3)])
+    db.session.commit()
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(args, port: int, async_mode: bool):
+    command = [sys.executable, '-m', 'qbay', 'serve',
+               '--bind', f'127.0.0.1:{port}',
+               '--workers', str(args.workers),
+               '--threads', str(args.threads)]
+    if async_mode:
+        command.append('--async')
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    for _ in range(300):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit(f"server exited: {' '.join(command)}")
+            sleep(0.1)
+    process.terminate()
+    raise SystemExit("server did not start")
+
+
+async def fetch(reader, writer, path: str, cookie: str) -> int:
+    """Sends one keep-alive GET and reads the response, returning its
+    status code
+    """
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: bench\r\n'
+                 f'Cookie: {cookie}\r\n\r\n'.encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return int(lines[0].split()[1])
+
+
+async def connection(port, pick, cookies, deadline, rng, timings, failed):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while perf_counter() < deadline:
+            began = perf_counter()
+            try:
+                status = await asyncio.wait_for(
+                    fetch(reader, writer, pick(), rng.choice(cookies)), 30)
+            except (asyncio.TimeoutError, OSError,
+                    asyncio.IncompleteReadError):
+                failed.append(1)
+                writer.close()
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+                continue
+            if status == 200:
+                timings.append(perf_counter() - began)
+            else:
+                failed.append(status)
+    finally:
+        writer.close()
+
+
+async def load(port, concurrency, seconds, pick, cookies, rng):
+    timings, failed = [], []
+    deadline = perf_counter() + seconds
+    began = perf_counter()
+    results = await asyncio.gather(*(
+        connection(port, pick, cookies, deadline, rng, timings, failed)
+        for _ in range(concurrency)), return_exceptions=True)
+    elapsed = perf_counter() - began
+    failed += [1 for result in results if isinstance(result, Exception)]
+    return timings, len(failed), elapsed
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'async_serving.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay import database, migrations
+    from qbay.database import app, db
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.drop_all()
+        migrations.migrate()
+        seed(database, db, args, rng)
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    cookies = [f"{app.config['SESSION_COOKIE_NAME']}="
+               f"{serializer.dumps({'logged_in': user_id})}"
+               for user_id in range(1, args.users + 1)]
+    # Each page as often as the others, the booking page of any listing
+    paths = ['/', '/user_bookings', '/user_listings', '/booking/{}']
+
+    def pick():
+        return rng.choice(paths).format(rng.randint(1, args.listings))
+
+    print(f"{'mode':<9} {'conns':>6} {'req/s':>9} {'median ms':>10}"
+          f" {'p99 ms':>9} {'failed':>7}")
+    for async_mode in (False, True):
+        port = free_port()
+        process = start_server(args, port, async_mode)
+        try:
+            for concurrency in map(int, args.concurrency.split(',')):
+                timings, failed, elapsed = asyncio.run(load(
+                    port, concurrency, args.seconds, pick, cookies, rng))
+                timings.sort()
+                median = timings[len(timings) // 2] * 1000 if timings else 0
+                p99 = percentile(timings, 0.99) * 1000 if timings else 0
+                print(f"{'async' if async_mode else 'threaded':<9} "
+                      f"{concurrency:>6} {len(timings) / elapsed:>9.1f} "
+                      f"{median:>10.2f} {p99:>9.2f} {failed:>7}")
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Latency of the catalog-wide "free from X to Y" search
+
+Seeds listings with years of booking history, then times, for random
+stays, the first page of Listing.query_available and collecting every
+free listing through all of its pages, against the previous approach of
+checking each listing in Python with Availability.overlaps.
+
+Usage:
+    python -m benchmarks.availability_search [--listings 5000] [--years 3]
+
+Runs against a throw-away SQLite file unless db_string is set; the
+database is dropped and re-seeded either way.
+"""
+import os
+import random
+import argparse
+import tempfile
+from time import perf_counter
+from datetime import datetime, timedelta
+from benchmarks import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--listings', type=int, default=5000)
+    parser.add_argument('--years', type=int, default=3,
+                        help='years of booking history per listing')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='stays searched per approach')
+    parser.add_argument('--seed', type=int, default=327)
+    return parser.parse_args()
+
+
+def seed(database, db, args, rng):
+    """Bulk inserts listings whose calendars are about 70% booked"""
+    from sqlalchemy import insert
+    db.session.execute(insert(database.User), [{
+        'id': 1, 'username': 'bench', 'email': 'bench@bench.com',
+        'password': 'Password123!', 'balance_snapshot': 100}])
+    db.session.execute(insert(database.Listing), [
+        {'id': i, 'title': f'Listing {i}', 'price': rng.randint(20, 300) * 100,
+         'description': f'Description of listing number {i}', 'address': '',
+         'date_created': '2022-01-01', 'last_modified_date': '2022-01-01',
+         'owner_id': 1} for i in range(1, args.listings + 1)])
+
+    nights = 0
+    first = datetime(2022, 1, 1)
+    last = first + timedelta(days=365 * args.years)
+    for listing_id in range(1, args.listings + 1):
+        ranges, day = [], first
+        while day < last:
+            day += timedelta(days=rng.randint(1, 4))  # free gap
+            end = min(day + timedelta(days=rng.randint(2, 9)), last)
+            ranges.append({'listing_id': listing_id,
+                           'start_date': day.strftime('%Y-%m-%d'),
+                           'end_date': end.strftime('%Y-%m-%d')})
+            nights += (end - day).days
+            day = end + timedelta(days=1)  # keep ranges apart
+        db.session.execute(insert(database.BookedRange), ranges)
+    db.session.commit()
+    return nights, first
+
+
+def timed(samples, run):
+    """Returns the median and p95 in milliseconds of calling run"""
+    timings = []
+    for _ in range(samples):
+        began = perf_counter()
+        run()
+        timings.append((perf_counter() - began) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], percentile(timings, 0.95)
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'availability_search.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay import database
+    from qbay.database import app, db
+    from qbay.listing import Listing
+    from qbay.availability import Availability
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        began = perf_counter()
+        nights, first = seed(database, db, args, rng)
+        print(f"seeded {args.listings} listings with {nights} booked "
+              f"nights in {perf_counter() - began:.1f}s\n")
+
+        def stay():
+            start = first + timedelta(days=rng.randint(0, 365 * args.years))
+            end = start + timedelta(days=rng.randint(1, 3))
+            return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+        def python_loop():
+            start, end = stay()
+            return [listing.id for listing in database.Listing.query.all()
+                    if not Availability(listing.id).overlaps(start, end)]
+
+        def first_page():
+            return Listing.query_available(*stay(), min_price=50,
+                                           max_price=200)
+
+        def every_page():
+            start, end = stay()
+            found, cursor = [], None
+            while True:
+                listings, cursor = Listing.query_available(
+                    start, end, after=cursor, limit=100)
+                found += listings
+                if cursor is None:
+                    return found
+
+        for name, run, samples in (
+                ('python loop, all', python_loop, max(args.samples // 10, 2)),
+                ('query, first page', first_page, args.samples),
+                ('query, all pages', every_page, args.samples)):
+            median, p95 = timed(samples, run)
+            print(f"{name:<18} median {median:9.3f} ms  p95 {p95:9.3f} ms")
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Cost of the booking page for a listing with years of booking history
+
+Seeds a listing booked night after night from 2.5 years ago to 2.5 years
+from now, then times finding its first bookable date the way the booking
+page used to (every booked night parsed, sorted and walked), with a probe
+of the booked ranges, and read from the listing, followed by the whole
+GET /booking/<id> page.
+
+Usage:
+    python -m benchmarks.booking_page [--years 5]
+
+Runs against a throw-away SQLite file unless db_string is set; the
+database is dropped and re-seeded either way.
+"""
+import os
+import random
+import argparse
+import tempfile
+from time import perf_counter
+from datetime import datetime, timedelta
+from benchmarks import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--years', type=float, default=5,
+                        help='years of bookings, half of them in the past')
+    parser.add_argument('--samples', type=int, default=100,
+                        help='executions timed per approach')
+    parser.add_argument('--seed', type=int, default=327)
+    return parser.parse_args()
+
+
+def per_night_scan(listing):
+    """The booking page's previous lookup, kept here for comparison"""
+    booked_dates = sorted(listing.booked_dates,
+                          key=lambda x: datetime.strptime(x, '%Y-%m-%d'))
+    today = datetime.now().strftime('%Y-%m-%d')
+    if booked_dates == [] or (booked_dates[0] > today):
+        return today
+    prev_d = datetime.strptime(booked_dates[0], "%Y-%m-%d")
+    for night in booked_dates[1:]:
+        curr_d = datetime.strptime(night, "%Y-%m-%d")
+        if (curr_d - prev_d).days > 1 and prev_d.strftime('%Y-%m-%d') >= \
+                today:
+            break
+        prev_d = curr_d
+    return (prev_d + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'booking_page.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay import controllers  # noqa: F401 registers the routes
+    from qbay.database import app, db
+    from qbay.user import User
+    from qbay.listing import Listing
+    from qbay.booking import Booking
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        User.register("Owner", "owner@bench.com", "Password123!")
+        User.register("Guest", "guest@bench.com", "Password123!")
+        owner = User.login("owner@bench.com", "Password123!")
+        guest = User.login("guest@bench.com", "Password123!")
+        User.query_user(guest.id).update_balance(10 ** 9)
+        listing = Listing.create_listing(
+            "Busy Listing", "A listing that is booked every night", 10,
+            owner, "1 Bench Street")
+        listing = Listing.query_listing(listing.id)
+
+        days = int(365 * args.years)
+        day = datetime.now() - timedelta(days=days // 2)
+        last = day + timedelta(days=days)
+        began, bookings = perf_counter(), 0
+        while day < last:
+            end = day + timedelta(days=rng.randint(1, 7))
+            Booking.book_listing(guest.id, owner.id, listing.id,
+                                 day.strftime('%Y-%m-%d'),
+                                 end.strftime('%Y-%m-%d'))
+            day, bookings = end, bookings + 1
+        print(f"booked {days} nights in {bookings} bookings "
+              f"in {perf_counter() - began:.1f}s\n")
+
+        client = app.test_client()
+        with client.session_transaction() as cookie:
+            cookie['logged_in'] = guest.id
+        expected = listing.find_min_booking_date()
+        approaches = (
+            ('per-night scan', lambda: per_night_scan(listing)),
+            ('range probe', lambda: listing.availability.first_free(
+                datetime.now())),
+            ('stored date', listing.find_min_booking_date),
+        )
+        for name, run in approaches:
+            assert run() == expected, name
+            timings = []
+            for _ in range(args.samples):
+                db.session.expire_all()
+                began = perf_counter()
+                run()
+                timings.append((perf_counter() - began) * 1000)
+            timings.sort()
+            print(f"{name:<15} median {timings[len(timings) // 2]:9.3f} ms"
+                  f"  p95 {percentile(timings, 0.95):9.3f} ms")
+
+        timings = []
+        for _ in range(args.samples):
+            began = perf_counter()
+            page = client.get(f'/booking/{listing.id}')
+            timings.append((perf_counter() - began) * 1000)
+        assert page.status_code == 200
+        timings.sort()
+        print(f"{'booking page':<15} median {timings[len(timings) // 2]:9.3f}"
+              f" ms  p95 {percentile(timings, 0.95):9.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
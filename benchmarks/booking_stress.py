@@ -0,0 +1,137 @@
+"""
+Concurrency stress benchmark for Booking.book_listing
+
+Fires N concurrent bookings of random date ranges at a single listing
+from a pool of threads and reports throughput, how many bookings were
+rejected as conflicts, and checks that no night ended up booked twice.
+
+Usage:
+    python -m benchmarks.booking_stress [--threads 16] [--bookings 400]
+
+Runs against a throw-away SQLite file unless db_string is set.
+"""
+import os
+import random
+import argparse
+import tempfile
+import threading
+from time import perf_counter
+from datetime import datetime, timedelta
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--bookings', type=int, default=400)
+    parser.add_argument('--window-days', type=int, default=365,
+                        help='bookings start within this many days')
+    parser.add_argument('--max-nights', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=327)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'booking_stress.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay import database
+    from qbay.database import app, db
+    from qbay.user import User
+    from qbay.listing import Listing
+    from qbay.booking import Booking
+    from qbay.availability import Availability
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        User.register("Owner", "owner@bench.com", "Password123!")
+        owner = database.User.query.filter_by(email="owner@bench.com").one()
+        listing = Listing.create_listing("Stress Test Listing",
+                                         "A listing that everyone wants",
+                                         20, User.query_user(owner.id))
+        buyer_ids = []
+        for i in range(args.threads):
+            email = f"buyer{i}@bench.com"
+            User.register(f"Buyer{i}", email, "Password123!")
+            buyer = User.query_user(
+                database.User.query.filter_by(email=email).one().id)
+            buyer.update_balance(10 ** 9)
+            buyer_ids.append(buyer.id)
+        owner_id, listing_id = owner.id, listing.id
+
+    rng = random.Random(args.seed)
+    first_day = datetime(2030, 1, 1)
+    requests = []
+    for _ in range(args.bookings):
+        start = first_day + timedelta(days=rng.randrange(args.window_days))
+        end = start + timedelta(days=rng.randint(1, args.max_nights))
+        requests.append((start.strftime('%Y-%m-%d'),
+                         end.strftime('%Y-%m-%d')))
+
+    results = {'booked': 0, 'conflict': 0, 'error': 0}
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def worker(index):
+        buyer_id = buyer_ids[index]
+        barrier.wait()
+        for start, end in requests[index::args.threads]:
+            with app.app_context():
+                try:
+                    Booking.book_listing(buyer_id, owner_id, listing_id,
+                                         start, end)
+                    outcome = 'booked'
+                except ValueError:
+                    outcome = 'conflict'
+                except Exception as e:
+                    outcome = 'error'
+                    errors.append(repr(e))
+            with lock:
+                results[outcome] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(args.threads)]
+    began = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - began
+
+    # Every night of every committed booking must be distinct
+    with app.app_context():
+        nights = []
+        for booking in database.Booking.query.filter_by(
+                listing_id=listing_id):
+            day = datetime.strptime(booking.start_date, '%Y-%m-%d')
+            end = datetime.strptime(booking.end_date, '%Y-%m-%d')
+            while day < end:
+                nights.append(day)
+                day += timedelta(days=1)
+        double_booked = len(nights) - len(set(nights))
+        claimed = sum(len(bits) for bits in
+                      Availability(listing_id).year_bits().values())
+
+    total = sum(results.values())
+    print(f"database:          {app.config['SQLALCHEMY_DATABASE_URI']}")
+    print(f"threads:           {args.threads}")
+    print(f"attempts:          {total} in {elapsed:.2f}s "
+          f"({total / elapsed:.1f} attempts/s)")
+    print(f"bookings:          {results['booked']} "
+          f"({results['booked'] / elapsed:.1f} bookings/s)")
+    print(f"conflicts:         {results['conflict']} "
+          f"({100 * results['conflict'] / total:.1f}%)")
+    print(f"errors:            {results['error']}")
+    for error in sorted(set(errors))[:5]:
+        print(f"    {error[:120]}")
+    print(f"nights booked:     {len(nights)} (claimed: {claimed})")
+    print(f"double bookings:   {double_booked}")
+    return 1 if double_booked or claimed != len(nights) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
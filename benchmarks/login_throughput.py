@@ -0,0 +1,106 @@
+"""
+Logins per second for each password hashing cost and pool size
+
+For every cost setting, registers an account, then has --clients threads
+log in through User.login for --seconds, once per password pool size.
+Logins per second divided by the pool size is the per-core figure to
+size PASSWORD_WORKERS (and the number of worker processes) against the
+expected login rate.
+
+Usage:
+    python -m benchmarks.login_throughput [--seconds 3] [--workers 1,4]
+
+Runs against a throw-away SQLite file unless db_string is set; the
+database is dropped and re-created either way.
+"""
+import os
+import argparse
+import tempfile
+import threading
+from time import perf_counter
+
+# (label, app config) of each cost setting measured
+COSTS = (
+    ('scrypt n=2^12', {'PASSWORD_SCHEME': 'scrypt',
+                       'PASSWORD_SCRYPT_N': 2 ** 12}),
+    ('scrypt n=2^14', {'PASSWORD_SCHEME': 'scrypt',
+                       'PASSWORD_SCRYPT_N': 2 ** 14}),
+    ('scrypt n=2^15', {'PASSWORD_SCHEME': 'scrypt',
+                       'PASSWORD_SCRYPT_N': 2 ** 15}),
+    ('pbkdf2 100k', {'PASSWORD_SCHEME': 'pbkdf2',
+                     'PASSWORD_PBKDF2_ITERATIONS': 100000}),
+    ('pbkdf2 600k', {'PASSWORD_SCHEME': 'pbkdf2',
+                     'PASSWORD_PBKDF2_ITERATIONS': 600000}),
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--seconds', type=float, default=3,
+                        help='duration of each measurement')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='threads logging in concurrently')
+    parser.add_argument('--workers', default=None,
+                        help='comma separated pool sizes, default 1 and '
+                             'the number of cores')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'login_throughput.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay import passwords
+    from qbay.database import app, db
+    from qbay.user import User
+
+    cores = os.cpu_count() or 1
+    sizes = sorted({1, cores} if args.workers is None else
+                   {int(size) for size in args.workers.split(',')})
+    print(f"{cores} cores, {args.clients} clients\n")
+    print(f"{'cost':<15} {'workers':>7} {'logins/s':>10} {'per core':>10}"
+          f" {'latency ms':>10}")
+
+    for number, (label, config) in enumerate(COSTS):
+        app.config.update(config)
+        email = f'user{number}@bench.com'
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            User.register(f'User{number}', email, 'Password123!')
+
+        for size in sizes:
+            app.config['PASSWORD_WORKERS'] = size
+            passwords.pool().shutdown()
+            passwords._pool = None  # the next call starts a pool of size
+
+            logins, stop = [0] * args.clients, threading.Event()
+
+            def client(index):
+                with app.app_context():
+                    while not stop.is_set():
+                        User.login(email, 'Password123!')
+                        logins[index] += 1
+                    db.session.remove()
+
+            threads = [threading.Thread(target=client, args=(i,))
+                       for i in range(args.clients)]
+            began = perf_counter()
+            for thread in threads:
+                thread.start()
+            stop.wait(args.seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+            elapsed = perf_counter() - began
+            rate = sum(logins) / elapsed
+            print(f"{label:<15} {size:>7} {rate:>10.1f} "
+                  f"{rate / min(size, cores):>10.1f} "
+                  f"{1000 * args.clients / rate:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Booking throughput of a popular owner, paid inline against batched payouts
+
+Seeds one owner with many listings and N buyers, then has the buyers book
+distinct listing and night combinations of that owner from a pool of
+threads, twice: once crediting the owner's balance row inside each booking
+(inline, as before payouts), and once recording a pending payout that the
+settler pays afterwards (batched). Reports bookings per second, median
+and p99 booking latency, the time the settler took, and checks that the
+owner was paid exactly for every booking. Bookings refused because
+another one held the same listing's availability at that moment are
+counted as failed.
+
+SQLite serializes every write transaction anyway, so the gap shows when
+db_string points at a MySQL server, where the inline credit makes all of
+the owner's bookings queue on one row lock.
+
+Usage:
+    python -m benchmarks.owner_payouts [--threads 16] [--bookings 800]
+
+Runs against a throw-away SQLite file unless db_string is set; the
+database is dropped and re-seeded for each mode.
+"""
+import os
+import random
+import argparse
+import tempfile
+import threading
+from time import perf_counter
+from datetime import datetime, timedelta
+from benchmarks import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--bookings', type=int, default=800)
+    parser.add_argument('--listings', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=327)
+    return parser.parse_args()
+
+
+def seed(database, db, args):
+    """Bulk inserts the owner, one buyer per thread and the owner's
+    listings
+    """
+    from sqlalchemy import insert
+    from qbay import migrations
+    db.drop_all()
+    migrations.migrate()
+    db.session.execute(insert(database.User), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@bench.com',
+         'password': 'Password123!', 'balance_snapshot': 10 ** 6}
+        for i in range(1, args.threads + 2)])
+    db.session.execute(insert(database.Listing), [
+        {'id': i, 'title': f'Listing {i}', 'price': 2000,
+         'description': f'Description of listing number {i}', 'address': '',
+         'date_created': '2022-01-01', 'last_modified_date': '2022-01-01',
+         'next_available_date': '2022-01-01', 'owner_id': 1}
+        for i in range(1, args.listings + 1)])
+    db.session.commit()
+
+
+def inline_record(owner_id: int, amount, booking_id: int = None):
+    """The owner's credit written in the booking's transaction"""
+    from sqlalchemy import update
+    from qbay import database
+    from qbay.database import db
+    User = database.User
+    db.session.execute(
+        update(User).where(User.id == owner_id)
+        .values(balance_snapshot=User.balance_snapshot + amount)
+        .execution_options(synchronize_session=False))
+
+
+def run(args, requests, mode):
+    from qbay import database, payouts
+    from qbay.database import app, db
+    from qbay.booking import Booking
+
+    with app.app_context():
+        seed(database, db, args)
+        before = db.session.get(database.User, 1).balance
+
+    timings, errors = [], []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def worker(index):
+        buyer_id = index + 2
+        barrier.wait()
+        for listing_id, start, end in requests[index::args.threads]:
+            with app.app_context():
+                began = perf_counter()
+                try:
+                    Booking.book_listing(buyer_id, 1, listing_id, start, end)
+                except Exception as e:
+                    with lock:
+                        errors.append(repr(e))
+                    continue
+                elapsed = perf_counter() - began
+            with lock:
+                timings.append(elapsed)
+
+    record = payouts.record
+    if mode == 'inline':
+        payouts.record = inline_record
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(args.threads)]
+    began = perf_counter()
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        payouts.record = record
+    elapsed = perf_counter() - began
+
+    with app.app_context():
+        settle_began = perf_counter()
+        while payouts.settle():
+            db.session.commit()
+        settle_time = perf_counter() - settle_began
+        earned = db.session.get(database.User, 1).balance - before
+    timings.sort()
+    return {'bookings': len(timings), 'elapsed': elapsed,
+            'median': timings[len(timings) // 2] * 1000 if timings else 0,
+            'p99': percentile(timings, 0.99) * 1000 if timings else 0,
+            'settle': settle_time * 1000, 'errors': errors,
+            'paid': round(earned, 2) == 20 * len(timings)}
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'owner_payouts.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay.database import app
+
+    # Distinct nights, so every booking succeeds
+    rng = random.Random(args.seed)
+    first_day = datetime(2030, 1, 1)
+    nights = [(listing_id, day) for listing_id in range(1, args.listings + 1)
+              for day in range(-(-args.bookings // args.listings))]
+    requests = []
+    for listing_id, day in rng.sample(nights, args.bookings):
+        start = first_day + timedelta(days=2 * day)
+        requests.append((listing_id, start.strftime('%Y-%m-%d'),
+                         (start + timedelta(days=1)).strftime('%Y-%m-%d')))
+
+    print(f"database: {app.config['SQLALCHEMY_DATABASE_URI']}")
+    print(f"{'mode':<8} {'bookings/s':>11} {'median ms':>10} {'p99 ms':>9}"
+          f" {'settle ms':>10} {'failed':>7} {'paid':>5}")
+    failed = False
+    for mode in ('inline', 'batched'):
+        result = run(args, requests, mode)
+        print(f"{mode:<8} {result['bookings'] / result['elapsed']:>11.1f} "
+              f"{result['median']:>10.2f} {result['p99']:>9.2f} "
+              f"{result['settle']:>10.2f} {len(result['errors']):>7} "
+              f"{'yes' if result['paid'] else 'NO':>5}")
+        for error in sorted(set(result['errors']))[:5]:
+            print(f"    {error[:120]}")
+        failed = failed or not result['paid']
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
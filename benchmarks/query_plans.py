@@ -0,0 +1,199 @@
+"""
+Latency and query plans of the hot lookups, without and with indexes
+
+Seeds a large catalog, then times each hot query with every secondary
+index of the involved tables dropped and again once they are recreated,
+printing the database's query plan for both runs.
+
+Usage:
+    python -m benchmarks.query_plans [--listings 50000] [--bookings 100000]
+
+Runs against a throw-away SQLite file unless db_string is set; the
+database is dropped and re-seeded either way.
+"""
+import os
+import random
+import argparse
+import tempfile
+from time import perf_counter
+from datetime import datetime, timedelta
+from benchmarks import percentile
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--listings', type=int, default=50000)
+    parser.add_argument('--bookings', type=int, default=100000)
+    parser.add_argument('--samples', type=int, default=200,
+                        help='executions timed per query')
+    parser.add_argument('--seed', type=int, default=327)
+    return parser.parse_args()
+
+
+def seed(database, db, args, rng):
+    """Bulk inserts users, listings, non-overlapping bookings and the
+    ledger entries charging their buyers
+    """
+    from sqlalchemy import insert
+    from qbay.bitmaps import YearBits, split_by_year
+
+    def bulk(model, rows, batch=10000):
+        for i in range(0, len(rows), batch):
+            db.session.execute(insert(model), rows[i:i + batch])
+
+    bulk(database.User, [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@bench.com',
+         'password': 'Password123!', 'postal_code': '',
+         'balance_snapshot': 100, 'billing_address': ''}
+        for i in range(1, args.users + 1)])
+    bulk(database.Listing, [
+        {'id': i, 'title': f'Listing {i}', 'price': 2000,
+         'description': f'Description of listing number {i}',
+         'address': f'{i} Bench Street', 'date_created': '2022-01-01',
+         'last_modified_date': '2022-01-01',
+         'owner_id': rng.randint(1, args.users)}
+        for i in range(1, args.listings + 1)])
+
+    next_free = {}
+    bookings, ranges, years = [], [], {}
+    for i in range(1, args.bookings + 1):
+        listing_id = rng.randint(1, args.listings)
+        start = next_free.get(listing_id, datetime(2022, 1, 1))
+        start += timedelta(days=rng.randint(1, 10))
+        end = start + timedelta(days=rng.randint(1, 7))
+        next_free[listing_id] = end
+        start_s, end_s = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+        bookings.append({'id': i, 'buyer_id': rng.randint(1, args.users),
+                         'owner_id': 0, 'listing_id': listing_id,
+                         'start_date': start_s, 'end_date': end_s})
+        ranges.append({'listing_id': listing_id, 'start_date': start_s,
+                       'end_date': end_s})
+        for year, first, last in split_by_year(start, end):
+            bits = years.setdefault((listing_id, year), YearBits(year))
+            bits.set_range(first, last)
+    bulk(database.Booking, bookings)
+    bulk(database.BookedRange, ranges)
+    bulk(database.BookedYear, [
+        {'listing_id': listing_id, 'year': year, 'bits': bits.to_bytes(),
+         'version': 1} for (listing_id, year), bits in years.items()])
+    bulk(database.LedgerEntry, [
+        {'user_id': booking['buyer_id'], 'amount': -1,
+         'kind': 'booking_debit', 'booking_id': booking['id']}
+        for booking in bookings])
+    db.session.commit()
+    return sum(len(bits) for bits in years.values())
+
+
+def hot_queries(database, args):
+    """Returns (name, statement factory) for each hot lookup"""
+    from sqlalchemy import select
+    Listing, Booking, User = database.Listing, database.Booking, database.User
+    BookedRange, BookedYear = database.BookedRange, database.BookedYear
+    return [
+        ('listing by title (valid_title)',
+         lambda rng: select(Listing.id).where(
+             Listing.title == f'Listing {rng.randint(1, args.listings)}')),
+        ('listings by owner (/user_listings)',
+         lambda rng: select(Listing).where(
+             Listing.owner_id == rng.randint(1, args.users))),
+        ('overlap probe (booking)',
+         lambda rng: select(BookedRange).where(
+             BookedRange.listing_id == rng.randint(1, args.listings),
+             BookedRange.start_date < '2023-06-01')
+         .order_by(BookedRange.start_date.desc()).limit(1)),
+        ('year bitmap lookup (booking)',
+         lambda rng: select(BookedYear).where(
+             BookedYear.listing_id == rng.randint(1, args.listings),
+             BookedYear.year == 2022)),
+        ('bookings by buyer (/user_bookings)',
+         lambda rng: select(Booking).where(
+             Booking.buyer_id == rng.randint(1, args.users))),
+        ('balance with ledger entries (every page)',
+         lambda rng: select(User.balance).where(
+             User.id == rng.randint(1, args.users))),
+    ]
+
+
+def explain(db, statement):
+    """Returns the database's plan for statement as a single line"""
+    from sqlalchemy import text
+    connection = db.session.connection()
+    sql = str(statement.compile(dialect=connection.dialect,
+                                compile_kwargs={'literal_binds': True}))
+    if connection.dialect.name == 'sqlite':
+        rows = connection.execute(text('EXPLAIN QUERY PLAN ' + sql))
+        return '; '.join(row[-1] for row in rows)
+    rows = connection.execute(text('EXPLAIN ' + sql)).mappings()
+    return '; '.join(f"{row.get('table')}: key={row.get('key')} "
+                     f"rows={row.get('rows')}" for row in rows)
+
+
+def measure(db, queries, samples, rng):
+    """Times every query and returns {name: (median ms, p95 ms, plan)}"""
+    results = {}
+    for name, factory in queries:
+        timings = []
+        for _ in range(samples):
+            statement = factory(rng)
+            began = perf_counter()
+            db.session.execute(statement).all()
+            timings.append((perf_counter() - began) * 1000)
+        timings.sort()
+        results[name] = (timings[len(timings) // 2],
+                         percentile(timings, 0.95),
+                         explain(db, factory(rng)))
+    return results
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'query_plans.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay import database
+    from qbay.database import app, db
+
+    rng = random.Random(args.seed)
+    tables = [database.Listing.__table__, database.Booking.__table__,
+              database.BookedRange.__table__, database.LedgerEntry.__table__]
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        began = perf_counter()
+        nights = seed(database, db, args, rng)
+        print(f"seeded {args.users} users, {args.listings} listings, "
+              f"{args.bookings} bookings, {nights} booked nights "
+              f"in {perf_counter() - began:.1f}s\n")
+
+        queries = hot_queries(database, args)
+        connection = db.session.connection()
+        for table in tables:
+            for index in table.indexes:
+                index.drop(connection)
+        db.session.commit()
+        before = measure(db, queries, args.samples, random.Random(args.seed))
+
+        connection = db.session.connection()
+        for table in tables:
+            for index in table.indexes:
+                index.create(connection)
+        if connection.dialect.name == 'sqlite':
+            db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+        after = measure(db, queries, args.samples, random.Random(args.seed))
+
+    for name, _ in queries:
+        print(name)
+        for label, (median, p95, plan) in (('without', before[name]),
+                                           ('with', after[name])):
+            print(f"  {label:<8} indexes: median {median:8.3f} ms  "
+                  f"p95 {p95:8.3f} ms")
+            print(f"  {'':<8} plan: {plan}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
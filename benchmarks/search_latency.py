@@ -0,0 +1,123 @@
+"""
+Latency of full-text listing search on a large catalog
+
+Seeds listings whose text mixes a few very common words with rarer
+place names, builds the search index, then times the first and a later
+page of searches for a place name, two place names, a place name and a
+common word, and a common word alone (the worst case, as it matches a
+large share of the catalog).
+
+Usage:
+    python -m benchmarks.search_latency [--listings 1000000]
+
+Runs against a throw-away SQLite file unless db_string is set; the
+database is dropped and re-seeded either way.
+"""
+import os
+import random
+import argparse
+import tempfile
+from time import perf_counter
+from benchmarks import percentile
+
+WORDS = ('cozy quiet sunny spacious modern rustic historic bright private '
+         'downtown lakeside beach mountain forest garden river harbour '
+         'village loft cabin cottage studio suite villa condo bungalow '
+         'apartment house chalet farmhouse penthouse view pool patio '
+         'balcony fireplace kitchen parking wifi sauna terrace courtyard '
+         'street avenue road lane drive crescent park square hill bay').split()
+SYLLABLES = ('ka lo mi ra ten vu sa po ne li dor an bel cor fin gar hal '
+             'jun mar nor pel qui ros tul ver win zan').split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--listings', type=int, default=200000)
+    parser.add_argument('--places', type=int, default=20000,
+                        help='distinct place names in the catalog')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='executions timed per kind of search')
+    parser.add_argument('--seed', type=int, default=327)
+    return parser.parse_args()
+
+
+def place_names(args, rng):
+    """Returns distinct made up place names"""
+    names = set()
+    while len(names) < args.places:
+        names.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(3, 4))))
+    return sorted(names)
+
+
+def seed(database, db, args, rng, places):
+    """Bulk inserts a user and listings with random text"""
+    from sqlalchemy import insert
+
+    def sentence(n):
+        words = [rng.choice(WORDS) for _ in range(n)]
+        words[rng.randrange(n)] = rng.choice(places)
+        return ' '.join(words)
+
+    db.session.execute(insert(database.User), [{
+        'id': 1, 'username': 'bench', 'email': 'bench@bench.com',
+        'password': 'Password123!', 'balance_snapshot': 100}])
+    batch = 10000
+    for first in range(1, args.listings + 1, batch):
+        db.session.execute(insert(database.Listing), [
+            {'id': i, 'title': f'{sentence(3)} {i}',
+             'description': sentence(rng.randint(10, 40)),
+             'address': f'{i} {sentence(2)}', 'price': 2000,
+             'date_created': '2022-01-01',
+             'last_modified_date': '2022-01-01', 'owner_id': 1}
+            for i in range(first, min(first + batch, args.listings + 1))])
+    db.session.commit()
+
+
+def main():
+    args = parse_args()
+    if not os.getenv('db_string'):
+        path = os.path.join(tempfile.mkdtemp(), 'search_latency.db')
+        os.environ['db_string'] = 'sqlite:///' + path
+
+    # qbay reads db_string at import time
+    from qbay import database, search
+    from qbay.database import app, db
+
+    rng = random.Random(args.seed)
+    places = place_names(args, rng)
+    kinds = [
+        ('place', lambda: rng.choice(places)),
+        ('two places', lambda: f'{rng.choice(places)} {rng.choice(places)}'),
+        ('place + word', lambda: f'{rng.choice(places)} {rng.choice(WORDS)}'),
+        ('common word', lambda: rng.choice(WORDS)),
+    ]
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        began = perf_counter()
+        seed(database, db, args, rng, places)
+        seeded = perf_counter() - began
+        began = perf_counter()
+        search.rebuild_index()
+        db.session.commit()
+        print(f"seeded {args.listings} listings in {seeded:.1f}s, "
+              f"indexed them in {perf_counter() - began:.1f}s "
+              f"({search.dialect()})\n")
+
+        for name, query in kinds:
+            for page in (1, 10):
+                timings = []
+                for _ in range(args.samples):
+                    began = perf_counter()
+                    search.search_listings(query(), page)
+                    timings.append((perf_counter() - began) * 1000)
+                    db.session.rollback()
+                timings.sort()
+                print(f"{name:<13} page {page:<3} "
+                      f"median {timings[len(timings) // 2]:8.3f} ms  "
+                      f"p95 {percentile(timings, 0.95):8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
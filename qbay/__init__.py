@@ -7,7 +7,5 @@ sys.path.append(os.path.dirname(SCRIPT_DIR))
 
 templates = os.path.join(SCRIPT_DIR, "templates")
 
-# Drop existing database and create new instance
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+# The schema is managed by qbay.migrations (`python -m qbay migrate`),
+# so importing the package never touches the database
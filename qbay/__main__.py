@@ -1,8 +1,78 @@
+import os
+import argparse
+from time import sleep
 from qbay import *
 from qbay.database import app
 from qbay.controllers import *
+from qbay import api, jobs, migrations, server
 
 FLASK_PORT = 8081
 
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m qbay',
+                                     description='QBay web application')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help='apply pending migrations and run the '
+                                    'development server (default)')
+    migrate = commands.add_parser('migrate',
+                                  help='apply pending schema migrations')
+    migrate.add_argument('--to', type=int, default=None, metavar='VERSION',
+                         help='stop after this schema version')
+    migrate.add_argument('--status', action='store_true',
+                         help='only show the current and pending versions')
+    serve = commands.add_parser('serve', help='apply pending migrations and '
+                                              'serve with multiple workers')
+    server.add_arguments(serve)
+    worker = commands.add_parser('worker', help='run background jobs '
+                                                'until interrupted')
+    worker.add_argument('--threads', type=int, default=None,
+                        help='job threads (default: job_workers, or 2)')
+    return parser.parse_args(argv)
+
+
+def migrate_command(args):
+    with app.app_context():
+        if args.status:
+            print(f"Schema version: {migrations.current_version()}")
+            for step in migrations.pending():
+                print(f"Pending: {step.version} {step.description}")
+            return
+        applied = migrations.migrate(args.to)
+        for step in applied:
+            print(f"Applied: {step.version} {step.description}")
+        print(f"Schema version: {migrations.current_version()}")
+
+
+def run_command(args):
+    with app.app_context():
+        migrations.migrate()
+    # The reloader's parent process only watches for changes
+    if os.environ.get('WERKZEUG_RUN_MAIN'):
+        jobs.start()
+    app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
+
+
+def worker_command(args):
+    with app.app_context():
+        migrations.migrate()
+    workers = jobs.start(max(1, args.threads or
+                             app.config['JOB_WORKERS']))
+    print(f"Running background jobs on {workers.size} threads")
+    try:
+        while True:
+            sleep(60)
+    except KeyboardInterrupt:
+        jobs.stop()
+
+
 if __name__ == "__main__":
-    app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
\ No newline at end of file
+    args = parse_args()
+    if args.command == 'migrate':
+        migrate_command(args)
+    elif args.command == 'serve':
+        server.serve(args)
+    elif args.command == 'worker':
+        worker_command(args)
+    else:
+        run_command(args)
\ No newline at end of file
@@ -0,0 +1,216 @@
+"""
+Versioned JSON API under /api/v1, for clients that need the data of the
+HTML pages without their markup
+
+Collections are paged by cursor: a page holds at most ?limit= items
+(default API_PAGE_SIZE, at most API_MAX_PAGE_SIZE) and `next` is the
+?after= value of the following page, or null on the last one. ?fields=
+picks the fields of each item, e.g. ?fields=id,title,price, and only
+those columns are read from the database. Prices are in cents.
+/api/v1/listings also takes ?available_from=&available_to= (a stay, end
+exclusive) and ?min_price=&max_price= to only list bookable listings.
+"""
+
+from qbay import database
+from qbay.database import app, db, read_only
+from qbay.user import User
+from qbay.listing import Listing
+from qbay.booking import Booking
+from qbay.ratelimit import rate_limited
+from flask import jsonify, request, session
+from functools import wraps
+from sqlalchemy import select
+from datetime import date
+
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+
+# Fields a client can select, with the column each one is read from
+LISTING_FIELDS = {
+    'id': database.Listing.id,
+    'title': database.Listing.title,
+    'description': database.Listing.description,
+    'price': database.Listing.price,
+    'address': database.Listing.address,
+    'owner_id': database.Listing.owner_id,
+    'owner': database.User.username,
+    'date_created': database.Listing.date_created,
+    'last_modified_date': database.Listing.last_modified_date,
+}
+DEFAULT_LISTING_FIELDS = ('id', 'title', 'price', 'owner_id', 'owner')
+
+BOOKING_FIELDS = {
+    'id': database.Booking.id,
+    'listing_id': database.Booking.listing_id,
+    'owner_id': database.Booking.owner_id,
+    'start_date': database.Booking.start_date,
+    'end_date': database.Booking.end_date,
+    'title': database.Listing.title,
+}
+DEFAULT_BOOKING_FIELDS = ('id', 'listing_id', 'start_date', 'end_date')
+
+
+def api_error(status: int, message: str):
+    """JSON error response"""
+    return jsonify(error=message), status
+
+
+def api_user(inner_function):
+    """Like controllers.authenticate, but answers 401 instead of
+    redirecting to the login page
+    """
+    @wraps(inner_function)
+    def wrapped(*args, **kwargs):
+        user = None
+        if 'logged_in' in session:
+            user = User.query_user_cached(session['logged_in'],
+                                          label=request.endpoint)
+        if not user:
+            return api_error(401, "Login required")
+        return inner_function(user, *args, **kwargs)
+    return wrapped
+
+
+def selected_fields(available: dict, default: tuple) -> 'list':
+    """Parses ?fields= against the available fields
+
+    Raises ValueError on an unknown field
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return list(default)
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown or not names:
+        raise ValueError("Unknown fields: " + ','.join(unknown) +
+                         "; available: " + ','.join(available))
+    return names
+
+
+def page_args():
+    """Parses ?after= and ?limit=, raising ValueError if malformed"""
+    after = request.args.get('after')
+    limit = request.args.get('limit', API_PAGE_SIZE)
+    try:
+        after = None if after is None else int(after)
+        limit = int(limit)
+    except ValueError:
+        raise ValueError("after and limit must be integers")
+    if not 0 < limit <= API_MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {API_MAX_PAGE_SIZE}")
+    return after, limit
+
+
+def listing_filters(statement):
+    """Applies the optional ?available_from= and ?available_to= stay and
+    ?min_price= and ?max_price= bounds (in cents) to a listings select,
+    raising ValueError if the stay is malformed
+    """
+    start = request.args.get('available_from')
+    end = request.args.get('available_to')
+    if start or end:
+        if not (start and end):
+            raise ValueError("available_from and available_to go together")
+        Listing.valid_stay(start, end)
+        statement = statement.where(Listing.free_between(start, end))
+    min_price = request.args.get('min_price', type=int)
+    max_price = request.args.get('max_price', type=int)
+    if min_price is not None:
+        statement = statement.where(database.Listing.price >= min_price)
+    if max_price is not None:
+        statement = statement.where(database.Listing.price <= max_price)
+    return statement
+
+
+def keyset_page(statement, key, fields, available, after, limit):
+    """Runs statement for one page ordered by key, reading only the
+    selected columns into plain dicts
+
+    Returns:
+        (List[dict], int): the items and the cursor of the next page, or
+        None if this is the last page
+    """
+    statement = (statement.add_columns(*(available[name] for name in fields),
+                                       key)
+                 .order_by(key).limit(limit + 1))
+    if after is not None:
+        statement = statement.where(key > after)
+    rows = db.session.execute(statement).all()
+    items = [dict(zip(fields, row)) for row in rows[:limit]]
+    next_cursor = rows[limit - 1][-1] if len(rows) > limit else None
+    return items, next_cursor
+
+
+@app.route('/api/v1/listings')
+@read_only
+def api_listings():
+    try:
+        fields = selected_fields(LISTING_FIELDS, DEFAULT_LISTING_FIELDS)
+        after, limit = page_args()
+    except ValueError as e:
+        return api_error(400, str(e))
+    statement = select().select_from(database.Listing)
+    if 'owner' in fields:
+        statement = statement.join(database.Listing.owner)
+    try:
+        statement = listing_filters(statement)
+    except ValueError as e:
+        return api_error(400, str(e))
+    items, next_cursor = keyset_page(statement, database.Listing.id, fields,
+                                     LISTING_FIELDS, after, limit)
+    return jsonify(data=items, next=next_cursor)
+
+
+@app.route('/api/v1/listings/<int:listing_id>/availability')
+@read_only
+def api_listing_availability(listing_id):
+    listing = Listing.query_listing(listing_id)
+    if not listing:
+        return api_error(404, f"Invalid Listing ID: {listing_id}")
+    first_free = listing.find_min_booking_date()
+    since = request.args.get('since', date.today().isoformat())
+    return jsonify(listing_id=listing_id, first_free=first_free,
+                   booked=listing.availability.ranges(since=since))
+
+
+@app.route('/api/v1/me/bookings', methods=['GET'])
+@read_only
+@api_user
+def api_my_bookings(user):
+    try:
+        fields = selected_fields(BOOKING_FIELDS, DEFAULT_BOOKING_FIELDS)
+        after, limit = page_args()
+    except ValueError as e:
+        return api_error(400, str(e))
+    statement = (select().select_from(database.Booking)
+                 .where(database.Booking.buyer_id == user.id))
+    if 'title' in fields:
+        statement = statement.join(database.Booking.listing)
+    items, next_cursor = keyset_page(statement, database.Booking.id, fields,
+                                     BOOKING_FIELDS, after, limit)
+    return jsonify(data=items, next=next_cursor)
+
+
+@app.route('/api/v1/me/bookings', methods=['POST'])
+@rate_limited('booking', error=api_error)
+@api_user
+def api_book_listing(user):
+    """Books {listing_id, start_date, end_date} for the logged in user,
+    with the same checks as the booking page
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        listing_id = int(body.get('listing_id'))
+    except (TypeError, ValueError):
+        return api_error(400, "listing_id must be an integer")
+    listing = Listing.query_listing(listing_id)
+    if not listing:
+        return api_error(404, f"Invalid Listing ID: {listing_id}")
+    start_date, end_date = body.get('start_date'), body.get('end_date')
+    try:
+        Booking.book_listing(user.id, listing.database_obj.owner_id,
+                             listing.id, str(start_date), str(end_date))
+    except ValueError as e:
+        return api_error(400, str(e))
+    return jsonify(listing_id=listing.id, start_date=start_date,
+                   end_date=end_date), 201
@@ -0,0 +1,316 @@
+"""
+Async serving mode, used by `python -m qbay serve --async`
+
+The read-heavy pages (Home, the booking page, My Bookings and My
+Listings) are answered on an event loop, reading through SQLAlchemy's
+asyncio engine with an async driver (aiosqlite or aiomysql), so a worker
+waiting on the database keeps serving its other connections instead of
+holding a thread per request. Every other request, including every
+write, falls through to the Flask app, which asgiref's WsgiToAsgi runs on
+a thread pool.
+
+The pages are built from the same statements, caches (user snapshots,
+listing cards) and templates as their threaded versions in
+qbay.controllers, and answer the same ETags. Reads are sent to the read
+replicas under the same rules as the read_only decorator.
+
+Requires: pip install asgiref uvicorn aiosqlite (or aiomysql for MySQL)
+"""
+import re
+import random
+from time import time
+from datetime import date
+from urllib.parse import parse_qs
+from typing import Dict, List, Optional
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import joinedload
+from werkzeug.http import parse_cookie, parse_etags
+from werkzeug.wrappers import Response
+from qbay import api, controllers, database  # noqa: F401 registers routes
+from qbay.database import app, engine_options
+from qbay.availability import Availability
+from qbay.bitmaps import YearBits
+from qbay.controllers import hex_bitmaps, page_etag, tag_page
+from qbay.listing import FEED_PAGE_SIZE, Listing
+from qbay.user import User, user_cache
+
+# Async driver used in place of each synchronous one
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+}
+
+
+def async_url(uri: str):
+    """The database URL of uri with its driver swapped for an async one"""
+    url = make_url(uri)
+    driver = ASYNC_DRIVERS.get(url.drivername)
+    return url.set(drivername=driver) if driver else url
+
+
+def async_engine_options(uri: str) -> dict:
+    """engine_options for an async engine, which brings its own pool"""
+    options = dict(engine_options(uri))
+    options.pop('poolclass', None)
+    return options
+
+
+class PageRequest:
+    """The parts of an ASGI request the async pages read
+
+    params:
+    - scope: ASGI connection scope (dict)
+    """
+
+    def __init__(self, scope: dict):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = parse_qs(scope.get('query_string', b'').decode())
+        self.headers = {name.decode('latin-1').lower():
+                        value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self.cookies = parse_cookie(self.headers.get('cookie', ''))
+        self.session = self._load_session()
+
+    def int_arg(self, name: str) -> 'Optional[int]':
+        """Like request.args.get(name, type=int)"""
+        try:
+            return int(self.args[name][0])
+        except (KeyError, ValueError):
+            return None
+
+    def _load_session(self) -> dict:
+        """Reads the Flask session cookie"""
+        value = self.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        serializer = app.session_interface.get_signing_serializer(app)
+        if not value or serializer is None:
+            return {}
+        max_age = int(app.permanent_session_lifetime.total_seconds())
+        try:
+            return serializer.loads(value, max_age=max_age)
+        except BadSignature:
+            return {}
+
+    def not_modified(self, etag: str) -> bool:
+        return parse_etags(self.headers.get('if-none-match')) \
+            .contains_weak(etag)
+
+
+def render(template: str, **context) -> str:
+    return app.jinja_env.get_template(template).render(**context)
+
+
+def page(etag: str, html: str = None) -> Response:
+    """The page, or an empty 304 if html is None, tagged with etag"""
+    if html is None:
+        return tag_page(Response('', 304), etag)
+    return tag_page(Response(html, mimetype='text/html'), etag)
+
+
+class AsyncPages:
+    """ASGI application answering the async pages and passing every other
+    request to fallback
+
+    params:
+    - fallback: ASGI application of the rest of the site
+    """
+
+    # (path pattern, handler name, read-only)
+    ROUTES = (
+        (re.compile(r'/'), 'home', True),
+        (re.compile(r'/booking/(\d+)'), 'booking', False),
+        (re.compile(r'/user_bookings'), 'user_bookings', True),
+        (re.compile(r'/user_listings'), 'user_listings', True),
+    )
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self._primary = None
+        self._replicas: 'List' = []
+
+    def engines(self):
+        """Creates the async engines on first use, inside the worker"""
+        from sqlalchemy.ext.asyncio import create_async_engine
+        if self._primary is None:
+            uri = app.config['SQLALCHEMY_DATABASE_URI']
+            self._primary = create_async_engine(
+                async_url(uri), **async_engine_options(uri))
+            for key in database.REPLICA_BINDS:
+                uri = app.config['SQLALCHEMY_BINDS'][key]['url']
+                self._replicas.append(create_async_engine(
+                    async_url(uri), **async_engine_options(uri)))
+        return self._primary, self._replicas
+
+    def session(self, request: PageRequest, read_only: bool):
+        """An AsyncSession on a replica for read-only pages, unless the
+        user wrote something in the last REPLICA_LAG_SECONDS
+        """
+        from sqlalchemy.ext.asyncio import AsyncSession
+        primary, replicas = self.engines()
+        engine = primary
+        if (read_only and replicas
+                and request.session.get('primary_until', 0) <= time()):
+            engine = random.choice(replicas)
+        return AsyncSession(engine, expire_on_commit=False)
+
+    async def dispose(self):
+        primary, replicas = self._primary, self._replicas
+        for engine in ([primary] if primary else []) + replicas:
+            await engine.dispose()
+        self._primary, self._replicas = None, []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            for pattern, name, read_only in self.ROUTES:
+                match = pattern.fullmatch(scope['path'])
+                if match:
+                    request = PageRequest(scope)
+                    async with self.session(request, read_only) as session:
+                        response = await getattr(self, name)(
+                            request, session, *match.groups())
+                    return await self.respond(send, response,
+                                              scope['method'] == 'HEAD')
+        await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def respond(send, response: Response, head: bool = False):
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in response.headers.items()]})
+        await send({'type': 'http.response.body',
+                    'body': b'' if head else response.get_data()})
+
+    async def user(self, request: PageRequest, session,
+                   label: str) -> 'Optional[User]':
+        """Like User.query_user_cached for the logged in user"""
+        if 'logged_in' not in request.session:
+            return None
+        id = int(request.session['logged_in'])
+        snapshot = user_cache.get(id, label)
+        if snapshot is None:
+            database_user = await session.get(database.User, id)
+            if database_user is None:
+                return None
+            snapshot = User.cache_snapshot(database_user)
+        return User.from_snapshot(snapshot)
+
+    async def home(self, request: PageRequest, session) -> Response:
+        user = await self.user(request, session, 'home')
+        if user is None:
+            return Response('', 302, headers={'Location': '/login'})
+        after = request.int_arg('after')
+        listings, next_cursor = Listing.split_page(
+            (await session.scalars(Listing.page_statement(after))).all(),
+            FEED_PAGE_SIZE)
+        # Like controllers.home, the balance is not taken from the cache
+        user.balance = await session.scalar(
+            select(database.User.balance)
+            .where(database.User.id == user.id))
+        etag = page_etag('home', user.id, user.username, user.balance, after,
+                         next_cursor, [(listing.id, listing.version,
+                                        listing.owner.username)
+                                       for listing in listings])
+        if request.not_modified(etag):
+            return page(etag)
+        return page(etag, render(
+            'index.html', user=user, listings=listings, after=after,
+            next_cursor=next_cursor))
+
+    async def booking(self, request: PageRequest, session,
+                      listing_id: str) -> Response:
+        if 'logged_in' not in request.session:
+            return Response('', 302, headers={'Location': '/login'})
+        # The balance shown must be current, so no cached snapshot here
+        user = await session.get(database.User,
+                                 int(request.session['logged_in']))
+        listing = await session.scalar(
+            select(database.Listing)
+            .options(joinedload(database.Listing.owner))
+            .where(database.Listing.id == int(listing_id)))
+        if user is None or listing is None:
+            return Response('Not Found', 404)
+        today = date.today().isoformat()
+        etag = page_etag('booking', user.id, user.balance, listing.id,
+                         listing.version, listing.availability_version,
+                         listing.owner.username, today)
+        if request.not_modified(etag):
+            return page(etag)
+
+        availability = Availability(listing.id)
+        min_date = listing.next_available_date
+        if not min_date or min_date < today:
+            min_date = Availability.free_from(today, await session.scalar(
+                availability.covering_statement(today)))
+        booked_ranges = [tuple(row) for row in await session.execute(
+            availability.ranges_statement(since=min_date))]
+        years: 'Dict[int, YearBits]' = {
+            year: YearBits.from_bytes(year, bits)
+            for year, bits in await session.execute(
+                availability.year_bits_statement(since=int(min_date[:4])))}
+        return page(etag, render(
+            'booking.html', listing=listing, user=user, min_date=min_date,
+            booked_ranges=booked_ranges, booked_bits=hex_bitmaps(years),
+            message=''))
+
+    async def user_bookings(self, request: PageRequest,
+                            session) -> Response:
+        user = await self.user(request, session, 'view_user_bookings')
+        if user is None:
+            return Response('', 302, headers={'Location': '/login'})
+        bookings = (await session.scalars(
+            select(database.Booking)
+            .where(database.Booking.buyer_id == user.id))).all()
+        ids = {booking.listing_id for booking in bookings}
+        by_id = {}
+        if ids:
+            by_id = {listing.id: listing for listing in (
+                await session.scalars(
+                    select(database.Listing)
+                    .options(joinedload(database.Listing.owner))
+                    .where(database.Listing.id.in_(ids))))}
+        listings = [by_id.get(booking.listing_id) for booking in bookings]
+        return Response(render('user_bookings.html', bookings=bookings,
+                               listings=listings), mimetype='text/html')
+
+    async def user_listings(self, request: PageRequest,
+                            session) -> Response:
+        user = await self.user(request, session, 'view_user_listings')
+        if user is None:
+            return Response('', 302, headers={'Location': '/login'})
+        listings = (await session.scalars(
+            select(database.Listing)
+            .where(database.Listing.owner_id == user.id))).all()
+        return Response(render('user_listings.html', listings=listings),
+                        mimetype='text/html')
+
+
+def create_application() -> AsyncPages:
+    """The ASGI application of the whole site"""
+    try:
+        from asgiref.wsgi import WsgiToAsgi
+    except ImportError:
+        raise ImportError("the async mode requires asgiref: "
+                          "pip install asgiref uvicorn aiosqlite")
+    return AsyncPages(WsgiToAsgi(app))
+
+
+application = create_application()
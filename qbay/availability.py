@@ -0,0 +1,235 @@
+from qbay import database
+from qbay.database import db
+from qbay.bitmaps import YearBits, split_by_year
+from sqlalchemy import and_, case, insert, or_, select, update
+from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime, timedelta
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def to_date_string(day) -> str:
+    """Normalize a date, datetime or 'YYYY-MM-DD' string to a string"""
+    if isinstance(day, (date, datetime)):
+        return day.strftime(DATE_FORMAT)
+    return day
+
+
+def fold_nights(nights: List[str]) -> 'List[Tuple[str, str]]':
+    """Fold a list of booked nights into sorted, merged [start, end) ranges
+
+    params:
+    - nights: booked nights as 'YYYY-MM-DD' strings, in any order
+    """
+    ranges = []
+    for night in sorted(set(nights)):
+        day = datetime.strptime(night, DATE_FORMAT)
+        following = (day + timedelta(days=1)).strftime(DATE_FORMAT)
+        if ranges and ranges[-1][1] == night:
+            ranges[-1][1] = following
+        else:
+            ranges.append([night, following])
+    return [(start, end) for start, end in ranges]
+
+
+class Availability:
+    """Booked ranges and nights of a single listing
+
+    Ranges are stored as BookedRange rows which never overlap and are
+    merged when adjacent, so every range lookup below is a single probe
+    of the (listing_id, start_date) index: O(log n) in the number of
+    ranges, regardless of how many nights are being checked or booked.
+    The same nights are also kept as one bitmap per calendar year
+    (BookedYear), which guards against double bookings and answers
+    per-night questions.
+
+    params:
+    - listing_id: ID of the listing (int)
+    """
+
+    def __init__(self, listing_id: int):
+        self._listing_id = listing_id
+
+    @property
+    def listing_id(self):
+        return self._listing_id
+
+    def _query(self):
+        return database.BookedRange.query.filter_by(
+            listing_id=self.listing_id)
+
+    def _range_before(self, day: str) -> 'Optional[database.BookedRange]':
+        """Fetches the last range starting strictly before day"""
+        return (self._query()
+                .filter(database.BookedRange.start_date < day)
+                .order_by(database.BookedRange.start_date.desc())
+                .first())
+
+    def ranges_statement(self, since: str = None):
+        """Select of the booked (start, end) ranges in chronological
+        order, optionally only those that end after since
+        """
+        statement = (select(database.BookedRange.start_date,
+                            database.BookedRange.end_date)
+                     .where(database.BookedRange.listing_id ==
+                            self.listing_id)
+                     .order_by(database.BookedRange.start_date))
+        if since:
+            statement = statement.where(database.BookedRange.end_date > since)
+        return statement
+
+    def ranges(self, since: str = None) -> 'List[Tuple[str, str]]':
+        """Fetches booked [start, end) ranges in chronological order,
+        optionally only those that end after since
+        """
+        return [(start, end) for start, end in
+                db.session.execute(self.ranges_statement(since))]
+
+    def nights(self) -> 'List[str]':
+        """Fetches every booked night in chronological order"""
+        nights = []
+        for bits in self.year_bits().values():
+            nights += bits.nights()
+        return nights
+
+    def overlaps(self, start, end) -> bool:
+        """Determine if [start, end) overlaps any booked range
+
+        Ranges are disjoint and sorted, so only the last range starting
+        before end can overlap.
+        """
+        start, end = to_date_string(start), to_date_string(end)
+        candidate = self._range_before(end)
+        return candidate is not None and candidate.end_date > start
+
+    def year_bits_statement(self, since: int = None):
+        """Select of the (year, bits) rows of the listing, optionally
+        only from the year since onwards
+        """
+        statement = (select(database.BookedYear.year,
+                            database.BookedYear.bits)
+                     .where(database.BookedYear.listing_id ==
+                            self.listing_id)
+                     .order_by(database.BookedYear.year))
+        if since is not None:
+            statement = statement.where(database.BookedYear.year >= since)
+        return statement
+
+    def year_bits(self, since: int = None) -> 'Dict[int, YearBits]':
+        """Fetches the booked nights of each year with bookings, optionally
+        only from the year since onwards
+        """
+        return {year: YearBits.from_bytes(year, bits) for year, bits in
+                db.session.execute(self.year_bits_statement(since))}
+
+    def claim(self, start, end):
+        """Sets the nights [start, end) in the listing's yearly bitmaps,
+        one row per calendar year touched.
+
+        Each row is read without a lock, checked and written back only
+        if its version is unchanged, so a booking that raced past the
+        overlap check is rejected here instead of waiting: ValueError if
+        the nights were taken or the row changed in the meantime,
+        sqlalchemy.exc.IntegrityError if another booking created the same
+        year's row first.
+        """
+        for year, first, last in split_by_year(start, end):
+            row = db.session.execute(
+                select(database.BookedYear.bits, database.BookedYear.version)
+                .where(database.BookedYear.listing_id == self.listing_id,
+                       database.BookedYear.year == year)).first()
+            if row is None:
+                bits = YearBits(year)
+                bits.set_range(first, last)
+                db.session.execute(insert(database.BookedYear), [{
+                    'listing_id': self.listing_id, 'year': year,
+                    'bits': bits.to_bytes(), 'version': 1}])
+                continue
+            bits = YearBits.from_bytes(year, row.bits)
+            if bits.any_in(first, last):
+                raise ValueError("Given dates overlap with existing bookings!")
+            bits.set_range(first, last)
+            swapped = db.session.execute(
+                update(database.BookedYear)
+                .where(database.BookedYear.listing_id == self.listing_id,
+                       database.BookedYear.year == year,
+                       database.BookedYear.version == row.version)
+                .values(bits=bits.to_bytes(),
+                        version=database.BookedYear.version + 1))
+            if swapped.rowcount != 1:
+                raise ValueError("The listing was booked by someone else at "
+                                 "the same time, please try again!")
+
+    def reserve(self, start, end):
+        """Records [start, end) as booked, merging with adjacent ranges.
+        The nights are claimed first so a conflicting concurrent booking
+        fails before touching any range. The listing's
+        availability_version is bumped and its next_available_date moved
+        past the merged range if the range covers it. The caller is
+        responsible for committing, or rolling back if claim raises.
+        """
+        start, end = to_date_string(start), to_date_string(end)
+        self.claim(start, end)
+        previous = self._range_before(start)
+        if previous is not None and previous.end_date != start:
+            previous = None
+        following = self._query().filter_by(start_date=end).first()
+        merged_start = previous.start_date if previous else start
+        merged_end = following.end_date if following else end
+
+        if previous and following:
+            previous.end_date = following.end_date
+            db.session.delete(following)
+        elif previous:
+            previous.end_date = end
+        elif following:
+            following.start_date = start
+        else:
+            db.session.add(database.BookedRange(listing_id=self.listing_id,
+                                                start_date=start,
+                                                end_date=end))
+        # Moved relative to its current value in a single UPDATE, so
+        # concurrent bookings of the listing cannot overwrite each other's
+        # change. A date in the past is replaced by the first free night,
+        # like free_from, looked up by the CASE only in that branch.
+        today = date.today().strftime(DATE_FORMAT)
+        next_free = database.Listing.next_available_date
+        covering_end = self.covering_statement(today).scalar_subquery()
+        next_available_date = case(
+            (or_(next_free.is_(None), next_free < today),
+             case((covering_end > today, covering_end), else_=today)),
+            (and_(next_free >= merged_start, next_free < merged_end),
+             merged_end),
+            else_=next_free)
+        db.session.execute(
+            update(database.Listing)
+            .where(database.Listing.id == self.listing_id)
+            .values(availability_version=(
+                database.Listing.availability_version + 1),
+                next_available_date=next_available_date))
+
+    def covering_statement(self, day: str):
+        """Select of the end of the last range starting on or before day,
+        the only range that can cover it
+        """
+        return (select(database.BookedRange.end_date)
+                .where(database.BookedRange.listing_id == self.listing_id,
+                       database.BookedRange.start_date <= day)
+                .order_by(database.BookedRange.start_date.desc())
+                .limit(1))
+
+    @staticmethod
+    def free_from(day: str, covering_end: 'Optional[str]') -> str:
+        """First free night on or after day, given the result of
+        covering_statement. Adjacent ranges are merged, so the end of the
+        range covering day (if any) is always free.
+        """
+        if covering_end is not None and covering_end > day:
+            return covering_end
+        return day
+
+    def first_free(self, day) -> str:
+        """Fetches the first night on or after day that is not booked"""
+        day = to_date_string(day)
+        return self.free_from(
+            day, db.session.scalar(self.covering_statement(day)))
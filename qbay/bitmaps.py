@@ -0,0 +1,122 @@
+from datetime import date, datetime, timedelta
+from typing import Iterator, List, Tuple
+
+# Bytes of the blob holding the nights of one year, leap years included
+YEAR_BYTES = 46
+
+
+def days_in_year(year: int) -> int:
+    return (date(year + 1, 1, 1) - date(year, 1, 1)).days
+
+
+def to_date(day) -> date:
+    """Normalize a date, datetime or 'YYYY-MM-DD' string to a date"""
+    if isinstance(day, datetime):
+        return day.date()
+    if isinstance(day, date):
+        return day
+    return datetime.strptime(day, '%Y-%m-%d').date()
+
+
+def split_by_year(start, end) -> 'List[Tuple[int, int, int]]':
+    """Splits the nights [start, end) by calendar year
+
+    Returns:
+        (year, first, last) for every year touched, where the nights are
+        bits [first, last) of that year's YearBits
+    """
+    start, end = to_date(start), to_date(end)
+    spans = []
+    while start < end:
+        following = date(start.year + 1, 1, 1)
+        stop = min(end, following)
+        first = start.timetuple().tm_yday - 1
+        spans.append((start.year, first, first + (stop - start).days))
+        start = stop
+    return spans
+
+
+class YearBits:
+    """Set of nights of one calendar year, bit i standing for the night
+    starting on day i of the year (January 1st is bit 0)
+
+    params:
+    - year: Calendar year (int)
+    - bits: The set as an integer bitmask (int)
+    """
+
+    __slots__ = ('year', 'bits')
+
+    def __init__(self, year: int, bits: int = 0):
+        self.year = year
+        self.bits = bits
+
+    @classmethod
+    def from_bytes(cls, year: int, blob: bytes) -> 'YearBits':
+        return cls(year, int.from_bytes(blob, 'little'))
+
+    def to_bytes(self) -> bytes:
+        return self.bits.to_bytes(YEAR_BYTES, 'little')
+
+    @staticmethod
+    def mask(first: int, last: int) -> int:
+        """Bitmask of the nights [first, last) of a year"""
+        return ((1 << (last - first)) - 1) << first
+
+    def full_mask(self) -> int:
+        return self.mask(0, days_in_year(self.year))
+
+    def test(self, day) -> bool:
+        """Determine if the night starting on day is in the set"""
+        return bool(self.bits >> (to_date(day).timetuple().tm_yday - 1) & 1)
+
+    def any_in(self, first: int, last: int) -> bool:
+        """Determine if any of the nights [first, last) is in the set"""
+        return bool(self.bits & self.mask(first, last))
+
+    def set_range(self, first: int, last: int):
+        """Adds the nights [first, last) to the set"""
+        self.bits |= self.mask(first, last)
+
+    def clear_range(self, first: int, last: int):
+        """Removes the nights [first, last) from the set"""
+        self.bits &= ~self.mask(first, last)
+
+    def __and__(self, other: 'YearBits') -> 'YearBits':
+        return YearBits(self.year, self.bits & other.bits)
+
+    def __or__(self, other: 'YearBits') -> 'YearBits':
+        return YearBits(self.year, self.bits | other.bits)
+
+    def __invert__(self) -> 'YearBits':
+        return YearBits(self.year, ~self.bits & self.full_mask())
+
+    def __len__(self) -> int:
+        return bin(self.bits).count('1')
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, YearBits) and self.year == other.year
+                and self.bits == other.bits)
+
+    def __repr__(self) -> str:
+        return f'<YearBits {self.year} : {len(self)} nights>'
+
+    def indexes(self) -> 'Iterator[int]':
+        """Yields the set bits in increasing order"""
+        bits, index = self.bits, 0
+        while bits:
+            # Skip runs of unset bits a byte at a time
+            if not bits & 0xFF:
+                bits >>= 8
+                index += 8
+                continue
+            if bits & 1:
+                yield index
+            bits >>= 1
+            index += 1
+
+    def nights(self) -> 'List[str]':
+        """Returns the nights in the set, as 'YYYY-MM-DD' strings"""
+        first = date(self.year, 1, 1)
+        return [(first + timedelta(days=i)).strftime('%Y-%m-%d')
+                for i in self.indexes()]
@@ -0,0 +1,54 @@
+import hashlib
+import threading
+
+
+class BloomFilter:
+    """In-process set of strings that answers "maybe present" or
+    "definitely absent" in constant time and memory
+
+    Membership can be a false positive (with a probability growing with
+    the number of items added) but never a false negative, so a hit must
+    be confirmed against the database before acting on it.
+
+    params:
+    - bits: Size of the filter in bits (int)
+    - hashes: Bits set per item (int)
+    """
+
+    def __init__(self, bits: int = 1 << 20, hashes: int = 4):
+        self._bits = bits
+        self._hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def __len__(self):
+        """Number of items added, duplicates included"""
+        return self._count
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(),
+                                 digest_size=8 * self._hashes).digest()
+        for i in range(self._hashes):
+            yield int.from_bytes(digest[8 * i:8 * i + 8], 'little') \
+                % self._bits
+
+    def add(self, item: str):
+        """Adds item to the filter"""
+        with self._lock:
+            for position in self._positions(item):
+                self._array[position >> 3] |= 1 << (position & 7)
+            self._count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._array[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def clear(self):
+        with self._lock:
+            self._array = bytearray(len(self._array))
+            self._count = 0
+
+    def stats(self) -> dict:
+        return {'bits': self._bits, 'hashes': self._hashes,
+                'items': self._count}
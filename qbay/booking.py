@@ -1,6 +1,6 @@
-from qbay import database
+from qbay import database, ledger, payouts
 from qbay.database import db
-from qbay.user import User
+from qbay.user import User, user_cache
 from qbay.listing import Listing
 from sqlalchemy import exc
 from datetime import datetime, timedelta
@@ -20,6 +20,7 @@ class Booking:
 
     def __init__(self, buyer_id: int, owner_id: int, listing_id: int,
                  start_date: str = "", end_date: str = ""):
+        self._database_obj: database.Booking = None
         self._id = None
         self._owner_id = owner_id
         self._buyer_id = buyer_id
@@ -30,8 +31,15 @@ class Booking:
     def __str__(self):
         return str(self._id)
 
+    @property
+    def database_obj(self) -> database.Booking:
+        """Returns a reference to the database"""
+        return self._database_obj
+
     @property
     def id(self):
+        if self._id is None and self.database_obj:
+            self._id = self.database_obj.id
         return self._id
 
     @property
@@ -95,6 +103,9 @@ class Booking:
 
         if book_start >= book_end:
             raise ValueError("Start date is same or after end date!")
+
+        # Availability and balances must be read from the primary
+        database.use_primary()
   
         buyer = User.query_user(buyer_id)
         if not buyer:
@@ -115,29 +126,55 @@ class Booking:
                         for x in range(0, nights_booked)]
 
         cost = listing.price * nights_booked
-        if buyer.balance < cost:
-            raise ValueError("Buyer's balance is too low for this booking!")
-
-        # To book, update listing booking date
-        listing.valid_booking_date(booked_dates)
-        listing.add_booking_date(booked_dates)
-
-        # Add this listing to buyer's list of bookings
-        buyer.add_booking(listing)
 
-        # Update buyer and owner balance
-        buyer.update_balance(buyer.balance - cost)
-        owner.update_balance(owner.balance + cost)
+        # Reserve dates, charge the buyer, record the booking and the
+        # owner's pending payout as one unit of work: nothing is written
+        # until the single commit below, and any failure rolls every step
+        # back. Only rows are inserted for the money, no balance row is
+        # updated here: the owner is paid in batches by the settler.
         booking = Booking(buyer_id, owner_id, listing_id, book_start, book_end)
-        booking.add_to_database()
+        try:
+            # Fails early; the debit below decides, on the current balance
+            if ledger.balance(buyer_id) < cost:
+                raise ValueError(
+                    "Buyer's balance is too low for this booking!")
+            listing.valid_booking_date(booked_dates)
+            listing.add_booking_date(booked_dates, commit=False)
+
+            # Add this listing to buyer's list of bookings
+            buyer.add_booking(listing)
+
+            booking.add_to_database(commit=False)
+            db.session.flush()
+            if not ledger.debit(buyer_id, cost, 'booking_debit',
+                                booking_id=booking.id):
+                raise ValueError(
+                    "Buyer's balance is too low for this booking!")
+            payouts.record(owner_id, cost, booking_id=booking.id)
+            db.session.commit()
+            user_cache.invalidate(buyer_id)
+        except exc.IntegrityError:
+            # Another booking claimed one of the nights after our check
+            db.session.rollback()
+            raise ValueError("Given dates overlap with existing bookings!")
+        except Exception:
+            db.session.rollback()
+            raise
         return True
     
-    def add_to_database(self):
+    def add_to_database(self, commit: bool = True):
+        """Adds the booking to the database. With commit=False the row is
+        only added to the current session and the caller commits it.
+        """
         booking = database.Booking(buyer_id=self.buyer_id,
                                    owner_id=self.owner_id,
                                    listing_id=self.listing_id,
                                    start_date=self.start_date,
                                    end_date=self.end_date)
+        self._database_obj = booking
+        if not commit:
+            db.session.add(booking)
+            return True
 
         try:
             with database.app.app_context():
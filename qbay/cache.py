@@ -0,0 +1,109 @@
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe in-process cache with least-recently-used eviction and
+    an optional time-to-live, keeping hit and miss counters
+
+    params:
+    - maxsize: Maximum number of entries kept (int)
+    - ttl: Seconds an entry stays valid, or None to never expire (float)
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._by_label = {}
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @property
+    def ttl(self):
+        return self._ttl
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _count(self, hit: bool, label: str = None):
+        if hit:
+            self._hits += 1
+        else:
+            self._misses += 1
+        if label is not None:
+            counts = self._by_label.setdefault(label, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def get(self, key, label: str = None):
+        """Fetches the cached value for key, or None on a miss
+
+        params:
+        - key: Cache key
+        - label: Optional name (e.g. a page) the hit or miss is also
+          counted under
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > monotonic():
+                    self._entries.move_to_end(key)
+                    self._count(True, label)
+                    return value
+                del self._entries[key]
+            self._count(False, label)
+            return None
+
+    def set(self, key, value):
+        """Caches value under key, evicting the least recently used entry
+        if the cache is full
+        """
+        expires_at = None if self._ttl is None else monotonic() + self._ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        """Removes the entry for key, if any"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Removes every entry whose key satisfies predicate. Scans the
+        whole cache, so it is meant for infrequent events like edits.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        """Removes every entry, keeping the counters"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters, overall and per label"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self._maxsize,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'by_label': {label: {'hits': hits, 'misses': misses}
+                             for label, (hits, misses)
+                             in self._by_label.items()},
+            }
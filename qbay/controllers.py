@@ -1,9 +1,19 @@
+import os
+import hmac
+import hashlib
+from datetime import date
 from qbay import database
-from qbay.user import User
-from qbay.database import app
+from qbay.user import User, user_cache
+from qbay.database import app, db, read_only
+from qbay.metrics import pool_status
+from qbay.fragments import card_cache
 from qbay.listing import Listing
 from qbay.booking import Booking
-from flask import render_template, request, session, redirect
+from qbay.search import search_listings
+from qbay import jobs, ledger, ratelimit
+from qbay.ratelimit import rate_limited
+from flask import (jsonify, make_response, render_template, request,
+                   session, redirect, url_for)
 from functools import wraps
 
 
@@ -30,7 +40,9 @@ def authenticate(inner_function):
                 # the database via some tethering.
                 # You want to use this object to pass around the program as it
                 # has the needed functions for actually managing the database
-                user = User.query_user(id)
+                # It is built from a cached snapshot when one is available,
+                # so most requests reach the route without a query
+                user = User.query_user_cached(id, label=request.endpoint)
                 if user:
                     # if the user exists, call the inner_function
                     # with user as parameter
@@ -46,11 +58,87 @@ def authenticate(inner_function):
     return wrapped_inner
 
 
+def page_etag(*parts) -> str:
+    """Hashes everything a page's content depends on into an ETag"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def conditional(etag: str, render):
+    """Answers a request carrying a matching If-None-Match with an empty
+    304, otherwise calls render for the page and tags it with etag. The
+    pages are personal, so caches must revalidate them with us every time.
+
+    params:
+    - etag: Weak ETag of the page (str)
+    - render: Function returning the page body
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+    return tag_page(response, etag)
+
+
+def tag_page(response, etag: str):
+    """Sets the validators and caching policy of a personal page"""
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 @app.route('/')
+@read_only
 @authenticate
 def home(user):
-    listings = database.Listing.query.all()
-    return render_template('index.html', user=user, listings=listings)
+    after = request.args.get('after', type=int)
+    listings, next_cursor = Listing.query_page(after)
+    # Money moves without invalidating the cached user, so the balance
+    # shown, and tagged, is read from the database
+    user.balance = ledger.balance(user.id)
+    etag = page_etag('home', user.id, user.username, user.balance, after,
+                     next_cursor, [(listing.id, listing.version,
+                                    listing.owner.username)
+                                   for listing in listings])
+    return conditional(etag, lambda: render_template(
+        'index.html', user=user, listings=listings, after=after,
+        next_cursor=next_cursor))
+
+
+@app.route('/search')
+@read_only
+@authenticate
+def search(user):
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    listings, has_next = search_listings(query, page)
+    return render_template('search.html', user=user, query=query,
+                           listings=listings, page=page, has_next=has_next)
+
+
+@app.route('/available')
+@read_only
+@authenticate
+def available(user):
+    start = request.args.get('from', '')
+    end = request.args.get('to', '')
+    min_price = request.args.get('min_price', type=float)
+    max_price = request.args.get('max_price', type=float)
+    after = request.args.get('after', type=int)
+    listings, next_url, message = [], None, ''
+    if start and end:
+        try:
+            listings, next_cursor = Listing.query_available(
+                start, end, min_price, max_price, after)
+        except ValueError as e:
+            next_cursor, message = None, str(e)
+        if next_cursor:
+            next_url = url_for('available', **{**request.args.to_dict(),
+                                               'after': next_cursor})
+    return render_template('available.html', user=user, start=start,
+                           end=end, min_price=min_price,
+                           max_price=max_price, listings=listings,
+                           next_url=next_url, message=message)
 
 
 @app.route('/login', methods=['GET'])
@@ -59,6 +147,7 @@ def login_get():
 
 
 @app.route('/login', methods=['POST'])
+@rate_limited('login')
 def login_post():
     email = request.form.get('email')
     password = request.form.get('password')
@@ -101,6 +190,7 @@ def register_get():
 
 
 @app.route('/register', methods=['POST'])
+@rate_limited('register')
 def register_post():
     email = request.form.get('email')
     username = request.form.get('username')
@@ -130,7 +220,8 @@ def update_informations_get(user: User):
     return render_template('/user_update.html', user=user, errors='', 
                            prevEmail=user.email, prevUsername=user.username, 
                            prevBillingAddress=user.billing_address, 
-                           prevPostalCode=user.postal_code)
+                           prevPostalCode=user.postal_code,
+                           version=user.version)
 
 
 @app.route('/user_update', methods=['POST'])
@@ -143,35 +234,38 @@ def update_informations_post(user: User):
     email = request.form.get('email')
     billing_address = request.form.get('billing_address')
     postal_code = request.form.get('postal_code')
+    # The version the form was filled from, so that changes made to the
+    # profile since are not overwritten
+    version = request.form.get('version', type=int)
+    if version is not None:
+        user.version = version
 
     messages = []
-
-    if user.email != email:
-        try:
-            user.update_email(email)
-            messages += [f"Email updated successfully: {email}"]
-        except ValueError as e:
-            messages += [str(e)]
-
-    if user.username != username:
-        try:
-            user.update_username(username)
-            messages += [f"Username updated successfully: {username}"]
-        except ValueError as e:
-            messages += [str(e)]
-
-    if user.billing_address != billing_address:
-        try:
-            user.update_billing_address(billing_address)
-            messages += [
-                f"Billing address updated successfully: {billing_address}"]
-        except ValueError as e:
-            messages += [str(e)]
-
-    if user.postal_code != postal_code:
+    updates = [
+        (user.email != email, user.update_email, email,
+         f"Email updated successfully: {email}"),
+        (user.username != username, user.update_username, username,
+         f"Username updated successfully: {username}"),
+        (user.billing_address != billing_address,
+         user.update_billing_address, billing_address,
+         f"Billing address updated successfully: {billing_address}"),
+        (user.postal_code != postal_code, user.update_postal_code,
+         postal_code, f"Postal code updated successfully: {postal_code}"),
+    ]
+    for changed, update, value, message in updates:
+        if not changed:
+            continue
         try:
-            user.update_postal_code(postal_code)
-            messages += [f"Postal code updated successfully: {postal_code}"]
+            update(value)
+            messages += [message]
+        except database.EditConflict as e:
+            # Show the current details instead of the submitted ones
+            user = User.query_user(user.id)
+            return render_template(
+                '/user_update.html', user=user, errors=messages + [str(e)],
+                prevEmail=user.email, prevUsername=user.username,
+                prevBillingAddress=user.billing_address,
+                prevPostalCode=user.postal_code, version=user.version), 409
         except ValueError as e:
             messages += [str(e)]
     
@@ -180,7 +274,20 @@ def update_informations_post(user: User):
     return render_template('/user_update.html', user=user, errors=messages, 
                            prevEmail=user.email, prevUsername=username, 
                            prevBillingAddress=billing_address, 
-                           prevPostalCode=postal_code)
+                           prevPostalCode=postal_code, version=user.version)
+
+
+def booked_bitmaps(listing_obj: Listing, min_date: str) -> dict:
+    """Booked nights from the year of min_date on, as the hex encoded
+    yearly bitmaps the booking page's date picker checks stays against
+    """
+    years = listing_obj.availability.year_bits(since=int(min_date[:4]))
+    return hex_bitmaps(years)
+
+
+def hex_bitmaps(years: dict) -> dict:
+    """Hex encodes {year: YearBits} for the booking page"""
+    return {year: bits.to_bytes().hex() for year, bits in years.items()}
 
 
 @app.route('/booking/<int:listing_id>', methods=['GET'])
@@ -188,12 +295,25 @@ def booking_get(listing_id):
     listing = database.Listing.query.filter_by(id=listing_id).first()
     listing_obj = Listing.query_listing(listing_id)
     user = database.User.query.filter_by(id=session["logged_in"]).first()
-    min_date = listing_obj.find_min_booking_date()
-    return render_template('booking.html', listing=listing, user=user, 
-                           min_date=min_date, message='')
+    # The first free date moves with the calendar as well as the bookings
+    etag = page_etag('booking', user.id, user.balance, listing.id,
+                     listing.version, listing.availability_version,
+                     listing.owner.username, date.today().isoformat())
+
+    def render():
+        min_date = listing_obj.find_min_booking_date()
+        booked_ranges = listing_obj.availability.ranges(since=min_date)
+        return render_template('booking.html', listing=listing, user=user,
+                               min_date=min_date,
+                               booked_ranges=booked_ranges,
+                               booked_bits=booked_bitmaps(listing_obj,
+                                                          min_date),
+                               message='')
+    return conditional(etag, render)
 
 
 @app.route('/booking/<int:listing_id>', methods=['POST'])
+@rate_limited('booking')
 def booking_post(listing_id):
     user = database.User.query.filter_by(id=session["logged_in"]).first()
     buyer = user.id
@@ -209,12 +329,16 @@ def booking_post(listing_id):
     except ValueError as e:
         message = str(e)
     min_date = listing_obj.find_min_booking_date()
+    booked_ranges = listing_obj.availability.ranges(since=min_date)
 
     return render_template('booking.html', listing=listing, user=user, 
-                           min_date=min_date, message=message)
+                           min_date=min_date, booked_ranges=booked_ranges,
+                           booked_bits=booked_bitmaps(listing_obj, min_date),
+                           message=message)
 
 
 @app.route('/user_bookings')
+@read_only
 @authenticate
 def view_user_bookings(user):
     listings = []
@@ -256,6 +380,7 @@ def create_listing_post(user):
 
 
 @app.route('/user_listings')
+@read_only
 @authenticate
 def view_user_listings(user):
     listings = database.Listing.query.filter_by(owner_id=user.id).all()
@@ -271,7 +396,8 @@ def update_listing_get(listing_id):
                            prevTitle=listing.title, 
                            prevDescription=listing.description,
                            prevPrice=listing.price, 
-                           prevAddress=listing.address)
+                           prevAddress=listing.address,
+                           version=listing.version)
 
 
 @app.route('/update_listing/<int:listing_id>', methods=['POST'])
@@ -281,34 +407,38 @@ def update_listing_post(listing_id):
     description = request.form.get('description')
     price = float(request.form.get('price')) * 100
     address = request.form.get('address')
+    # The version the form was filled from, so that changes made to the
+    # listing since are not overwritten
+    version = request.form.get('version', type=int)
+    if version is not None:
+        listing.version = version
 
     messages = []
-    if title != listing.title:
+    updates = [
+        (title != listing.title, listing.update_title, title,
+         f"Title updated successfully: {title}"),
+        (description != listing.description, listing.update_description,
+         description, f"Description updated successfully: {description}"),
+        (price != listing.database_obj.price, listing.update_price,
+         price / 100, f"Price updated successfully: {price / 100:.2f}"),
+        (address != listing.database_obj.address, listing.update_address,
+         address, f"Address updated successfully: {address}"),
+    ]
+    for changed, update, value, message in updates:
+        if not changed:
+            continue
         try:
-            listing.update_title(title)
-            messages += [f"Title updated successfully: {title}"]
-        except ValueError as e:
-            messages += [str(e)]
-
-    if description != listing.description:
-        try:
-            listing.update_description(description)
-            messages += [f"Description updated successfully: {description}"]
-        except ValueError as e:
-            messages += [str(e)]
-
-    if price != listing.database_obj.price:
-        try:
-            listing.update_price(price / 100)
-            messages += [
-                f"Price updated successfully: {price / 100:.2f}"]
-        except ValueError as e:
-            messages += [str(e)]
-
-    if address != listing.database_obj.address:
-        try:
-            listing.update_address(address)
-            messages += [f"Address updated successfully: {address}"]
+            update(value)
+            messages += [message]
+        except database.EditConflict as e:
+            # Show the current details instead of the submitted ones
+            current = database.Listing.query.get(listing_id)
+            return render_template(
+                '/update_listing.html', listing=current,
+                messages=messages + [str(e)], prevTitle=current.title,
+                prevDescription=current.description,
+                prevPrice=current.price, prevAddress=current.address,
+                version=current.version), 409
         except ValueError as e:
             messages += [str(e)]
 
@@ -317,5 +447,23 @@ def update_listing_post(listing_id):
     return render_template('/update_listing.html',
                            listing=listing.database_obj, messages=messages,
                            prevTitle=title, prevDescription=description, 
-                           prevPrice=price, prevAddress=address)
-    
\ No newline at end of file
+                           prevPrice=price, prevAddress=address,
+                           version=listing.version)
+
+
+@app.route('/metrics')
+def metrics():
+    """Live connection pool, cache, rate limiting and job metrics of the
+    worker process serving the request, as JSON. Only served with the
+    METRICS_TOKEN as a bearer token, and not at all while it is unset.
+    """
+    token = app.config['METRICS_TOKEN']
+    if not token:
+        return 'Not Found', 404
+    given = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(given.encode(), f'Bearer {token}'.encode()):
+        return 'Forbidden', 403
+    return jsonify(pid=os.getpid(), pool=pool_status(db.engine),
+                   user_cache=user_cache.stats(),
+                   card_cache=card_cache.stats(),
+                   ratelimit=ratelimit.stats(), jobs=jobs.stats())
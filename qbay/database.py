@@ -1,8 +1,14 @@
 import os
-from flask import Flask
+import random
+from time import time
+from functools import wraps
+from flask import Flask, has_request_context, session
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from qbay.metrics import InstrumentedQueuePool
+from sqlalchemy import event, select
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import column_property, relationship, validates
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 app = Flask(__name__)
@@ -14,9 +20,203 @@ else:
         'sqlite:///' + os.path.join(basedir, 'qbay_database.db')
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+
+def engine_options(uri: str) -> dict:
+    """Connection pool settings for the engine behind uri, read from the
+    db_pool_* environment variables
+    """
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        return {}  # a single in-memory connection, nothing to pool
+    return {
+        'poolclass': InstrumentedQueuePool,
+        # connections kept open, and extra ones allowed under load
+        'pool_size': int(os.getenv('db_pool_size', 5)),
+        'max_overflow': int(os.getenv('db_max_overflow', 10)),
+        # seconds to wait for a free connection before failing
+        'pool_timeout': float(os.getenv('db_pool_timeout', 30)),
+        # seconds after which a connection is replaced, kept below the
+        # server's idle timeout (MySQL wait_timeout) to avoid stale ones
+        'pool_recycle': int(os.getenv('db_pool_recycle', 1800)),
+        # test each connection on checkout and reconnect if it went stale
+        'pool_pre_ping': os.getenv('db_pool_pre_ping', 'true').lower()
+        in ('1', 'true', 'yes'),
+    }
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'])
+
 app.config['SECRET_KEY'] = '69cae04b04756f65eabcd2c5a11c8c24'
 
-db = SQLAlchemy(app)
+# In-process cache of users for the authenticate decorator
+app.config['USER_CACHE_SIZE'] = int(os.getenv('user_cache_size', 10000))
+app.config['USER_CACHE_TTL'] = float(os.getenv('user_cache_ttl', 30))
+
+# In-process cache of rendered listing cards, see qbay.fragments
+app.config['CARD_CACHE_SIZE'] = int(os.getenv('card_cache_size', 5000))
+app.config['CARD_CACHE_TTL'] = float(os.getenv('card_cache_ttl', 60))
+
+# Hashing of new passwords, see qbay.passwords. Stored hashes using other
+# parameters are upgraded on the next successful login.
+app.config['PASSWORD_SCHEME'] = os.getenv('password_scheme', 'scrypt')
+app.config['PASSWORD_SCRYPT_N'] = int(os.getenv('password_scrypt_n',
+                                                2 ** 14))
+app.config['PASSWORD_SCRYPT_R'] = int(os.getenv('password_scrypt_r', 8))
+app.config['PASSWORD_SCRYPT_P'] = int(os.getenv('password_scrypt_p', 1))
+app.config['PASSWORD_PBKDF2_ITERATIONS'] = int(
+    os.getenv('password_pbkdf2_iterations', 600000))
+# Threads computing hashes at once in each worker process
+app.config['PASSWORD_WORKERS'] = int(os.getenv('password_workers',
+                                               os.cpu_count() or 1))
+
+# Bits of the in-process Bloom filter of signed up emails, 0 to disable
+app.config['SIGNUP_FILTER_BITS'] = int(os.getenv('signup_filter_bits',
+                                                 1 << 20))
+
+# Token buckets of qbay.ratelimit: kept in each worker process, or shared
+# through a Redis server when ratelimit_storage is a redis:// URL
+app.config['RATELIMIT_ENABLED'] = os.getenv(
+    'ratelimit_enabled', 'true').lower() in ('1', 'true', 'yes')
+app.config['RATELIMIT_STORAGE'] = os.getenv('ratelimit_storage', 'memory')
+app.config['RATELIMIT_MEMORY_SIZE'] = int(os.getenv('ratelimit_memory_size',
+                                                    100000))
+
+# Background jobs of qbay.jobs: worker threads per process (0 to only run
+# them with `python -m qbay worker`), how long a claimed job is reserved
+# for its worker, and the retry schedule
+app.config['JOB_WORKERS'] = int(os.getenv('job_workers', 2))
+app.config['JOB_POLL_INTERVAL'] = float(os.getenv('job_poll_interval', 1))
+app.config['JOB_LEASE_SECONDS'] = float(os.getenv('job_lease', 60))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.getenv('job_max_attempts', 8))
+app.config['JOB_BACKOFF_SECONDS'] = float(os.getenv('job_backoff', 2))
+app.config['JOB_BACKOFF_MAX'] = float(os.getenv('job_backoff_max', 600))
+# Jobs started per second by each process, 0 for no limit
+app.config['JOB_RATE'] = float(os.getenv('job_rate', 0))
+
+# Owners are paid for their bookings in batches, see qbay.payouts
+app.config['PAYOUT_SETTLE_INTERVAL'] = float(os.getenv(
+    'payout_settle_interval', 30))
+app.config['PAYOUT_BATCH'] = int(os.getenv('payout_batch', 1000))
+
+# Seconds between the balance snapshots of an active user, see qbay.ledger
+app.config['LEDGER_SNAPSHOT_DELAY'] = float(os.getenv('ledger_snapshot_delay',
+                                                      60))
+
+# Bearer token required by /metrics, which is disabled while unset
+app.config['METRICS_TOKEN'] = os.getenv('metrics_token', '')
+
+# Optional read replicas: a comma separated list of database URIs
+REPLICA_BINDS = []
+for i, uri in enumerate(filter(None, os.getenv('db_string_ro', '')
+                               .replace(' ', '').split(','))):
+    REPLICA_BINDS.append(f'replica_{i}')
+    app.config.setdefault('SQLALCHEMY_BINDS', {})[f'replica_{i}'] = {
+        'url': uri, **engine_options(uri)}
+# Seconds a user keeps reading from the primary after writing, so they
+# see their own changes even if the replicas lag behind
+app.config['REPLICA_LAG_SECONDS'] = float(os.getenv('replica_lag', 5))
+
+
+def replica_engines():
+    """Returns the engines of the configured read replicas"""
+    return [db.engines[key] for key in REPLICA_BINDS]
+
+
+class RoutingSession(Session):
+    """Session sending reads to a read replica when the request has been
+    marked read-only (see read_only) and every write, and every read
+    after a write, to the primary
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and self.info.get('read_only')
+                and not self.info.get('wrote') and not self._flushing
+                and getattr(clause, 'is_select', False)):
+            replicas = replica_engines()
+            if replicas:
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def read_only(view):
+    """Lets the reads of a route go to a replica, unless the user wrote
+    something in the last REPLICA_LAG_SECONDS
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if session.get('primary_until', 0) <= time():
+            db.session.info['read_only'] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            db.session.info.pop('read_only', None)
+    return wrapped
+
+
+def use_primary():
+    """Pins the rest of the current session to the primary"""
+    db.session.info['read_only'] = False
+
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+
+def _mark_write(db_session):
+    """Reads after a write go to the primary, for the rest of this session
+    and for the user's requests in the next REPLICA_LAG_SECONDS
+    """
+    db_session.info['wrote'] = True
+    if REPLICA_BINDS and has_request_context():
+        session['primary_until'] = time() + app.config['REPLICA_LAG_SECONDS']
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(db_session, flush_context):
+    _mark_write(db_session)
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _after_execute(orm_execute_state):
+    if not orm_execute_state.is_select:
+        _mark_write(orm_execute_state.session)
+
+
+def normalized_key(value: str) -> str:
+    """Case and whitespace insensitive form of a value that must be
+    unique, stored in the *_key column next to it
+    """
+    if value is None:
+        return None
+    return ' '.join(value.split()).casefold()
+
+
+def key_of(column: str):
+    """Default of a *_key column for Core inserts, which bypass the
+    model validators setting it
+    """
+    def default(context):
+        return normalized_key(context.get_current_parameters().get(column))
+    return default
+
+
+class EditConflict(ValueError):
+    """Raised by an edit of a row that someone else changed since the
+    version the edit was based on
+    """
+
+
+class SchemaVersion(db.Model):
+    """One row per schema migration applied, see qbay.migrations"""
+    __tablename__ = 'schema_version'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False,
+                           server_default=func.now())
+
+    def __repr__(self) -> str:
+        return f'<SchemaVersion {self.version}>'
 
 
 class User(db.Model):
@@ -27,12 +227,28 @@ class User(db.Model):
     password = db.Column(db.String(255), nullable=False)
     postal_code = db.Column(db.String(7), nullable=True)
     billing_address = db.Column(db.String(46), nullable=True)
-    balance = db.Column(db.Integer, nullable=False)  # in cents
+    # Sum of the user's folded ledger entries, see LedgerEntry; the
+    # current balance is the balance property, defined after LedgerEntry
+    balance_snapshot = db.Column('balance', db.Integer, nullable=False,
+                                 default=0)  # in cents
+    # Bumped by every edit of the profile, which only applies if the
+    # version is still the one the edit was based on
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    # normalized_key(email), unique so a duplicate sign up fails on insert
+    # without a lookup. NULL only for legacy duplicates, see migration 8
+    email_key = db.Column(db.String(320), unique=True, index=True,
+                          nullable=True, default=key_of('email'))
 
     listings = relationship('Listing', back_populates='owner')
     reviews = relationship('Review', back_populates='user')
     bookings = relationship('Booking', back_populates='buyer')
 
+    @validates('email')
+    def _set_email_key(self, key, email):
+        self.email_key = normalized_key(email)
+        return email
+
     def __repr__(self) -> str:
         return f'<User {self.username} : {self.id}>'
 
@@ -40,29 +256,78 @@ class User(db.Model):
 class Listing(db.Model):
     __tablename__ = 'listings'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    title = db.Column(db.String(255), nullable=False)
+    title = db.Column(db.String(255), nullable=False, index=True)
+    # normalized_key(title), unique like User.email_key
+    title_key = db.Column(db.String(255), unique=True, index=True,
+                          nullable=True, default=key_of('title'))
     description = db.Column(db.String(5000), nullable=False)
     price = db.Column(db.Integer, nullable=False)  # in cents to avoid errors
     address = db.Column(db.String(5000), nullable=False)
     date_created = db.Column(db.String(10), nullable=False)
     last_modified_date = db.Column(db.String(10), nullable=False)
-    booked_dates = relationship('Dates', back_populates='listing')
-    
-    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # Bumped by every edit of the listing and every change of its booked
+    # ranges respectively, for cache keys and ETags. Edits only apply if
+    # version is still the one they were based on.
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    availability_version = db.Column(db.Integer, nullable=False, default=1,
+                                     server_default='1')
+    # First night that was free on or after the day it was last updated,
+    # kept current by Availability.reserve; stale once it is in the past
+    next_available_date = db.Column(db.String(10), nullable=True)
+    booked_ranges = relationship('BookedRange', back_populates='listing',
+                                 order_by='BookedRange.start_date')
+
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     owner = relationship('User', back_populates='listings')
     bookings = relationship('Booking', back_populates='listing')
     reviews = relationship('Review', back_populates='listing')
 
+    @validates('title')
+    def _set_title_key(self, key, title):
+        self.title_key = normalized_key(title)
+        return title
+
     def __repr__(self) -> str:
         return f'<Listing {self.title}>'
 
 
-class Dates(db.Model):
-    __tablename__ = "dates"
+class BookedRange(db.Model):
+    """A maximal run of booked nights [start_date, end_date) of a listing.
+
+    Ranges of a listing never overlap and adjacent ranges are merged, so
+    the (listing_id, start_date) index doubles as an interval index.
+    """
+    __tablename__ = 'booked_ranges'
+    __table_args__ = (
+        db.Index('ix_booked_ranges_listing_start', 'listing_id', 'start_date'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'))
-    listing = relationship("Listing", back_populates='booked_dates')
-    date = db.Column(db.String(10), nullable=False)
+    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'),
+                           nullable=False)
+    listing = relationship('Listing', back_populates='booked_ranges')
+    start_date = db.Column(db.String(10), nullable=False)
+    end_date = db.Column(db.String(10), nullable=False)  # exclusive
+
+    def __repr__(self) -> str:
+        return f'<BookedRange {self.start_date} - {self.end_date}>'
+
+
+class BookedYear(db.Model):
+    """Booked nights of a listing in one calendar year, as a bitset blob
+    (see qbay.bitmaps.YearBits). A booking only updates the row if its
+    version is unchanged since the booking read it, so concurrent bookings
+    cannot both claim the same night.
+    """
+    __tablename__ = 'booked_years'
+    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'),
+                           primary_key=True)
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bits = db.Column(db.LargeBinary(46), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    def __repr__(self) -> str:
+        return f'<BookedYear {self.listing_id} : {self.year}>'
 
 
 class Booking(db.Model):
@@ -70,10 +335,11 @@ class Booking(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     
     owner_id = db.Column(db.Integer, nullable=False)
-    buyer_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    buyer_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     buyer = relationship("User", back_populates='bookings')
 
-    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'))
+    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'),
+                           index=True)
     listing = relationship("Listing", back_populates='bookings')
 
     start_date = db.Column(db.String(10), nullable=False)
@@ -83,6 +349,93 @@ class Booking(db.Model):
         return f'<Booking {self.id}>'
 
 
+class Job(db.Model):
+    """Work queued by qbay.jobs in the same transaction as the change it
+    follows from (an outbox row), so the job exists exactly when that
+    change was committed. Workers claim a job by setting locked_until; a
+    job whose worker died is claimed again once that time has passed.
+    Successful jobs are deleted, those out of attempts are kept as failed.
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON object
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Unix times: not run before run_at, reserved until locked_until.
+    # Double precision, a claim is identified by its exact locked_until
+    run_at = db.Column(db.Float(53), nullable=False)
+    locked_until = db.Column(db.Float(53), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.Float(53), nullable=False, default=time)
+    # Set for jobs that need not be queued twice, see qbay.jobs.enqueue
+    dedupe_key = db.Column(db.String(64), nullable=True, index=True)
+
+    def __repr__(self) -> str:
+        return f'<Job {self.id} : {self.kind}>'
+
+
+class LedgerEntry(db.Model):
+    """A movement of money on a user's balance (see qbay.ledger). Entries
+    are only ever inserted, and later flagged as folded into the user's
+    snapshot, so concurrent movements never update the same row, and a
+    user's entries are the audit trail of their balance.
+    """
+    __tablename__ = 'ledger'
+    __table_args__ = (
+        db.Index('ix_ledger_user_id_id', 'user_id', 'id'),
+        db.Index('ix_ledger_user_id_folded', 'user_id', 'folded'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                        nullable=False)
+    amount = db.Column(db.Integer, nullable=False)  # like users.balance
+    kind = db.Column(db.String(20), nullable=False)
+    booking_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.Float(53), nullable=False, default=time)
+    # Set once the amount is included in users.balance
+    folded = db.Column(db.Boolean, nullable=False, default=False,
+                       server_default='0')
+
+    def __repr__(self) -> str:
+        return f'<LedgerEntry {self.id} : {self.kind} {self.amount}>'
+
+
+class Payout(db.Model):
+    """Payment of a booking to the listing's owner, pending until the
+    settler adds it to the owner's balance, in one ledger entry with
+    their other pending payouts (see qbay.payouts)
+    """
+    __tablename__ = 'payouts'
+    __table_args__ = (
+        db.Index('ix_payouts_entry_id_id', 'entry_id', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('users.id'),
+                         nullable=False, index=True)
+    booking_id = db.Column(db.Integer, nullable=True)
+    amount = db.Column(db.Integer, nullable=False)  # like users.balance
+    created_at = db.Column(db.Float(53), nullable=False, default=time)
+    # The ledger entry that paid it, NULL while pending
+    entry_id = db.Column(db.Integer, nullable=True)
+
+    def __repr__(self) -> str:
+        return f'<Payout {self.id} : {self.amount}>'
+
+
+# Current balance: the snapshot plus the entries not folded into it yet,
+# read through the (user_id, folded) index along with the rest of the row
+User.balance = column_property(
+    User.balance_snapshot + func.coalesce(
+        select(func.sum(LedgerEntry.amount))
+        .where(LedgerEntry.user_id == User.id,
+               LedgerEntry.folded == db.false())
+        .correlate_except(LedgerEntry).scalar_subquery(), 0))
+
+
 class Review(db.Model):
     __tablename__ = 'reviews'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
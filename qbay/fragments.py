@@ -0,0 +1,52 @@
+from qbay.cache import LRUCache
+from qbay.database import app
+from markupsafe import Markup
+
+# Rendered listing cards, keyed by card_key. Edits invalidate the cards of
+# the listing in this process; the TTL bounds how long other worker
+# processes may keep showing a card from before an edit.
+card_cache = LRUCache(app.config['CARD_CACHE_SIZE'],
+                      app.config['CARD_CACHE_TTL'])
+
+# Card partial of each page showing listings, in templates/cards
+CARD_TEMPLATES = {
+    'home': 'cards/home.html',
+    'user_listings': 'cards/user_listings.html',
+    'user_bookings': 'cards/user_bookings.html',
+}
+
+
+def card_key(kind: str, listing) -> tuple:
+    """Cache key of the card of a database listing. The owner id is part
+    of the key so an owner's cards can be dropped when they are renamed.
+    """
+    return (kind, listing.id, listing.owner_id, listing.last_modified_date,
+            listing.version)
+
+
+@app.template_global()
+def listing_card(listing, kind: str) -> Markup:
+    """Renders the card of a database listing on the given page, reusing
+    the markup rendered for an earlier request when it is still valid
+
+    params:
+    - listing: The listing shown (database.Listing)
+    - kind: The page the card is shown on, a key of CARD_TEMPLATES (str)
+    """
+    key = card_key(kind, listing)
+    html = card_cache.get(key, label=kind)
+    if html is None:
+        template = app.jinja_env.get_template(CARD_TEMPLATES[kind])
+        html = Markup(template.render(listing=listing))
+        card_cache.set(key, html)
+    return html
+
+
+def invalidate_listing(listing_id: int):
+    """Drops every cached card of the listing"""
+    card_cache.invalidate_where(lambda key: key[1] == listing_id)
+
+
+def invalidate_owner(owner_id: int):
+    """Drops every cached card of the owner's listings"""
+    card_cache.invalidate_where(lambda key: key[2] == owner_id)
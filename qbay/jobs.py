@@ -0,0 +1,338 @@
+"""
+Durable background jobs, run outside the request path
+
+A route enqueues a job in the same transaction as the change it follows
+from, so the job is stored exactly when that change is committed (the
+jobs table is an outbox). Worker threads then claim jobs from the table
+and run their handler; a job that raises is retried later with
+exponential backoff, up to JOB_MAX_ATTEMPTS attempts, then kept as
+failed with its last error.
+
+Delivery is at least once: a worker claims a job for JOB_LEASE_SECONDS,
+and if it dies before finishing, the job is claimed again once that has
+passed. The writes a handler makes in db.session are committed together
+with the removal of its job, so they happen once; a handler must not
+commit itself, and anything else it does (e.g. sending a notification)
+must be safe to repeat.
+
+Each serving process runs JOB_WORKERS threads (see start), and
+`python -m qbay worker` runs them on their own. JOB_RATE caps the jobs a
+process starts per second, so that a spike of bookings is drained at a
+steady rate instead of competing with the requests.
+
+Periodic jobs (see periodic) queue their next run when they finish, and
+starting the workers queues any that is missing.
+"""
+import os
+import json
+import random
+import threading
+import traceback
+from time import time
+from typing import Callable, Dict, List, Optional
+from sqlalchemy import and_, event, func, or_, select, update
+from qbay import database
+from qbay.database import RoutingSession, app, db
+from qbay.ratelimit import MemoryStore
+
+# Handler of each kind of job, called with the job's payload as keyword
+# arguments
+HANDLERS: 'Dict[str, Callable[..., None]]' = {}
+# Seconds between the runs of each periodic kind of job
+PERIODIC: 'Dict[str, float]' = {}
+
+# Outcomes of the jobs run by this process
+counters = {'done': 0, 'retried': 0, 'failed': 0, 'lost': 0}
+_counters_lock = threading.Lock()
+
+
+def handler(kind: str):
+    """Registers the decorated function as the handler of kind"""
+    def register(function):
+        if kind in HANDLERS:
+            raise ValueError(f"Job kind {kind} is already registered")
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+def periodic(kind: str, seconds: float):
+    """Registers the decorated function, taking no arguments, as the
+    handler of kind, run every seconds
+    """
+    def register(function):
+        handler(kind)(function)
+        PERIODIC[kind] = seconds
+        return function
+    return register
+
+
+def enqueue(kind: str, delay: float = 0, dedupe_key: str = None,
+            **payload):
+    """Adds a job to the current session, to be run once the caller
+    commits it. The payload must be JSON serializable.
+
+    params:
+    - kind: Name of a registered handler (str)
+    - delay: Seconds to wait before the job may run (float)
+    - dedupe_key: If given, nothing is queued while a job with the same
+      key is waiting to run (str)
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    Job = database.Job
+    if dedupe_key is not None and db.session.scalar(
+            select(Job.id).where(Job.dedupe_key == dedupe_key,
+                                 Job.status == 'pending').limit(1)):
+        return
+    db.session.add(Job(kind=kind, payload=json.dumps(payload),
+                       run_at=time() + delay, dedupe_key=dedupe_key))
+    db.session.info['jobs_enqueued'] = True
+
+
+def schedule(kind: str, delay: float = None):
+    """Queues the next run of a periodic job, in the current session,
+    unless one is already waiting
+    """
+    enqueue(kind, delay=PERIODIC[kind] if delay is None else delay,
+            dedupe_key=f'periodic:{kind}')
+
+
+def schedule_all():
+    """Queues every periodic job that is not waiting to run, now"""
+    for kind in PERIODIC:
+        schedule(kind, delay=0)
+    db.session.commit()
+
+
+def _count(outcome: str):
+    with _counters_lock:
+        counters[outcome] += 1
+
+
+def backoff(attempts: int) -> float:
+    """Seconds before another attempt of a job that failed attempts
+    times, doubling each time with jitter so retries spread out
+    """
+    delay = min(app.config['JOB_BACKOFF_MAX'],
+                app.config['JOB_BACKOFF_SECONDS'] * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def claim(limit: int, now: float = None) -> 'List[database.Job]':
+    """Reserves up to limit due jobs for this worker and commits the
+    reservation, so no other worker runs them for JOB_LEASE_SECONDS
+
+    Returns:
+        the jobs claimed, oldest due first
+    """
+    now = time() if now is None else now
+    Job = database.Job
+    claimable = or_(and_(Job.status == 'pending', Job.run_at <= now),
+                    and_(Job.status == 'running', Job.locked_until < now))
+    ids = db.session.scalars(select(Job.id).where(claimable)
+                             .order_by(Job.run_at).limit(limit)).all()
+    locked_until = now + app.config['JOB_LEASE_SECONDS']
+    claimed = []
+    for id in ids:
+        # Only one of the workers racing for a job sees it claimable
+        result = db.session.execute(
+            update(Job).where(Job.id == id, claimable)
+            .values(status='running', locked_until=locked_until,
+                    attempts=Job.attempts + 1)
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 1:
+            claimed.append(id)
+    db.session.commit()
+    if not claimed:
+        return []
+    return db.session.scalars(select(Job).where(Job.id.in_(claimed))
+                              .order_by(Job.run_at)).all()
+
+
+def _release(id: int, lease: float, **values) -> bool:
+    """Updates a claimed job if this worker still holds its lease"""
+    Job = database.Job
+    result = db.session.execute(
+        update(Job).where(Job.id == id, Job.status == 'running',
+                          Job.locked_until == lease)
+        .values(**values).execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+
+def run(job: 'database.Job', now: float = None):
+    """Runs a claimed job and commits its outcome"""
+    now = time() if now is None else now
+    Job = database.Job
+    # Read before the handler runs, a rollback would expire the job, and
+    # the row is only changed through statements checking the lease
+    id, kind, attempts, lease = job.id, job.kind, job.attempts, \
+        job.locked_until
+    payload = json.loads(job.payload)
+    if job in db.session:
+        db.session.expunge(job)
+    try:
+        HANDLERS[kind](**payload)
+        if kind in PERIODIC:
+            schedule(kind)
+        # Deleted along with the handler's writes, unless the lease ran
+        # out and another worker has claimed the job meanwhile
+        result = db.session.execute(Job.__table__.delete().where(
+            Job.id == id, Job.locked_until == lease))
+        if result.rowcount != 1:
+            db.session.rollback()
+            _count('lost')
+            return
+        db.session.commit()
+        _count('done')
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc(limit=5)
+        if attempts >= app.config['JOB_MAX_ATTEMPTS']:
+            outcome = 'failed'
+            released = _release(id, lease, status='failed',
+                                locked_until=None, last_error=error)
+        else:
+            outcome = 'retried'
+            released = _release(id, lease, status='pending',
+                                locked_until=None,
+                                run_at=now + backoff(attempts),
+                                last_error=error)
+        if released and outcome == 'failed' and kind in PERIODIC:
+            schedule(kind)
+        db.session.commit()
+        _count(outcome if released else 'lost')
+        app.logger.warning("Job %s (%s) %s after attempt %s:\n%s", id, kind,
+                           outcome, attempts, error)
+
+
+def run_pending(limit: int = 100, now: float = None) -> int:
+    """Claims and runs up to limit due jobs in the calling thread
+
+    Returns:
+        the number of jobs run
+    """
+    jobs = claim(limit, now)
+    for job in jobs:
+        run(job, now)
+    return len(jobs)
+
+
+def queue_sizes() -> 'Dict[str, int]':
+    """Number of jobs in the table by status"""
+    Job = database.Job
+    return dict(db.session.execute(
+        select(Job.status, func.count()).group_by(Job.status)).all())
+
+
+class Workers:
+    """Threads of this process running due jobs until stopped
+
+    params:
+    - size: Number of threads (int)
+    - rate: Jobs started per second by all the threads, 0 for no limit
+    """
+
+    # Jobs claimed by a thread at a time
+    BATCH = 10
+
+    def __init__(self, size: int, rate: float = 0):
+        self.size = size
+        self.rate = rate
+        self._bucket = MemoryStore(1)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads: 'List[threading.Thread]' = []
+
+    def start(self):
+        with app.app_context():
+            schedule_all()
+        for number in range(self.size):
+            thread = threading.Thread(target=self._run, daemon=True,
+                                      name=f'jobs-{number}')
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None):
+        """Lets each thread finish its current job, then stops them"""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wake(self):
+        """Tells idle threads that jobs were just committed"""
+        self._wake.set()
+
+    def _pace(self):
+        """Waits for a turn when the process is limited to rate jobs per
+        second
+        """
+        while self.rate and not self._stop.is_set():
+            allowed, retry_after = self._bucket.take(
+                'jobs', self.rate, max(1, self.size), time())
+            if allowed:
+                return
+            self._stop.wait(retry_after)
+
+    def _run(self):
+        with app.app_context():
+            while not self._stop.is_set():
+                self._pace()
+                try:
+                    jobs = claim(1 if self.rate else self.BATCH)
+                    for job in jobs:
+                        run(job)
+                        if job is not jobs[-1]:
+                            self._pace()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Job worker error")
+                    jobs = []
+                if not jobs:
+                    self._wake.wait(app.config['JOB_POLL_INTERVAL'])
+                    self._wake.clear()
+            db.session.remove()
+
+
+_workers: 'Optional[Workers]' = None
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+
+def start(size: int = None) -> 'Optional[Workers]':
+    """Starts this process' worker threads (JOB_WORKERS by default), once
+    per process so that workers forked by gunicorn each start their own
+    """
+    global _workers, _workers_pid
+    size = app.config['JOB_WORKERS'] if size is None else size
+    with _workers_lock:
+        if size > 0 and (_workers is None or _workers_pid != os.getpid()):
+            _workers = Workers(size, app.config['JOB_RATE'])
+            _workers_pid = os.getpid()
+            _workers.start()
+        return _workers
+
+
+def stop(timeout: float = None):
+    global _workers
+    with _workers_lock:
+        if _workers is not None and _workers_pid == os.getpid():
+            _workers.stop(timeout)
+        _workers = None
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _wake_workers(db_session):
+    """Saves the local workers waiting for their next poll"""
+    if db_session.info.pop('jobs_enqueued', False):
+        workers = _workers
+        if workers is not None and _workers_pid == os.getpid():
+            workers.wake()
+
+
+def stats() -> dict:
+    workers = _workers if _workers_pid == os.getpid() else None
+    return {'workers': workers.size if workers else 0,
+            'queued': queue_sizes(), **counters}
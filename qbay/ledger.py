@@ -0,0 +1,142 @@
+"""
+Balances kept as an append-only ledger
+
+Every movement of money is inserted as a LedgerEntry (the sign up bonus,
+the debit of a booking's buyer, the payouts of its owner, adjustments),
+and no entry's amount is ever changed. A user's row only holds a
+snapshot: the sum of the entries flagged as folded into it.
+database.User.balance adds the entries not folded yet, so it is current
+without anyone writing to the user's row when money moves.
+
+Recording an entry queues a snapshot_balance job for the user, at most
+one at a time, which folds the entries older than LEDGER_SNAPSHOT_DELAY
+into the snapshot, batching the entries of a busy account into one
+update. Only the entries the job can see are folded, and they are
+flagged in the same transaction, so an entry committed later, whatever
+its id or time, stays counted until the next snapshot.
+
+A debit that must not overdraw the balance is inserted with debit(),
+whose INSERT ... SELECT only adds the entry if the balance it reads in
+the same statement covers it.
+"""
+from time import time
+from sqlalchemy import insert, literal, select, update
+from qbay import database, jobs
+from qbay.database import app, db
+
+KINDS = ('opening_balance', 'signup_bonus', 'booking_debit',
+         'booking_credit', 'payout', 'adjustment')
+
+
+def record(user_id: int, amount, kind: str,
+           booking_id: int = None) -> 'database.LedgerEntry':
+    """Adds an entry to the current session, for the caller to commit
+
+    params:
+    - user_id: The user whose balance changes (int)
+    - amount: Money added, negative when taken (same unit as balances)
+    - kind: One of KINDS (str)
+    - booking_id: The booking the money moved for, if any (int)
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown ledger entry kind: {kind}")
+    entry = database.LedgerEntry(user_id=user_id, amount=amount, kind=kind,
+                                 booking_id=booking_id)
+    db.session.add(entry)
+    jobs.enqueue('snapshot_balance', delay=app.config['LEDGER_SNAPSHOT_DELAY'],
+                 dedupe_key=f'balance:{user_id}', user_id=user_id)
+    return entry
+
+
+def debit(user_id: int, amount, kind: str, booking_id: int = None) -> bool:
+    """Adds an entry taking amount from the user's balance, unless the
+    balance is lower, for the caller to commit. The balance is read by
+    the insert itself: on SQLite it runs in a write transaction, which
+    sees every commit, and on MySQL after locking the user's row, as a
+    locking read of the ledger, so two debits cannot both spend the same
+    money.
+
+    Returns:
+        whether the entry was added
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown ledger entry kind: {kind}")
+    User, Entry = database.User, database.LedgerEntry
+    # Debits of the same user wait for each other here on MySQL
+    db.session.execute(select(User.id).where(User.id == user_id)
+                       .with_for_update())
+    entry = select(literal(user_id), literal(-amount, Entry.amount.type),
+                   literal(kind), literal(booking_id, Entry.booking_id.type),
+                   literal(time(), Entry.created_at.type), db.false()) \
+        .where(User.id == user_id, User.balance >= amount)
+    result = db.session.execute(insert(Entry).from_select(
+        ['user_id', 'amount', 'kind', 'booking_id', 'created_at', 'folded'],
+        entry))
+    if not result.rowcount:
+        return False
+    jobs.enqueue('snapshot_balance', delay=app.config['LEDGER_SNAPSHOT_DELAY'],
+                 dedupe_key=f'balance:{user_id}', user_id=user_id)
+    return True
+
+
+def balance(user_id: int):
+    """Current balance of a user, including entries not yet committed in
+    this session
+    """
+    return db.session.scalar(select(database.User.balance)
+                             .where(database.User.id == user_id))
+
+
+def entries(user_id: int) -> 'list':
+    """All the entries of a user, oldest first"""
+    Entry = database.LedgerEntry
+    return db.session.scalars(select(Entry).where(Entry.user_id == user_id)
+                              .order_by(Entry.id)).all()
+
+
+def snapshot(user_id: int, before: float = None) -> int:
+    """Folds the user's entries recorded before the given time (all of
+    them by default) into their snapshot
+
+    Returns:
+        the number of entries folded
+
+    Raises RuntimeError if another worker folded some of them first
+    """
+    User, Entry = database.User, database.LedgerEntry
+    unfolded = select(Entry.id, Entry.amount).where(
+        Entry.user_id == user_id, Entry.folded == db.false())
+    if before is not None:
+        unfolded = unfolded.where(Entry.created_at < before)
+    rows = db.session.execute(unfolded).all()
+    if not rows:
+        return 0
+    ids = [row.id for row in rows]
+    # Only the entries read above are flagged, and nothing is folded
+    # twice: of two workers folding the same entries, one flags fewer
+    result = db.session.execute(
+        update(Entry).where(Entry.id.in_(ids), Entry.folded == db.false())
+        .values(folded=True).execution_options(synchronize_session=False))
+    if result.rowcount != len(ids):
+        raise RuntimeError(f"Entries of user {user_id} were folded "
+                           "concurrently")
+    db.session.execute(
+        update(User).where(User.id == user_id)
+        .values(balance_snapshot=User.balance_snapshot
+                + sum(row.amount for row in rows))
+        .execution_options(synchronize_session=False))
+    return len(ids)
+
+
+@jobs.handler('snapshot_balance')
+def snapshot_job(user_id: int):
+    """Job folding a user's settled entries into their snapshot, queued
+    again while younger ones remain
+    """
+    delay = app.config['LEDGER_SNAPSHOT_DELAY']
+    snapshot(user_id, before=time() - delay)
+    Entry = database.LedgerEntry
+    if db.session.scalar(select(Entry.id).where(
+            Entry.user_id == user_id, Entry.folded == db.false()).limit(1)):
+        jobs.enqueue('snapshot_balance', delay=delay,
+                     dedupe_key=f'balance:{user_id}', user_id=user_id)
@@ -2,10 +2,18 @@ import re
 from qbay import database
 from qbay.user import User
 from qbay.review import Review
+from qbay.availability import Availability, to_date_string
+from qbay.fragments import invalidate_listing
+from qbay.search import index_listing
+from qbay import jobs
 from qbay.database import db
+from sqlalchemy import exc, func, select, update
+from sqlalchemy.orm import joinedload
 from typing import List
 from datetime import datetime, timedelta
 
+FEED_PAGE_SIZE = 20
+
 
 class Listing:
     """
@@ -40,6 +48,7 @@ class Listing:
         self._modified_date: datetime = datetime.now()
         self._seller = owner
         self._booked_dates = None
+        self._version = None  # read from the database on first use
 
         # Extra
         self._address: str = address
@@ -74,21 +83,37 @@ class Listing:
         self._modified_date = datetime.now()
 
     @staticmethod
-    def valid_title(title):
-        """Determine if a given title is valid """
+    def valid_title_format(title):
+        """Determine if a given title is well formed"""
         regex = re.compile(
             r'(^([A-Za-z0-9]([A-Za-z0-9]| ){,78}[A-Za-z0-9])$)|[A-Za-z0-9]')
-        if re.fullmatch(regex, title):
-            with database.app.app_context():
-                exists = database.Listing.query.filter_by(title=title).all()
-            return not len(exists)
-        return False
+        return bool(re.fullmatch(regex, title))
+
+    @staticmethod
+    def valid_title(title):
+        """Determine if a given title is well formed and not taken by
+        another listing, ignoring case, with a single probe of the
+        title_key index
+        """
+        if not Listing.valid_title_format(title):
+            return False
+        with database.app.app_context():
+            taken = db.session.query(database.Listing.query.filter_by(
+                title_key=database.normalized_key(title)).exists()).scalar()
+        return not taken
 
     def update_title(self, title):
-        """Updates the listing title and pushes changes to database"""
+        """Updates the listing title and pushes changes to database
+
+        Raises ValueError if another listing has the title
+        """
         self.title = title
         self.database_obj.title = title
-        db.session.commit()
+        try:
+            self._push_modification()
+        except exc.IntegrityError:
+            db.session.rollback()
+            raise ValueError(f"Title already exists: {title}")
 
     @property
     def description(self):
@@ -115,7 +140,7 @@ class Listing:
         """Updates the listing description and pushes changes to database"""
         self.description = description
         self.database_obj.description = description
-        db.session.commit()
+        self._push_modification()
 
     @property
     def price(self):
@@ -141,7 +166,7 @@ class Listing:
         """Updates the listing price and pushes changes to database"""
         self.price = price
         self.database_obj.price = price * 100
-        db.session.commit()
+        self._push_modification()
 
     @property
     def created_date(self):
@@ -157,6 +182,48 @@ class Listing:
             self._modified_date = self.database_obj.last_modified_date
         return self._modified_date.date().isoformat()
 
+    @property
+    def version(self) -> int:
+        """Version of the database listing the next update expects to
+        find: the one first read, or given by an edit form, plus the
+        updates made through this object
+        """
+        if self._version is None and self.database_obj:
+            self._version = self.database_obj.version
+        return self._version
+
+    @version.setter
+    def version(self, version: int):
+        """Bases the next updates on the given version"""
+        self._version = version
+
+    def _push_modification(self):
+        """Stamps the database listing as modified today and bumps its
+        version if it is still the expected one, then queues its
+        reindexing for search, commits it and drops its cached cards
+
+        Raises EditConflict if the listing was edited by someone else
+        """
+        version = self.version
+        # Compare and set: of two edits based on the same version, the
+        # second matches no row, without holding a lock while editing
+        result = db.session.execute(
+            update(database.Listing)
+            .where(database.Listing.id == self.id,
+                   database.Listing.version == version)
+            .values(version=version + 1,
+                    last_modified_date=datetime.now().strftime('%Y-%m-%d'))
+            .execution_options(synchronize_session=False))
+        if result.rowcount != 1:
+            db.session.rollback()
+            raise database.EditConflict(
+                "The listing was changed by someone else in the meantime, "
+                "please check its current details and try again!")
+        jobs.enqueue('index_listing', listing_id=self.id)
+        db.session.commit()
+        self._version = version + 1
+        invalidate_listing(self.id)
+
     @staticmethod
     def valid_date(mod_date):
         """Determine if a given last modification date is valid"""
@@ -186,52 +253,52 @@ class Listing:
                 return ((user is not None) and (user.email != ""))
         return False
 
+    @property
+    def availability(self) -> 'Availability':
+        """Fetches the booked ranges of the listing"""
+        return Availability(self.id)
+
     @property
     def booked_dates(self) -> 'List[str]':
         """Fetches list of booked dates"""
         if self.database_obj:
-            result = database.Dates.query.filter_by(listing_id=self.id).all()
-            booked_dates = [d.date for d in result]
-            return booked_dates
+            return self.availability.nights()
         return None
 
     def valid_booking_date(self, booked_dates: List[datetime]):
         """Check if given booking start and ending dates are valid"""
-        for date in booked_dates:
-            date = date.strftime('%Y-%m-%d')
-            if date in self.booked_dates:
-                raise ValueError("Given dates overlap with existing bookings!")
+        if not booked_dates:
+            return True
+        start = min(booked_dates)
+        end = max(booked_dates) + timedelta(days=1)
+        if self.availability.overlaps(start, end):
+            raise ValueError("Given dates overlap with existing bookings!")
         return True
 
-    def add_booking_date(self, booked_dates: List[datetime]):
-        """Adds booked dates to List of bookings"""
-        for date in booked_dates:
-            date_db = database.Dates(date=date.strftime('%Y-%m-%d'),
-                                     listing_id=self.id)
-            with database.app.app_context():
-                db.session.add(date_db)
-                db.session.commit()
+    def add_booking_date(self, booked_dates: List[datetime],
+                         commit: bool = True):
+        """Adds booked dates to List of bookings. With commit=False the
+        reservation is left for the caller to commit.
+        """
+        if not booked_dates:
+            return
+        start = min(booked_dates)
+        end = max(booked_dates) + timedelta(days=1)
+        self.availability.reserve(start, end)
+        if commit:
+            db.session.commit()
 
     def find_min_booking_date(self):
-        """Fetches first available start date a buyer can book the listing"""
-        booked_dates = sorted(self.booked_dates, 
-                              key=lambda x: datetime.strptime(x, '%Y-%m-%d'))
-        # No bookings yet or earliest booking is after today
+        """Fetches first available start date a buyer can book the listing.
+        Read from the listing unless the stored date has passed, in which
+        case it is looked up in the booked ranges.
+        """
         today = datetime.now().strftime('%Y-%m-%d')
-        if booked_dates == [] or (booked_dates[0] > today):
-            return today
-
-        # Find first available date, found when there's a gap between dates
-        prev_d = datetime.strptime(booked_dates[0], "%Y-%m-%d")
-        curr_d = prev_d
-        for i in range(1, len(booked_dates)):
-            curr_d = datetime.strptime(booked_dates[i], "%Y-%m-%d")
-            if (curr_d - prev_d).days > 1:
-                return (prev_d + timedelta(days=1)).strftime('%Y-%m-%d')
-            prev_d = curr_d
-
-        # No gaps exist, first available date is the day after latest booking
-        return (prev_d + timedelta(days=1)).strftime('%Y-%m-%d')
+        if self.database_obj:
+            stored = self.database_obj.next_available_date
+            if stored and stored >= today:
+                return stored
+        return self.availability.first_free(today)
 
     @property
     def address(self):
@@ -248,7 +315,7 @@ class Listing:
         """Updates the listing address and pushes changes to database"""
         self.address = address
         self.database_obj.address = address
-        db.session.commit()
+        self._push_modification()
 
     @property
     def reviews(self) -> 'List[Review]':
@@ -276,8 +343,10 @@ class Listing:
         - price: The cost of renting the listing (float)
         - owner: The User associated with the listing (User)
         - address: The address of the listing (string)
+
+        Raises ValueError if a parameter is invalid or the title is taken
         """
-        if not (Listing.valid_title(title)):
+        if not (Listing.valid_title_format(title)):
             raise ValueError(f"Invalid Title: {title}")
         if not (Listing.valid_seller(owner)):
             raise ValueError(f"Invalid Seller: {owner}")
@@ -298,14 +367,31 @@ class Listing:
                                    owner_id=self.seller.id,
                                    address=self.address,
                                    date_created=self.created_date,
-                                   last_modified_date=self.modified_date)
+                                   last_modified_date=self.modified_date,
+                                   next_available_date=self.created_date)
         with database.app.app_context():
             db.session.add(listing)
+            try:
+                db.session.flush()
+            except exc.IntegrityError:
+                db.session.rollback()
+                raise ValueError(f"Title already exists: {self.title}")
+            jobs.enqueue('index_listing', listing_id=listing.id)
             db.session.commit()
             self._database_obj = listing
             self._modified_date = listing.last_modified_date
             self._id = listing.id
 
+    @staticmethod
+    @jobs.handler('index_listing')
+    def reindex(listing_id: int):
+        """Job bringing the search index up to date with a listing created
+        or edited since it was queued
+        """
+        listing = db.session.get(database.Listing, listing_id)
+        if listing is not None:
+            index_listing(listing)
+
     @staticmethod
     def query_listing(id):
         """ Returns a Listing object for interacting with the database
@@ -325,4 +411,105 @@ class Listing:
             listing = Listing()
             listing._database_obj = database_listing
             return listing
-        return None
\ No newline at end of file
+        return None
+
+    @staticmethod
+    def query_page(after: int = None, limit: int = FEED_PAGE_SIZE):
+        """Returns one page of listings for the home feed, ordered by id
+        and with each owner loaded in the same query. Pages are keyed by
+        the last id seen rather than an offset, so any page costs the same
+        however large the catalog grows.
+
+        Args:
+            after (int): id of the last listing on the previous page, or
+            None for the first page
+            limit (int): maximum number of listings on the page
+
+        Returns:
+            (List[database.Listing], int): the listings on the page and the
+            cursor for the next page, or None if this is the last page
+        """
+        listings = db.session.scalars(
+            Listing.page_statement(after, limit)).all()
+        return Listing.split_page(listings, limit)
+
+    @staticmethod
+    def page_statement(after: int = None, limit: int = FEED_PAGE_SIZE):
+        """Select of the listings of a home feed page, one more than
+        limit to tell whether another page follows (see split_page)
+        """
+        statement = (select(database.Listing)
+                     .options(joinedload(database.Listing.owner))
+                     .order_by(database.Listing.id))
+        if after is not None:
+            statement = statement.where(database.Listing.id > after)
+        return statement.limit(limit + 1)
+
+    @staticmethod
+    def split_page(listings: 'List[database.Listing]', limit: int):
+        """Splits the rows of page_statement into the listings on the
+        page and the cursor of the next page, or None on the last page
+        """
+        if len(listings) > limit:
+            return listings[:limit], listings[limit - 1].id
+        return listings, None
+
+    @staticmethod
+    def valid_stay(start, end):
+        """Check that a stay from start to end (exclusive) is made of
+        'YYYY-MM-DD' dates in order, raising ValueError otherwise"""
+        if datetime.strptime(to_date_string(start), '%Y-%m-%d') >= \
+                datetime.strptime(to_date_string(end), '%Y-%m-%d'):
+            raise ValueError("Start date is same or after end date!")
+        return True
+
+    @staticmethod
+    def free_between(start, end):
+        """SQL condition selecting the listings with no booked night in
+        [start, end). Booked ranges never overlap, so only the last range
+        of a listing starting before end can overlap: one probe of the
+        (listing_id, start_date) index per listing, however long its
+        booking history.
+        """
+        start, end = to_date_string(start), to_date_string(end)
+        last_end = (select(database.BookedRange.end_date)
+                    .where(database.BookedRange.listing_id ==
+                           database.Listing.id,
+                           database.BookedRange.start_date < end)
+                    .order_by(database.BookedRange.start_date.desc())
+                    .limit(1).scalar_subquery())
+        return func.coalesce(last_end, '') <= start
+
+    @staticmethod
+    def query_available(start, end, min_price: float = None,
+                        max_price: float = None, after: int = None,
+                        limit: int = FEED_PAGE_SIZE):
+        """Returns one page of the listings that can be booked from start
+        to end (exclusive), answered for the whole catalog in one query.
+        Paged like query_page.
+
+        Args:
+            start, end (str): the stay, as 'YYYY-MM-DD'
+            min_price, max_price (float): optional bounds on the nightly
+            price, in dollars
+            after (int): id of the last listing on the previous page
+            limit (int): maximum number of listings on the page
+
+        Returns:
+            (List[database.Listing], int): the listings on the page and the
+            cursor for the next page, or None if this is the last page
+
+        Raises ValueError if the dates are malformed or out of order
+        """
+        Listing.valid_stay(start, end)
+        query = (database.Listing.query
+                 .options(joinedload(database.Listing.owner))
+                 .filter(Listing.free_between(start, end))
+                 .order_by(database.Listing.id))
+        if min_price is not None:
+            query = query.filter(database.Listing.price >= min_price * 100)
+        if max_price is not None:
+            query = query.filter(database.Listing.price <= max_price * 100)
+        if after is not None:
+            query = query.filter(database.Listing.id > after)
+        return Listing.split_page(query.limit(limit + 1).all(), limit)
\ No newline at end of file
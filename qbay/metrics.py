@@ -0,0 +1,83 @@
+import threading
+from time import perf_counter
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+class Histogram:
+    """Thread-safe cumulative histogram of observed values
+
+    params:
+    - buckets: Upper bounds of the buckets, in increasing order
+    """
+
+    def __init__(self, buckets):
+        self._bounds = tuple(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)  # last one is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """Records a single value"""
+        with self._lock:
+            for i, bound in enumerate(self._bounds):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            else:
+                self._counts[-1] += 1
+            self._sum += value
+
+    def snapshot(self) -> dict:
+        """Returns the count, sum and [upper bound, cumulative count] of
+        every bucket
+        """
+        with self._lock:
+            buckets, total = [], 0
+            for bound, count in zip(self._bounds + ('+Inf',), self._counts):
+                total += count
+                buckets.append([bound, total])
+            return {'count': total, 'sum': self._sum, 'buckets': buckets}
+
+
+# Time spent waiting for a connection from the pool, in milliseconds
+pool_wait_ms = Histogram((0.1, 0.5, 1, 5, 10, 25, 50, 100, 250, 500,
+                          1000, 2500, 5000, 10000, 30000))
+pool_timeouts = 0
+_timeouts_lock = threading.Lock()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waits for a connection
+    (including opening a new one) and how many checkouts time out
+    """
+
+    def _do_get(self):
+        global pool_timeouts
+        began = perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with _timeouts_lock:
+                pool_timeouts += 1
+            raise
+        finally:
+            pool_wait_ms.observe((perf_counter() - began) * 1000)
+
+
+def pool_status(engine) -> dict:
+    """Returns the live connection counts of engine's pool"""
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'idle': pool.checkedin(),
+            # QueuePool counts the unopened part of the pool as negative
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+            'timeouts': pool_timeouts,
+            'wait_ms': pool_wait_ms.snapshot(),
+        })
+    return status
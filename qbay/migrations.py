@@ -0,0 +1,328 @@
+"""
+Versioned schema migrations, applied with `python -m qbay migrate`
+
+Every migration runs at most once per database; the versions applied so
+far are recorded in the schema_version table. Migration 1 creates any
+missing table from the current models, so on a new database the later
+migrations only find their work already done. They must therefore check
+before changing anything (see has_column / has_index) and stay safe to
+run against a schema that is already up to date.
+"""
+
+import json
+from qbay import database, passwords, search
+from qbay.database import db
+from qbay.availability import DATE_FORMAT, Availability, fold_nights
+from qbay.bitmaps import YearBits, split_by_year
+from sqlalchemy import insert, inspect, text
+from typing import Callable, List
+from datetime import date, datetime
+
+
+class Migration:
+    """A single versioned schema change
+
+    params:
+    - version: Position of the migration, starting at 1 (int)
+    - description: What the migration does (str)
+    - upgrade: Function applying the change in the current session
+    """
+
+    def __init__(self, version: int, description: str,
+                 upgrade: Callable[[], None]):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+
+    def __repr__(self):
+        return f'<Migration {self.version}: {self.description}>'
+
+
+MIGRATIONS: 'List[Migration]' = []
+
+
+def migration(version: int, description: str):
+    """Registers the decorated function as the migration to version"""
+    def register(upgrade):
+        if MIGRATIONS and MIGRATIONS[-1].version != version - 1:
+            raise ValueError(f"Migration {version} is out of order")
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        return upgrade
+    return register
+
+
+def has_table(name: str) -> bool:
+    """Determine if the database has the given table"""
+    return inspect(db.session.connection()).has_table(name)
+
+
+def has_column(table: str, column: str) -> bool:
+    """Determine if the given table has the given column"""
+    columns = inspect(db.session.connection()).get_columns(table)
+    return any(c['name'] == column for c in columns)
+
+
+def has_index(table: str, index: str) -> bool:
+    """Determine if the given table has an index with the given name"""
+    indexes = inspect(db.session.connection()).get_indexes(table)
+    return any(i['name'] == index for i in indexes)
+
+
+def create_index(table: str, index: str, columns: 'List[str]',
+                 unique: bool = False):
+    """Creates the named index unless the table already has it. The
+    migrations name their indexes here instead of reading them from the
+    models, which also declare indexes on columns added by later
+    migrations.
+    """
+    if not has_index(table, index):
+        db.session.execute(text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {index} "
+            f"ON {table} ({', '.join(columns)})"))
+
+
+@migration(1, "create missing tables")
+def create_tables():
+    db.metadata.create_all(db.session.connection())
+
+
+@migration(2, "fold per-night dates rows into booked ranges")
+def fold_dates_into_ranges():
+    if not has_table('dates'):
+        return
+    rows = db.session.execute(text(
+        "SELECT listing_id, date FROM dates ORDER BY listing_id")).all()
+    nights_by_listing = {}
+    for listing_id, night in rows:
+        nights_by_listing.setdefault(listing_id, []).append(night)
+
+    # Inserted directly rather than through Availability, whose methods
+    # also touch listings columns added by later migrations. The nights
+    # are set in the yearly bitmaps too, as migration 7 does for the
+    # per-night rows that replaced the dates table for a while.
+    years = {}
+    for listing_id, nights in nights_by_listing.items():
+        for start, end in fold_nights(nights):
+            db.session.execute(insert(database.BookedRange), [{
+                'listing_id': listing_id, 'start_date': start,
+                'end_date': end}])
+            for year, first, last in split_by_year(start, end):
+                years.setdefault((listing_id, year),
+                                 YearBits(year)).set_range(first, last)
+    if years:
+        db.session.execute(insert(database.BookedYear), [
+            {'listing_id': listing_id, 'year': year,
+             'bits': bits.to_bytes(), 'version': 1}
+            for (listing_id, year), bits in years.items()])
+    db.session.execute(text("DROP TABLE dates"))
+
+
+@migration(3, "index hot lookup columns")
+def index_hot_columns():
+    create_index('listings', 'ix_listings_title', ['title'])
+    create_index('listings', 'ix_listings_owner_id', ['owner_id'])
+    create_index('bookings', 'ix_bookings_buyer_id', ['buyer_id'])
+    create_index('bookings', 'ix_bookings_listing_id', ['listing_id'])
+    create_index('booked_ranges', 'ix_booked_ranges_listing_start',
+                 ['listing_id', 'start_date'])
+
+
+@migration(4, "add listing versions")
+def add_listing_versions():
+    for column in ('version', 'availability_version'):
+        if not has_column('listings', column):
+            db.session.execute(text(
+                f"ALTER TABLE listings ADD COLUMN {column} "
+                "INTEGER NOT NULL DEFAULT 1"))
+
+
+@migration(5, "full-text search index")
+def add_search_index():
+    dialect = search.dialect()
+    if dialect == 'sqlite' and not has_table(search.FTS_TABLE):
+        db.session.execute(search.CREATE_FTS_TABLE)
+        search.rebuild_index()
+    elif dialect == 'mysql' and not has_index('listings',
+                                              search.FULLTEXT_INDEX):
+        db.session.execute(search.CREATE_FULLTEXT_INDEX)
+
+
+@migration(6, "store the next available date of listings")
+def add_next_available_date():
+    if not has_column('listings', 'next_available_date'):
+        db.session.execute(text("ALTER TABLE listings ADD COLUMN "
+                                "next_available_date VARCHAR(10)"))
+    today = date.today().strftime(DATE_FORMAT)
+    for (listing_id,) in db.session.execute(text(
+            "SELECT id FROM listings WHERE next_available_date IS NULL")):
+        db.session.execute(text(
+            "UPDATE listings SET next_available_date = :day WHERE id = :id"),
+            {'day': Availability(listing_id).first_free(today),
+             'id': listing_id})
+
+
+@migration(7, "store booked nights as yearly bitmaps")
+def fold_nights_into_bitmaps():
+    if not has_table('booked_nights'):
+        return
+    years = {}
+    for listing_id, night in db.session.execute(text(
+            "SELECT listing_id, night FROM booked_nights")):
+        day = datetime.strptime(night, DATE_FORMAT).date()
+        bits = years.setdefault((listing_id, day.year), YearBits(day.year))
+        index = day.timetuple().tm_yday - 1
+        bits.set_range(index, index + 1)
+    if years:
+        db.session.execute(insert(database.BookedYear), [
+            {'listing_id': listing_id, 'year': year,
+             'bits': bits.to_bytes(), 'version': 1}
+            for (listing_id, year), bits in years.items()])
+    db.session.execute(text("DROP TABLE booked_nights"))
+
+
+@migration(8, "case-normalized unique emails and listing titles")
+def add_unique_keys():
+    for table, column, column_type in (('users', 'email', 'VARCHAR(320)'),
+                                       ('listings', 'title', 'VARCHAR(255)')):
+        key = column + '_key'
+        if not has_column(table, key):
+            db.session.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN {key} {column_type}"))
+        # Legacy rows equal but for case keep a NULL key, all but the first
+        seen = {value for (value,) in db.session.execute(text(
+            f"SELECT {key} FROM {table} WHERE {key} IS NOT NULL"))}
+        for row_id, value in db.session.execute(text(
+                f"SELECT id, {column} FROM {table} "
+                f"WHERE {key} IS NULL ORDER BY id")).all():
+            normalized = database.normalized_key(value)
+            if normalized in seen:
+                continue
+            seen.add(normalized)
+            db.session.execute(text(
+                f"UPDATE {table} SET {key} = :key WHERE id = :id"),
+                {'key': normalized, 'id': row_id})
+        create_index(table, f'ix_{table}_{key}', [key], unique=True)
+
+
+@migration(9, "hash plaintext passwords")
+def hash_plaintext_passwords():
+    rows = [(user_id, password) for user_id, password in db.session.execute(
+        text("SELECT id, password FROM users")) if
+        not passwords.is_hashed(password)]
+    hashes = passwords.hash_passwords([password for _, password in rows])
+    for (user_id, _), hashed in zip(rows, hashes):
+        db.session.execute(text(
+            "UPDATE users SET password = :password WHERE id = :id"),
+            {'password': hashed, 'id': user_id})
+
+
+@migration(10, "add the background jobs table")
+def add_jobs_table():
+    if not has_table(database.Job.__tablename__):
+        database.Job.__table__.create(db.session.connection())
+
+
+@migration(11, "record balances in an append-only ledger")
+def add_ledger():
+    if not has_column('jobs', 'dedupe_key'):
+        db.session.execute(text(
+            "ALTER TABLE jobs ADD COLUMN dedupe_key VARCHAR(64)"))
+    create_index('jobs', 'ix_jobs_dedupe_key', ['dedupe_key'])
+    if not has_table(database.LedgerEntry.__tablename__):
+        database.LedgerEntry.__table__.create(db.session.connection())
+    if not has_column('users', 'balance_entry_id'):
+        db.session.execute(text(
+            "ALTER TABLE users ADD COLUMN balance_entry_id INTEGER "
+            "NOT NULL DEFAULT 0"))
+    # Existing balances become opening entries, already in the snapshots
+    rows = db.session.execute(text(
+        "SELECT id, balance FROM users WHERE balance_entry_id = 0")).all()
+    if rows:
+        db.session.execute(insert(database.LedgerEntry), [
+            {'user_id': user_id, 'amount': balance,
+             'kind': 'opening_balance'} for user_id, balance in rows])
+        db.session.execute(text(
+            "UPDATE users SET balance_entry_id = (SELECT MAX(id) FROM "
+            "ledger WHERE ledger.user_id = users.id) "
+            "WHERE balance_entry_id = 0"))
+
+
+@migration(12, "pay owners through batched payouts")
+def add_payouts():
+    if not has_table(database.Payout.__tablename__):
+        database.Payout.__table__.create(db.session.connection())
+    # Owner credits still queued as jobs become pending payouts
+    credits = db.session.execute(text(
+        "SELECT id, payload FROM jobs WHERE kind = 'credit_owner'")).all()
+    if credits:
+        payloads = [json.loads(payload) for _, payload in credits]
+        db.session.execute(insert(database.Payout), [
+            {'owner_id': payload['owner_id'], 'amount': payload['amount'],
+             'booking_id': payload.get('booking_id')}
+            for payload in payloads])
+        db.session.execute(text(
+            "DELETE FROM jobs WHERE kind = 'credit_owner'"))
+
+
+@migration(13, "add user versions")
+def add_user_versions():
+    if not has_column('users', 'version'):
+        db.session.execute(text(
+            "ALTER TABLE users ADD COLUMN version "
+            "INTEGER NOT NULL DEFAULT 1"))
+
+
+@migration(14, "flag the ledger entries folded into balances")
+def add_ledger_folded():
+    if not has_column('ledger', 'folded'):
+        db.session.execute(text(
+            "ALTER TABLE ledger ADD COLUMN folded BOOLEAN NOT NULL "
+            "DEFAULT 0"))
+    # Entries up to balance_entry_id were folded into the snapshots
+    if has_column('users', 'balance_entry_id'):
+        db.session.execute(text(
+            "UPDATE ledger SET folded = 1 WHERE id <= (SELECT "
+            "balance_entry_id FROM users WHERE users.id = ledger.user_id)"))
+        db.session.execute(text(
+            "ALTER TABLE users DROP COLUMN balance_entry_id"))
+    create_index('ledger', 'ix_ledger_user_id_folded', ['user_id', 'folded'])
+
+
+def current_version() -> int:
+    """Returns the latest schema version applied, 0 for a new database"""
+    if not has_table(database.SchemaVersion.__tablename__):
+        return 0
+    latest = db.session.query(
+        db.func.max(database.SchemaVersion.version)).scalar()
+    return latest or 0
+
+
+def pending() -> 'List[Migration]':
+    """Returns the migrations not yet applied, in order"""
+    version = current_version()
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def migrate(target: int = None) -> 'List[Migration]':
+    """Applies pending migrations up to target (default: all of them).
+    Each migration is committed together with its schema_version row,
+    and rolled back on failure.
+
+    Returns:
+        the migrations applied
+    """
+    applied = []
+    for step in pending():
+        if target is not None and step.version > target:
+            break
+        try:
+            step.upgrade()
+            # Migration 1 creates the schema_version table itself
+            db.session.add(database.SchemaVersion(
+                version=step.version, description=step.description))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        applied.append(step)
+    return applied
@@ -0,0 +1,134 @@
+"""
+Password hashing on a bounded pool of worker threads
+
+Passwords are stored as `$scrypt$n=<n>,r=<r>,p=<p>$<salt>$<hash>` or
+`$pbkdf2-sha256$i=<iterations>$<salt>$<hash>` (base64 salt and hash).
+The scheme and cost used for new hashes are read from the app config on
+every call, so needs_rehash notices when they change and User.login can
+upgrade a stored hash with the password it just verified. Rows in any
+other format are legacy plaintext passwords, accepted once and rehashed.
+
+hashlib releases the GIL while deriving keys, so the pool's threads run
+on separate cores; PASSWORD_WORKERS bounds how many hashes are computed
+at once (and how much memory scrypt uses) whatever the number of request
+threads waiting on them.
+"""
+import os
+import hmac
+import base64
+import hashlib
+import threading
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from qbay.database import app
+
+SCHEMES = ('scrypt', 'pbkdf2-sha256')
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def pool() -> ThreadPoolExecutor:
+    """Returns this process' hashing pool, created on first use so that
+    workers forked by gunicorn each start their own threads
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(app.config['PASSWORD_WORKERS'],
+                                       thread_name_prefix='passwords')
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _b64(raw: bytes) -> str:
+    return base64.b64encode(raw).decode().rstrip('=')
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def current_params() -> str:
+    """Scheme and cost parameters of new hashes, as stored in them"""
+    if app.config['PASSWORD_SCHEME'] == 'pbkdf2':
+        return f"pbkdf2-sha256$i={app.config['PASSWORD_PBKDF2_ITERATIONS']}"
+    return (f"scrypt$n={app.config['PASSWORD_SCRYPT_N']},"
+            f"r={app.config['PASSWORD_SCRYPT_R']},"
+            f"p={app.config['PASSWORD_SCRYPT_P']}")
+
+
+def _derive(password: str, params: str, salt: bytes) -> bytes:
+    scheme, costs = params.split('$')
+    costs = {name: int(value) for name, value in
+             (cost.split('=') for cost in costs.split(','))}
+    if scheme == 'scrypt':
+        n, r, p = costs['n'], costs['r'], costs['p']
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=2 * 128 * n * r * p + 2 ** 20,
+                              dklen=HASH_BYTES)
+    if scheme == 'pbkdf2-sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt,
+                                   costs['i'], dklen=HASH_BYTES)
+    raise ValueError(f"Unknown password scheme: {scheme}")
+
+
+def _hash(password: str, params: str) -> str:
+    salt = os.urandom(SALT_BYTES)
+    digest = _derive(password, params, salt)
+    return f"${params}${_b64(salt)}${_b64(digest)}"
+
+
+def _verify(password: str, stored: str) -> bool:
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, scheme, costs, salt, digest = stored.split('$')
+    return hmac.compare_digest(
+        _derive(password, f"{scheme}${costs}", _unb64(salt)), _unb64(digest))
+
+
+def hash_password(password: str) -> str:
+    """Hashes password with the current parameters, on the pool"""
+    return pool().submit(_hash, password, current_params()).result()
+
+
+def hash_passwords(passwords: 'List[str]') -> 'List[str]':
+    """Hashes many passwords with the current parameters, spread over
+    the pool
+    """
+    params = current_params()
+    return list(pool().map(lambda password: _hash(password, params),
+                           passwords))
+
+
+def verify_password(password: str, stored: str) -> bool:
+    """Determine if password matches the stored hash (or legacy
+    plaintext), on the pool
+    """
+    return pool().submit(_verify, password, stored).result()
+
+
+def needs_rehash(stored: str) -> bool:
+    """Determine if stored was not hashed with the current parameters"""
+    return not stored.startswith(f"${current_params()}$")
+
+
+def is_hashed(stored: str) -> bool:
+    """Determine if stored is a hash rather than a legacy plaintext"""
+    parts = stored.split('$')
+    return len(parts) == 5 and parts[0] == '' and parts[1] in SCHEMES
+
+
+# Verified when the email is unknown, so that a failed login takes as
+# long whether or not the account exists
+_dummy_hashes = {}
+
+
+def dummy_hash() -> str:
+    params = current_params()
+    if params not in _dummy_hashes:
+        _dummy_hashes[params] = hash_password(os.urandom(8).hex())
+    return _dummy_hashes[params]
@@ -0,0 +1,73 @@
+"""
+Batched payment of owners for their bookings
+
+A booking only inserts a pending Payout for the listing's owner, so the
+bookings of an owner with many listings do not all wait on that owner's
+balance. Every PAYOUT_SETTLE_INTERVAL seconds the settle_payouts job
+pays up to PAYOUT_BATCH pending payouts, with one ledger entry per owner
+for all of theirs, and marks them paid by that entry.
+"""
+from sqlalchemy import select, update
+from typing import Dict, List
+from qbay import database, jobs, ledger
+from qbay.database import app, db
+from qbay.user import user_cache
+
+
+def record(owner_id: int, amount, booking_id: int = None):
+    """Adds a pending payout to the current session, for the caller to
+    commit
+    """
+    db.session.add(database.Payout(owner_id=owner_id, amount=amount,
+                                   booking_id=booking_id))
+
+
+def pending(owner_id: int):
+    """Total of the owner's payouts not yet added to their balance"""
+    Payout = database.Payout
+    return db.session.scalar(
+        select(db.func.coalesce(db.func.sum(Payout.amount), 0))
+        .where(Payout.owner_id == owner_id, Payout.entry_id.is_(None)))
+
+
+def settle(limit: int = None) -> int:
+    """Pays the oldest pending payouts, up to limit (PAYOUT_BATCH by
+    default), in the current session
+
+    Returns:
+        the number of payouts paid
+    """
+    Payout = database.Payout
+    limit = app.config['PAYOUT_BATCH'] if limit is None else limit
+    rows = db.session.execute(
+        select(Payout.id, Payout.owner_id, Payout.amount)
+        .where(Payout.entry_id.is_(None)).order_by(Payout.id)
+        .limit(limit)).all()
+    by_owner: 'Dict[int, List]' = {}
+    for row in rows:
+        by_owner.setdefault(row.owner_id, []).append(row)
+    for owner_id, payouts in by_owner.items():
+        entry = ledger.record(owner_id, sum(p.amount for p in payouts),
+                              'payout')
+        db.session.flush()
+        ids = [p.id for p in payouts]
+        result = db.session.execute(
+            update(Payout).where(Payout.id.in_(ids),
+                                 Payout.entry_id.is_(None))
+            .values(entry_id=entry.id)
+            .execution_options(synchronize_session=False))
+        if result.rowcount != len(ids):
+            raise RuntimeError(f"Payouts of owner {owner_id} were settled "
+                               "concurrently")
+        user_cache.invalidate(owner_id)
+    return len(rows)
+
+
+@jobs.periodic('settle_payouts', app.config['PAYOUT_SETTLE_INTERVAL'])
+def settle_job():
+    """Job paying a batch of payouts, run again right away while more
+    are pending
+    """
+    batch = app.config['PAYOUT_BATCH']
+    if settle(batch) == batch:
+        jobs.schedule('settle_payouts', delay=0)
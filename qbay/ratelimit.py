@@ -0,0 +1,274 @@
+"""
+Token bucket rate limiting of the login, sign up and booking routes
+
+Each budget allows `burst` requests at once, refilled at `per_minute`
+tokens a minute, and is counted separately for every client IP and for
+every account (the email submitted, or the logged in user). A request
+over any of its budgets is answered 429 with a Retry-After header before
+the route runs, so it costs no database query, and takes no token from
+its other budgets.
+
+Buckets live in the worker process (MemoryStore) unless ratelimit_storage
+points at a Redis server (redis://...), which all workers then share.
+"""
+import math
+import threading
+from time import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Tuple
+from flask import make_response, request, session
+from qbay.database import app, normalized_key
+
+
+class Limit:
+    """Budget of one route for one kind of key
+
+    params:
+    - name: Name of the budget, part of the bucket keys (str)
+    - per_minute: Tokens added back every minute (float)
+    - burst: Size of the bucket (int)
+    - key: Function returning the key of the current request, or None if
+      the budget does not apply to it
+    """
+
+    def __init__(self, name: str, per_minute: float, burst: int,
+                 key: 'Callable[[], Optional[str]]'):
+        self.name = name
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.key = key
+
+    def __repr__(self):
+        return f'<Limit {self.name}: {self.rate * 60:g}/min, {self.burst}>'
+
+
+def by_ip() -> str:
+    return request.remote_addr or 'unknown'
+
+
+def by_email() -> 'Optional[str]':
+    email = request.form.get('email')
+    return normalized_key(email) if email else None
+
+
+def by_user() -> 'Optional[str]':
+    user_id = session.get('logged_in')
+    return str(user_id) if user_id is not None else None
+
+
+RATE_LIMITS: 'Dict[str, List[Limit]]' = {
+    'login': [Limit('login-ip', 30, 10, by_ip),
+              Limit('login-email', 6, 5, by_email)],
+    'register': [Limit('register-ip', 10, 5, by_ip)],
+    'booking': [Limit('booking-ip', 60, 20, by_ip),
+                Limit('booking-user', 20, 10, by_user)],
+}
+
+
+def refill(tokens: float, updated: float, now: float, rate: float,
+           burst: int) -> float:
+    """Tokens in a bucket last left with tokens at time updated"""
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class MemoryStore:
+    """Buckets of this process, the least recently used dropped past
+    maxsize so that a flood of addresses cannot exhaust memory
+
+    params:
+    - maxsize: Maximum number of buckets kept (int)
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self._maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key: str, rate: float, burst: int,
+             now: float) -> 'Tuple[bool, float]':
+        """Takes a token from the bucket at key
+
+        Returns:
+            (allowed, seconds until a token is available)
+        """
+        denied, retry_after = self.take_all([(key, rate, burst)], now)
+        return denied is None, retry_after
+
+    def take_all(self, buckets: 'List[Tuple[str, float, int]]',
+                 now: float) -> 'Tuple[Optional[int], float]':
+        """Takes a token from each of the (key, rate, burst) buckets, or
+        from none of them if any is empty
+
+        Returns:
+            (None, 0.0) if the tokens were taken, otherwise (position of
+            the first empty bucket, seconds until they all have a token)
+        """
+        with self._lock:
+            levels = []
+            for key, rate, burst in buckets:
+                tokens, updated = self._buckets.pop(key, (burst, now))
+                levels.append(refill(tokens, updated, now, rate, burst))
+            empty = [i for i, tokens in enumerate(levels) if tokens < 1]
+            for (key, _, _), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens if empty else tokens - 1, now)
+            while len(self._buckets) > self._maxsize:
+                self._buckets.popitem(last=False)
+        return denied_after(buckets, levels, empty)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+def denied_after(buckets: 'List[Tuple[str, float, int]]',
+                 levels: 'List[float]',
+                 empty: 'List[int]') -> 'Tuple[Optional[int], float]':
+    """Result of take_all for buckets refilled to levels, of which the
+    ones at the positions empty had no token
+    """
+    if not empty:
+        return None, 0.0
+    return empty[0], max((1 - levels[i]) / buckets[i][1] for i in empty)
+
+
+class RedisStore:
+    """Buckets shared by every worker through a Redis server, taken from
+    atomically by a Lua script and expiring once full again
+
+    params:
+    - url: redis:// URL of the server (str)
+    """
+
+    # ARGV: now, then the rate, burst and expiry of each bucket in KEYS
+    TAKE = """
+    local now = tonumber(ARGV[1])
+    local levels, empty = {}, false
+    for i, key in ipairs(KEYS) do
+        local rate, burst = tonumber(ARGV[3 * i - 1]), tonumber(ARGV[3 * i])
+        local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        levels[i] = math.min(burst,
+                             tokens + math.max(0, now - updated) * rate)
+        if levels[i] < 1 then
+            empty = true
+        end
+    end
+    local result = {}
+    for i, key in ipairs(KEYS) do
+        result[i] = tostring(levels[i])
+        if not empty then
+            levels[i] = levels[i] - 1
+        end
+        redis.call('HSET', key, 'tokens', tostring(levels[i]),
+                   'updated', tostring(now))
+        redis.call('EXPIRE', key, ARGV[3 * i + 1])
+    end
+    return result
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("ratelimit_storage=redis:// requires redis: "
+                              "pip install redis")
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(self.TAKE)
+
+    def take(self, key: str, rate: float, burst: int,
+             now: float) -> 'Tuple[bool, float]':
+        denied, retry_after = self.take_all([(key, rate, burst)], now)
+        return denied is None, retry_after
+
+    def take_all(self, buckets: 'List[Tuple[str, float, int]]',
+                 now: float) -> 'Tuple[Optional[int], float]':
+        args = [now]
+        for _, rate, burst in buckets:
+            args += [rate, burst, math.ceil(burst / rate) + 1]
+        levels = [float(tokens) for tokens in self._take(
+            keys=[f'qbay:ratelimit:{key}' for key, _, _ in buckets],
+            args=args)]
+        empty = [i for i, tokens in enumerate(levels) if tokens < 1]
+        return denied_after(buckets, levels, empty)
+
+    def clear(self):
+        for key in self._client.scan_iter('qbay:ratelimit:*'):
+            self._client.delete(key)
+
+
+def make_store(storage: str):
+    """Returns the store for a ratelimit_storage setting"""
+    if storage.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(storage)
+    return MemoryStore(app.config['RATELIMIT_MEMORY_SIZE'])
+
+
+store = make_store(app.config['RATELIMIT_STORAGE'])
+
+# Requests rejected by this process, per budget
+rejected: 'Dict[str, int]' = {}
+_rejected_lock = threading.Lock()
+
+
+def check(route: str) -> 'Optional[float]':
+    """Takes a token from every budget of route that applies to the
+    current request, or from none of them if any is spent
+
+    Returns:
+        None if the request may proceed, otherwise the seconds to wait
+    """
+    limits, buckets = [], []
+    for limit in RATE_LIMITS[route]:
+        key = limit.key()
+        if key is not None:
+            limits.append(limit)
+            buckets.append((f'{limit.name}:{key}', limit.rate, limit.burst))
+    if not buckets:
+        return None
+    denied, retry_after = store.take_all(buckets, time())
+    if denied is None:
+        return None
+    name = limits[denied].name
+    with _rejected_lock:
+        rejected[name] = rejected.get(name, 0) + 1
+    return retry_after
+
+
+def too_many_requests(status: int, message: str):
+    return make_response(message, status)
+
+
+def rate_limited(route: str, error=too_many_requests):
+    """Answers 429 instead of calling the decorated view once any budget
+    of route is spent
+
+    params:
+    - route: Key of the route's budgets in RATE_LIMITS (str)
+    - error: Function building the response from a status and message
+    """
+    def decorate(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if app.config['RATELIMIT_ENABLED']:
+                retry_after = check(route)
+                if retry_after is not None:
+                    response = make_response(error(
+                        429, "Too many requests, please try again later."))
+                    response.headers['Retry-After'] = str(
+                        max(1, math.ceil(retry_after)))
+                    return response
+            return view(*args, **kwargs)
+        return wrapped
+    return decorate
+
+
+def stats() -> dict:
+    with _rejected_lock:
+        counts = dict(rejected)
+    return {'enabled': app.config['RATELIMIT_ENABLED'],
+            'store': type(store).__name__, 'rejected': counts}
@@ -0,0 +1,144 @@
+"""
+Full-text search over listing titles, descriptions and addresses
+
+On SQLite the text is indexed in the FTS5 table listings_fts, whose rows
+share the id of their listing; the Listing write methods keep it current
+by queuing an index_listing job (see Listing.reindex), so a new or edited
+listing is found once a job worker has run it. On MySQL a FULLTEXT index
+on the listings table itself is used, which InnoDB keeps current on its
+own. Both tables are created along with the listings table, and
+migration 5 adds them to databases created before search existed.
+"""
+
+import re
+from qbay import database
+from qbay.database import db
+from sqlalchemy import DDL, event, text
+from sqlalchemy.orm import joinedload
+from typing import List, Tuple
+
+SEARCH_PAGE_SIZE = 20
+# Ranking on SQLite: listings with every word in the title first, then in
+# the title or address, then the rest, newest first within each tier.
+# FTS5 reads each tier in rowid order, so a page costs the rows before
+# its end, where bm25 would first count every match of a common word.
+FTS_TIERS = ('title : ({0})', '{{title address}} : ({0}) NOT title : ({0})',
+             '({0}) NOT {{title address}} : ({0})')
+FTS_TABLE = 'listings_fts'
+FULLTEXT_INDEX = 'ft_listings_text'
+
+CREATE_FTS_TABLE = DDL(
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+    "USING fts5(title, description, address)")
+CREATE_FULLTEXT_INDEX = DDL(
+    f"ALTER TABLE listings ADD FULLTEXT INDEX {FULLTEXT_INDEX} "
+    "(title, description, address)")
+
+# Created and dropped along with the listings table
+listings_table = database.Listing.__table__
+event.listen(listings_table, 'after_create',
+             CREATE_FTS_TABLE.execute_if(dialect='sqlite'))
+event.listen(listings_table, 'after_create',
+             CREATE_FULLTEXT_INDEX.execute_if(dialect='mysql'))
+event.listen(listings_table, 'before_drop',
+             DDL(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+             .execute_if(dialect='sqlite'))
+
+
+def dialect() -> str:
+    """Name of the primary database's dialect"""
+    return db.engine.dialect.name
+
+
+def terms(query: str) -> 'List[str]':
+    """Splits a user's query into the words searched for"""
+    return re.findall(r'\w+', query.lower())[:16]
+
+
+def index_listing(listing: 'database.Listing'):
+    """Brings the search index up to date with a listing written in the
+    current session, before it is committed
+    """
+    if dialect() != 'sqlite':
+        return  # MySQL maintains its FULLTEXT index on its own
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"),
+                       {'id': listing.id})
+    db.session.execute(text(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, description, address) "
+        "VALUES (:id, :title, :description, :address)"),
+        {'id': listing.id, 'title': listing.title,
+         'description': listing.description, 'address': listing.address})
+
+
+def rebuild_index():
+    """Indexes every listing from scratch"""
+    if dialect() != 'sqlite':
+        return
+    db.session.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    db.session.execute(text(
+        f"INSERT INTO {FTS_TABLE} (rowid, title, description, address) "
+        "SELECT id, title, description, address FROM listings"))
+
+
+def ranked_ids(words: 'List[str]', offset: int, limit: int) -> 'List[int]':
+    """Ids of the listings containing every word, best matches first"""
+    if dialect() == 'sqlite':
+        phrases = ' '.join(f'"{word}"' for word in words)
+        ids, end = [], offset + limit
+        for tier in FTS_TIERS:
+            ids += db.session.scalars(text(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH "
+                ":match ORDER BY rowid DESC LIMIT :limit"),
+                {'match': tier.format(phrases), 'limit': end - len(ids)})
+            if len(ids) >= end:
+                break
+        return ids[offset:]
+    elif dialect() == 'mysql':
+        match = ' '.join(f'+{word}' for word in words)
+        statement = text(
+            "SELECT id FROM listings WHERE MATCH (title, description, "
+            "address) AGAINST (:match IN BOOLEAN MODE) ORDER BY MATCH "
+            "(title, description, address) AGAINST (:match IN BOOLEAN "
+            "MODE) DESC, id LIMIT :limit OFFSET :offset")
+    else:
+        # No full-text index, fall back to scanning in id order
+        listing = database.Listing
+        columns = listing.title + ' ' + listing.description + ' ' + \
+            listing.address
+        query = db.session.query(listing.id)
+        for word in words:
+            query = query.filter(columns.ilike(f'%{word}%'))
+        return [row.id for row in
+                query.order_by(listing.id).offset(offset).limit(limit)]
+    rows = db.session.execute(statement, {'match': match, 'limit': limit,
+                                          'offset': offset})
+    return [row[0] for row in rows]
+
+
+def search_listings(query: str, page: int = 1,
+                    limit: int = SEARCH_PAGE_SIZE
+                    ) -> 'Tuple[List[database.Listing], bool]':
+    """Searches listings by title, description and address
+
+    Args:
+        query (str): words to search for, all of which must match
+        page (int): 1-based page of results
+        limit (int): maximum number of listings on the page
+
+    Returns:
+        (List[database.Listing], bool): the listings on the page, best
+        match first, with their owners loaded, and whether there is a
+        next page
+    """
+    words = terms(query)
+    if not words:
+        return [], False
+    ids = ranked_ids(words, (page - 1) * limit, limit + 1)
+    has_next = len(ids) > limit
+    ids = ids[:limit]
+    listings = (database.Listing.query
+                .options(joinedload(database.Listing.owner))
+                .filter(database.Listing.id.in_(ids)).all())
+    position = {listing_id: i for i, listing_id in enumerate(ids)}
+    listings.sort(key=lambda listing: position[listing.id])
+    return listings, has_next
@@ -0,0 +1,124 @@
+"""
+Production serving for `python -m qbay serve`
+
+Runs the app under gunicorn with a pre-forked pool of worker processes,
+each serving requests from a pool of threads. The app is imported and
+migrated once in the master process before forking (preload), so
+workers start without repeating that work. Send SIGHUP to the master
+for a graceful restart: new workers are started and old ones finish
+their in-flight requests (up to --graceful-timeout) before exiting.
+With --async, workers run uvicorn's event loop instead of threads and
+serve the read-heavy pages with an async database driver (qbay.asgi).
+Each worker also runs job_workers background job threads (qbay.jobs).
+"""
+
+import os
+from qbay import jobs, migrations
+from qbay.database import app, db
+
+DEFAULT_BIND = '0.0.0.0:8081'
+
+
+def default_workers() -> int:
+    """One worker process per core"""
+    return os.cpu_count() or 1
+
+
+def add_arguments(parser):
+    """Adds the serve options to an argparse parser"""
+    parser.add_argument('--bind', default=DEFAULT_BIND,
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='threads per worker (default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=30,
+                        help='seconds a request may run before its worker '
+                             'is restarted (default: %(default)s)')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='seconds workers get to finish in-flight '
+                             'requests on restart (default: %(default)s)')
+    parser.add_argument('--keep-alive', type=int, default=5,
+                        help='seconds to keep idle connections open '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='restart a worker after this many requests, '
+                             '0 to disable (default: %(default)s)')
+    parser.add_argument('--pid', default=None,
+                        help='file to write the master process id to')
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help='serve the read-heavy pages on an event loop '
+                             'with an async database driver (requires '
+                             'asgiref, uvicorn and aiosqlite or aiomysql)')
+
+
+def gunicorn_options(args) -> dict:
+    """Translates parsed serve options into gunicorn settings"""
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'preload_app': True,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'keepalive': args.keep_alive,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+    }
+    if args.async_mode:
+        options['worker_class'] = 'uvicorn.workers.UvicornWorker'
+    if args.pid:
+        options['pidfile'] = args.pid
+    return options
+
+
+def post_fork(server, worker):
+    """Drops database connections inherited from the master process, so
+    workers never share a socket, and starts the worker's job threads
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+    jobs.start()
+
+
+def worker_exit(server, worker):
+    """Lets the job threads finish the job they are running"""
+    jobs.stop(timeout=worker.cfg.graceful_timeout)
+
+
+def serve(args):
+    """Migrates the database and serves the app until interrupted"""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("serve requires gunicorn: pip install gunicorn")
+
+    class QBayApplication(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    application = app
+    if args.async_mode:
+        try:
+            import uvicorn  # noqa: F401 provides the worker class
+            from qbay.asgi import application
+        except ImportError:
+            raise SystemExit("serve --async requires asgiref, uvicorn and "
+                             "an async driver: pip install asgiref uvicorn "
+                             "aiosqlite")
+
+    with app.app_context():
+        migrations.migrate()
+    QBayApplication(application, gunicorn_options(args)).run()
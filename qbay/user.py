@@ -1,13 +1,29 @@
 import re
-from qbay import database
-from qbay.database import db
-from sqlalchemy import exc
+from qbay import database, ledger
+from qbay.bloom import BloomFilter
+from qbay.cache import LRUCache
+from qbay.database import app, db
+from qbay.passwords import (dummy_hash, hash_password, needs_rehash,
+                            verify_password)
+from qbay.fragments import invalidate_owner
+from sqlalchemy import exc, update
 from typing import TYPE_CHECKING, List
 
 if TYPE_CHECKING:
     from .listing import Listing
     from .review import Review
 
+# Snapshots of recently seen users, keyed by id, so authenticated requests
+# do not have to query the database before the route runs
+user_cache = LRUCache(app.config['USER_CACHE_SIZE'],
+                      app.config['USER_CACHE_TTL'])
+
+# Normalized emails signed up with through this process, so repeated
+# attempts with a taken email are rejected by a read instead of a failed
+# insert. Disabled when SIGNUP_FILTER_BITS is 0.
+signup_filter = (BloomFilter(app.config['SIGNUP_FILTER_BITS'])
+                 if app.config['SIGNUP_FILTER_BITS'] else None)
+
 
 class User():
     """ Object representation of a user's account
@@ -26,6 +42,7 @@ class User():
                  email: str = "", password: str = ""):
 
         self._database_obj: database.User = None
+        self._from_cache = False  # tethered lazily, see database_obj
         self._id = None  # created upon being added to database
         self._username: str = username
         self._email: str = email
@@ -35,49 +52,63 @@ class User():
         self._balance = 100
         self._reviews: 'List[Review]' = []
         self._listings_booked: 'List[Listing]' = []
+        self._version = None  # read from the database on first use
+
+    # Columns copied into the snapshots kept by user_cache
+    SNAPSHOT_COLUMNS = ('id', 'username', 'email', 'password',
+                        'postal_code', 'billing_address', 'balance',
+                        'version')
 
     def __repr__(self):
         return f'<User {self.username}>'
 
     # Will throw an exception if unique fields not satisfied
     def add_to_database(self):
-        """add the user object to the database
+        """add the user object to the database, with its balance as the
+        sign up bonus
         return: True if successful, False otherwise
         """
         user = database.User(username=self.username,
                              email=self.email,
-                             password=self.password,
+                             password=hash_password(self.password),
                              postal_code=self.postal_code,
-                             billing_address=self.billing_address,
-                             balance=self.balance)
+                             billing_address=self.billing_address)
 
         try:
             with database.app.app_context():
                 db.session.add(user)
+                db.session.flush()
+                ledger.record(user.id, self.balance, 'signup_bonus')
                 db.session.commit()
                 self._database_obj = user
                 self._id = user.id
+            user_cache.invalidate(self._id)
             return True
         except exc.IntegrityError:
+            db.session.rollback()
             return False
 
     @property
     def database_obj(self) -> database.User:
-        """Returns a reference to the database"""
+        """Returns a reference to the database. Users built from a cached
+        snapshot only load their row the first time it is needed.
+        """
+        if self._database_obj is None and self._from_cache:
+            self._database_obj = db.session.get(database.User, self._id)
         return self._database_obj
 
     @property
     def id(self):
         """Fetches the user's id"""
-        if self.database_obj:
-            self._id = self.database_obj.id
+        if self._database_obj:
+            self._id = self._database_obj.id
         return self._id
 
     @property
     def username(self) -> str:
         """Fetches the user's username"""
-        if self.database_obj:
-            self._username = self.database_obj.username
+        if self._database_obj:
+            self._username = self._database_obj.username
         return self._username
 
     @username.setter
@@ -90,8 +121,8 @@ class User():
     @property
     def email(self) -> str:
         """Fetches the user's email"""
-        if self.database_obj:
-            self._email = self.database_obj.email
+        if self._database_obj:
+            self._email = self._database_obj.email
         return self._email
 
     @email.setter
@@ -104,8 +135,8 @@ class User():
     @property
     def password(self) -> str:
         """Fetches the user's password"""
-        if self.database_obj:
-            self._password = self.database_obj.password
+        if self._database_obj:
+            self._password = self._database_obj.password
         return self._password
 
     @password.setter
@@ -118,8 +149,8 @@ class User():
     @property
     def balance(self):
         """ Fetches the user's balance """
-        if self.database_obj:
-            self._balance = self.database_obj.balance
+        if self._database_obj:
+            self._balance = self._database_obj.balance
         return self._balance
 
     @balance.setter
@@ -127,6 +158,21 @@ class User():
         """ Set the user's balance """
         self._balance = value
 
+    @property
+    def version(self) -> int:
+        """Version of the profile the next update expects to find: the
+        one first read, or given by an edit form, plus the updates made
+        through this object
+        """
+        if self._version is None and self.database_obj:
+            self._version = self.database_obj.version
+        return self._version
+
+    @version.setter
+    def version(self, version: int):
+        """Bases the next updates on the given version"""
+        self._version = version
+
     @property
     def reviews(self):
         """Fetches the list of reviews"""
@@ -144,8 +190,8 @@ class User():
     @property
     def postal_code(self):
         """Fetches the user's postal code"""
-        if self.database_obj:
-            self._postal_code = self.database_obj.postal_code
+        if self._database_obj:
+            self._postal_code = self._database_obj.postal_code
         return self._postal_code
 
     @postal_code.setter
@@ -160,8 +206,8 @@ class User():
     @property
     def billing_address(self):
         """Fetches the billing address"""
-        if self.database_obj:
-            self._billing_address = self.database_obj.billing_address
+        if self._database_obj:
+            self._billing_address = self._database_obj.billing_address
         return self._billing_address
 
     @billing_address.setter
@@ -267,16 +313,28 @@ class User():
                 User.valid_username(name)):
             return False
 
-        existed = database.User.query.filter_by(email=email).all()
-        if len(existed):
-            return False
+        # Uniqueness is enforced by the email_key index on insert; the
+        # filter only spares the insert for emails seen before
+        key = database.normalized_key(email)
+        if signup_filter is not None and key in signup_filter:
+            if User.email_taken(email):
+                return False
 
         user = User(username=name, email=email, password=password)
 
         # add it to current database session
-        user.add_to_database()
+        added = user.add_to_database()
+        if signup_filter is not None:
+            signup_filter.add(key)
+        return added
 
-        return True
+    @staticmethod
+    def email_taken(email) -> bool:
+        """Determine if an account uses email, ignoring case, with a
+        single probe of the email_key index
+        """
+        return db.session.query(database.User.query.filter_by(
+            email_key=database.normalized_key(email)).exists()).scalar()
 
     @staticmethod
     def login(email, password):
@@ -290,15 +348,25 @@ class User():
         Returns 1 for login failure due to invalid username or password
         Returns 2 for login failure due to incorrect username or 
                                                 password (non-matching)
+
+        The email is matched regardless of case, like on sign up. A
+        password stored with outdated hashing parameters (or as legacy
+        plaintext) is rehashed with the current ones.
         """
         if not (User.valid_email(email) and User.valid_password(password)):
             raise ValueError("Invalid email or password")
         with database.app.app_context():
-            user = database.User.query.filter_by(email=email).first()
-
-            if user:
-                if user.password == password:
-                    return user
+            user = database.User.query.filter_by(
+                email_key=database.normalized_key(email)).first()
+
+            if user is None:
+                verify_password(password, dummy_hash())
+            elif verify_password(password, user.password):
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
+                    db.session.commit()
+                    user_cache.invalidate(user.id)
+                return user
 
         raise ValueError("Incorrect email or password")
 
@@ -311,7 +379,8 @@ class User():
         self.username = username
         try:
             self.database_obj.username = username
-            db.session.commit()
+            self._push_modification()
+            invalidate_owner(self.id)  # cards show the owner's username
         except exc.IntegrityError:
             db.session.rollback()
             raise ValueError(f"Username already exists: {username}")
@@ -319,16 +388,18 @@ class User():
     def update_email(self, email):
         """Updates the user's email and pushes changes to the 
         database (if the email isn't already in the database)
+
+        Raises ValueError if the email already exists
         """
-        existed = database.User.query.filter_by(email=email).all()
-        if len(existed):
-            raise ValueError(f"Email already exists: {email}")
         self.email = email
         try:
             self.database_obj.email = email
-            db.session.commit()
+            self._push_modification()
         except exc.IntegrityError:
             db.session.rollback()
+            raise ValueError(f"Email already exists: {email}")
+        if signup_filter is not None:
+            signup_filter.add(database.normalized_key(email))
 
     def update_billing_address(self, address):
         """Updates the billing address and pushes changes to the 
@@ -336,7 +407,7 @@ class User():
         """
         self.billing_address = address
         self.database_obj.billing_address = address
-        db.session.commit()
+        self._push_modification()
 
     def update_postal_code(self, postal_code):
         """Updates the postal code and pushes changes to the 
@@ -344,15 +415,42 @@ class User():
         """
         self.postal_code = postal_code
         self.database_obj.postal_code = postal_code
+        self._push_modification()
+
+    def _push_modification(self):
+        """Bumps the version of the user's row if it is still the
+        expected one, then commits the changes made to the row and drops
+        its cached snapshot
+
+        Raises EditConflict if the profile was edited by someone else
+        """
+        version = self.version
+        result = db.session.execute(
+            update(database.User)
+            .where(database.User.id == self.id,
+                   database.User.version == version)
+            .values(version=version + 1)
+            .execution_options(synchronize_session=False))
+        if result.rowcount != 1:
+            db.session.rollback()
+            raise database.EditConflict(
+                "Your profile was changed elsewhere in the meantime, "
+                "please check its current details and try again!")
         db.session.commit()
+        self._version = version + 1
+        user_cache.invalidate(self.id)
     
-    def update_balance(self, value):
-        """Updates the user's balance and pushes changes to the 
-        database.
+    def update_balance(self, value, commit: bool = True):
+        """Sets the user's balance, recording the difference as an
+        adjustment in the ledger. With commit=False the change is left
+        for the caller to commit as part of a larger transaction.
         """
+        ledger.record(self.id, value - ledger.balance(self.id), 'adjustment')
         self.balance = value
-        self.database_obj.balance = value
-        db.session.commit()
+        db.session.expire(self.database_obj, ['balance'])
+        if commit:
+            db.session.commit()
+        user_cache.invalidate(self.id)
 
     @staticmethod
     def query_user(id):
@@ -375,3 +473,47 @@ class User():
             user.balance = user.database_obj.balance
             return user
         return None
+
+    @staticmethod
+    def query_user_cached(id, label: str = None):
+        """Returns an User object built from a cached snapshot of the
+        database row, only querying the database on a cache miss. The
+        row is loaded lazily if the object is used to write changes.
+        Snapshots expire after USER_CACHE_TTL seconds and are invalidated
+        by the update_* methods.
+
+        Args:
+            id (int): integer denoting the unique identifier of the user
+            label (str): name the cache hit or miss is counted under
+
+        Returns:
+            User: an user object for the given id, or None if it does not
+            exist
+        """
+        id = int(id)
+        snapshot = user_cache.get(id, label)
+        if snapshot is None:
+            database_user = db.session.get(database.User, id)
+            if not database_user:
+                return None
+            snapshot = User.cache_snapshot(database_user)
+        return User.from_snapshot(snapshot)
+
+    @staticmethod
+    def cache_snapshot(database_user: database.User) -> dict:
+        """Copies the SNAPSHOT_COLUMNS of a database user into user_cache
+        and returns them
+        """
+        snapshot = {column: getattr(database_user, column)
+                    for column in User.SNAPSHOT_COLUMNS}
+        user_cache.set(database_user.id, snapshot)
+        return snapshot
+
+    @staticmethod
+    def from_snapshot(snapshot: dict) -> 'User':
+        """Builds an User object from a user_cache snapshot"""
+        user = User()
+        user._from_cache = True
+        for column, value in snapshot.items():
+            setattr(user, '_' + column, value)
+        return user
@@ -4,6 +4,7 @@ import pytest
 import threading
 from werkzeug.serving import make_server
 from qbay.database import app
+from qbay.migrations import migrate
 '''
 This file defines what to do BEFORE running any test cases:
 '''
@@ -17,6 +18,11 @@ def pytest_sessionstart():
     db_file = 'db.sqlite'
     if os.path.exists(db_file):
         os.remove(db_file)
+    # Cheap password hashing, the tests create hundreds of accounts
+    app.config['PASSWORD_SCRYPT_N'] = 2 ** 4
+    # Importing qbay no longer creates the schema
+    with app.app_context():
+        migrate()
 
 
 def pytest_sessionfinish():
@@ -35,7 +41,7 @@ class ServerThread(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
         # import necessary routes
-        from qbay import controllers
+        from qbay import api, controllers
         self.srv = make_server('127.0.0.1', 8081, app)
         self.ctx = app.app_context()
         self.ctx.push()
@@ -1,12 +1,33 @@
+import os
+import sys
 import pytest
+import tempfile
+import argparse
+import threading
+import subprocess
 import unittest
+from unittest.mock import patch
 
 from qbay import database
-from qbay.user import User
+from qbay.user import User, signup_filter, user_cache
+from qbay.bloom import BloomFilter
+from qbay import jobs, ledger, passwords, payouts, ratelimit
+from qbay.passwords import verify_password
+from qbay.cache import LRUCache
 from qbay.database import app, db
 from qbay.review import Review
 from qbay.listing import Listing
 from qbay.booking import Booking
+from qbay.fragments import card_cache, listing_card
+from qbay.search import search_listings
+from qbay.bitmaps import YearBits, split_by_year
+from qbay.availability import Availability
+from qbay import api, migrations, server
+from time import time
+from flask import session
+from sqlalchemy import create_engine, event, insert, inspect, text
+from qbay.metrics import (Histogram, InstrumentedQueuePool, pool_status,
+                          pool_wait_ms)
 from datetime import datetime
 from datetime import datetime, timedelta
 
@@ -547,6 +568,9 @@ class UnitTest(unittest.TestCase):
         One can update all attributes of the listing, except 
         owner_id and last_modified_date.
         """
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
         # Initialize Listing
         title = "4 Bed 2 Bath"
         address = "Queen's University"
@@ -812,7 +836,8 @@ class UnitTest(unittest.TestCase):
         queried_user = User.query_user(user.id)
         assert queried_user.username == "testUser"
         assert queried_user.email == "user@example.ca"
-        assert queried_user.password == "password123"
+        assert queried_user.password != "password123"
+        assert verify_password("password123", queried_user.password)
 
         queried_user.update_billing_address("updating street")
         assert queried_user.billing_address == "updating street"
@@ -897,6 +922,1229 @@ class UnitTest(unittest.TestCase):
             Booking.book_listing(fred.id, bob.id, listing.id, "2022-12-02",
                                  "2022-12-04")
 
+    def test_availability_ranges(self):
+        """Tests that booked nights are kept as merged ranges and that
+        overlaps and the first free date are found from them.
+        """
+        bob, tim, listing = self.booking_helper()
+        tim.update_balance(1000)
+
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-01-01",
+                             "2030-01-05")
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-01-08",
+                             "2030-01-10")
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-01-05",
+                             "2030-01-08")
+        assert listing.availability.ranges() == [("2030-01-01",
+                                                  "2030-01-10")]
+        assert len(listing.booked_dates) == 9
+
+        availability = listing.availability
+        assert availability.overlaps("2029-12-30", "2030-01-02") is True
+        assert availability.overlaps("2030-01-09", "2030-01-12") is True
+        assert availability.overlaps("2029-12-30", "2030-01-01") is False
+        assert availability.overlaps("2030-01-10", "2030-01-12") is False
+        assert availability.first_free("2029-12-31") == "2029-12-31"
+        assert availability.first_free("2030-01-03") == "2030-01-10"
+
+    def test_migrations(self):
+        """Tests that pending migrations are applied once, in order, and
+        that legacy per-night rows are folded into ranges.
+        """
+        bob, tim, listing = self.booking_helper()
+        db.session.execute(text("CREATE TABLE dates (id INTEGER PRIMARY "
+                                "KEY, listing_id INTEGER, date VARCHAR(10))"))
+        for night in ["2030-02-03", "2030-02-01", "2030-02-02",
+                      "2030-02-07"]:
+            db.session.execute(text("INSERT INTO dates (listing_id, date) "
+                                    "VALUES (:id, :night)"),
+                               {"id": listing.id, "night": night})
+        db.session.execute(text("DROP INDEX ix_bookings_buyer_id"))
+        db.session.execute(text(
+            "ALTER TABLE listings DROP COLUMN availability_version"))
+        db.session.commit()
+
+        applied = migrations.migrate()
+        assert applied == migrations.MIGRATIONS
+        assert migrations.current_version() == len(migrations.MIGRATIONS)
+        assert migrations.pending() == []
+        assert migrations.migrate() == []
+
+        assert not migrations.has_table("dates")
+        assert listing.availability.ranges() == [
+            ("2030-02-01", "2030-02-04"), ("2030-02-07", "2030-02-08")]
+        assert len(listing.booked_dates) == 4
+        assert migrations.has_index("bookings", "ix_bookings_buyer_id")
+        assert migrations.has_column("listings", "availability_version")
+
+    def test_migrate_baseline_schema(self):
+        """Tests that `python -m qbay migrate` upgrades a database created
+        by the first release, before any migration existed, to the
+        latest version with its rows carried over.
+        """
+        path = os.path.join(tempfile.mkdtemp(), "baseline.db")
+        engine = create_engine("sqlite:///" + path)
+        with engine.begin() as connection:
+            for statement in [
+                    "CREATE TABLE users (id INTEGER PRIMARY KEY, username "
+                    "VARCHAR(20) NOT NULL, email VARCHAR(320) NOT NULL "
+                    "UNIQUE, password VARCHAR(255) NOT NULL, postal_code "
+                    "VARCHAR(7), billing_address VARCHAR(46), balance "
+                    "INTEGER NOT NULL)",
+                    "CREATE TABLE listings (id INTEGER PRIMARY KEY, title "
+                    "VARCHAR(255) NOT NULL, description VARCHAR(5000) NOT "
+                    "NULL, price INTEGER NOT NULL, address VARCHAR(5000) NOT "
+                    "NULL, date_created VARCHAR(10) NOT NULL, "
+                    "last_modified_date VARCHAR(10) NOT NULL, owner_id "
+                    "INTEGER REFERENCES users (id))",
+                    "CREATE TABLE dates (id INTEGER PRIMARY KEY, listing_id "
+                    "INTEGER REFERENCES listings (id), date VARCHAR(10) NOT "
+                    "NULL)",
+                    "CREATE TABLE bookings (id INTEGER PRIMARY KEY, owner_id "
+                    "INTEGER NOT NULL, buyer_id INTEGER REFERENCES users "
+                    "(id), listing_id INTEGER REFERENCES listings (id), "
+                    "start_date VARCHAR(10) NOT NULL, end_date VARCHAR(10) "
+                    "NOT NULL)",
+                    "CREATE TABLE reviews (id INTEGER PRIMARY KEY, "
+                    "review_text VARCHAR(5000), date INTEGER NOT NULL, "
+                    "user_id INTEGER REFERENCES users (id), listing_id "
+                    "INTEGER REFERENCES listings (id))",
+                    "INSERT INTO users VALUES (1, 'Bob', 'bob@gmail.com', "
+                    "'Password123!', NULL, NULL, 100), (2, 'Tim', "
+                    "'Tim@gmail.com', 'Password123!', NULL, NULL, 60)",
+                    "INSERT INTO listings VALUES (1, 'Title', 'Some "
+                    "description that is valid length', 2000, '1 Street', "
+                    "'2022-01-01', '2022-01-01', 1)",
+                    "INSERT INTO dates (listing_id, date) VALUES "
+                    "(1, '2030-12-31'), (1, '2031-01-01'), (1, '2031-01-05')",
+                    "INSERT INTO bookings VALUES (1, 1, 2, 1, '2030-12-31', "
+                    "'2031-01-02')"]:
+                connection.execute(text(statement))
+
+        result = subprocess.run(
+            [sys.executable, "-m", "qbay", "migrate"],
+            env=dict(os.environ, db_string="sqlite:///" + path),
+            capture_output=True, text=True, timeout=120)
+        assert result.returncode == 0, result.stderr
+        assert f"Schema version: {len(migrations.MIGRATIONS)}" in \
+            result.stdout
+
+        with engine.connect() as connection:
+            def rows(query):
+                return [tuple(row) for row in connection.execute(text(query))]
+            assert rows("SELECT start_date, end_date FROM booked_ranges "
+                        "ORDER BY start_date") == [
+                ("2030-12-31", "2031-01-02"), ("2031-01-05", "2031-01-06")]
+            years = {year: YearBits.from_bytes(year, bits) for year, bits in
+                     rows("SELECT year, bits FROM booked_years")}
+            assert [night for year in sorted(years)
+                    for night in years[year].nights()] == [
+                "2030-12-31", "2031-01-01", "2031-01-05"]
+            assert rows("SELECT email_key, balance, version FROM users "
+                        "ORDER BY id") == [
+                ("bob@gmail.com", 100, 1), ("tim@gmail.com", 60, 1)]
+            assert rows("SELECT user_id, amount, kind FROM ledger "
+                        "ORDER BY user_id") == [
+                (1, 100, "opening_balance"), (2, 60, "opening_balance")]
+            assert rows("SELECT title_key, version, next_available_date "
+                        "FROM listings")[0][:2] == ("title", 1)
+            assert all(passwords.is_hashed(password) for (password,) in
+                       rows("SELECT password FROM users"))
+            indexes = {index["name"] for table in ("users", "listings",
+                                                   "bookings")
+                       for index in inspect(connection).get_indexes(table)}
+            assert {"ix_users_email_key", "ix_listings_title",
+                    "ix_listings_title_key", "ix_listings_owner_id",
+                    "ix_bookings_buyer_id", "ix_bookings_listing_id"} <= \
+                indexes
+        engine.dispose()
+
+    def test_booking_single_transaction(self):
+        """Tests that a failure part way through a booking rolls back the
+        reserved dates and both balance changes.
+        """
+        bob, tim, listing = self.booking_helper()
+
+        with patch.object(Booking, "add_to_database",
+                          side_effect=RuntimeError("insert failed")):
+            with self.assertRaises(RuntimeError):
+                Booking.book_listing(tim.id, bob.id, listing.id,
+                                     "2030-03-01", "2030-03-03")
+
+        assert listing.availability.ranges() == []
+        assert User.query_user(tim.id).balance == 100
+        assert User.query_user(bob.id).balance == 100
+        assert database.Booking.query.count() == 0
+
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-03-01",
+                             "2030-03-03")
+        assert User.query_user(tim.id).balance == 60
+        # The owner is paid in batches by the settler
+        assert User.query_user(bob.id).balance == 100
+        payouts.settle()
+        db.session.commit()
+        assert User.query_user(bob.id).balance == 140
+        assert database.Booking.query.count() == 1
+
+    def test_booking_night_claims(self):
+        """Tests that the database rejects a double booking even when the
+        overlap check is raced past by a concurrent booking.
+        """
+        bob, tim, listing = self.booking_helper()
+        User.register("Fred", "fred@gmail.com", "Password123!")
+        fred = User.login("fred@gmail.com", "Password123!")
+
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-04-01",
+                             "2030-04-03")
+        assert len(listing.booked_dates) == 2
+
+        with patch.object(Listing, "valid_booking_date", return_value=True):
+            with self.assertRaisesRegex(ValueError,
+                                        "Given dates overlap with existing " +
+                                        "bookings!"):
+                Booking.book_listing(fred.id, bob.id, listing.id,
+                                     "2030-04-02", "2030-04-05")
+
+        assert User.query_user(fred.id).balance == 100
+        assert len(listing.booked_dates) == 2
+        assert listing.availability.ranges() == [("2030-04-01",
+                                                  "2030-04-03")]
+
+    def test_listing_feed_pages(self):
+        """Tests that the home feed is paged by id cursor and loads each
+        listing's owner in the same query.
+        """
+        bob, tim, listing = self.booking_helper()
+        for i in range(24):
+            Listing.create_listing(f"Feed Listing {i}",
+                                   "Some description that is valid length",
+                                   20, bob.database_obj)
+
+        first, cursor = Listing.query_page(limit=20)
+        assert [li.id for li in first] == list(range(1, 21))
+        assert cursor == 20
+        assert "owner" not in inspect(first[0]).unloaded
+
+        second, cursor = Listing.query_page(after=cursor, limit=20)
+        assert [li.id for li in second] == list(range(21, 26))
+        assert cursor is None
+
+    def test_user_cache(self):
+        """Tests that cached users are served without a query and that
+        updates invalidate the cached snapshot.
+        """
+        bob, tim, listing = self.booking_helper()
+        user_cache.clear()
+        hits = user_cache.stats()["hits"]
+
+        cached = User.query_user_cached(tim.id)
+        assert cached.username == "Tim"
+        assert cached._database_obj is None
+        assert User.query_user_cached(tim.id).balance == 100
+        assert user_cache.stats()["hits"] == hits + 1
+
+        # Writing through a cached user loads its row and invalidates
+        cached.update_balance(75)
+        assert cached.database_obj.balance == 75
+        assert User.query_user_cached(tim.id).balance == 75
+
+        tim.update_username("Timothy")
+        assert User.query_user_cached(tim.id).username == "Timothy"
+        assert User.query_user_cached(1000) is None
+
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a", label="home")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["by_label"] == {"home": {"hits": 1,
+                                                      "misses": 0}}
+
+    def test_serve_options(self):
+        """Tests that serve options preload the app and pick a threaded
+        worker only when more than one thread is requested.
+        """
+        parser = argparse.ArgumentParser()
+        server.add_arguments(parser)
+
+        options = server.gunicorn_options(parser.parse_args(
+            ["--workers", "3", "--threads", "8", "--keep-alive", "2"]))
+        assert options["workers"] == 3
+        assert options["worker_class"] == "gthread"
+        assert options["preload_app"] is True
+        assert options["keepalive"] == 2
+        assert "pidfile" not in options
+
+        options = server.gunicorn_options(parser.parse_args(
+            ["--threads", "1", "--pid", "qbay.pid"]))
+        assert options["workers"] == server.default_workers()
+        assert options["worker_class"] == "sync"
+        assert options["pidfile"] == "qbay.pid"
+
+        options = server.gunicorn_options(parser.parse_args(["--async"]))
+        assert options["worker_class"] == "uvicorn.workers.UvicornWorker"
+
+    def test_pool_metrics(self):
+        """Tests that the pool reports live connection counts and records
+        checkout waits in the histogram, and that /metrics is only served
+        with the configured token.
+        """
+        histogram = Histogram((1, 10))
+        for value in (0.5, 5, 50, 1):
+            histogram.observe(value)
+        assert histogram.snapshot() == {
+            "count": 4, "sum": 56.5,
+            "buckets": [[1, 2], [10, 3], ["+Inf", 4]]}
+
+        engine = create_engine("sqlite://", poolclass=InstrumentedQueuePool,
+                               pool_size=2, max_overflow=1)
+        waits = pool_wait_ms.snapshot()["count"]
+        first, second, third = (engine.connect() for _ in range(3))
+        status = pool_status(engine)
+        assert status["checked_out"] == 3
+        assert status["overflow"] == 1
+        assert status["wait_ms"]["count"] == waits + 3
+        for connection in (first, second, third):
+            connection.close()
+        assert pool_status(engine)["idle"] == 2
+        assert pool_status(engine)["checked_out"] == 0
+
+        client = app.test_client()
+        with patch.dict(app.config, {"METRICS_TOKEN": ""}):
+            assert client.get("/metrics").status_code == 404
+        with patch.dict(app.config, {"METRICS_TOKEN": "s3cret"}):
+            assert client.get("/metrics").status_code == 403
+            assert client.get("/metrics", headers={
+                "Authorization": "Bearer wrong"}).status_code == 403
+            page = client.get("/metrics", headers={
+                "Authorization": "Bearer s3cret"})
+            assert page.status_code == 200 and "pool" in page.get_json()
+
+    def test_replica_routing(self):
+        """Tests that read-only sessions read from a replica, while writes
+        and reads after a write go to the primary, using a second SQLite
+        file as the replica.
+        """
+        bob, tim, listing = self.booking_helper()
+        replica = create_engine("sqlite:///" + os.path.join(
+            tempfile.mkdtemp(), "replica.db"))
+        db.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(insert(database.Listing), [{
+                "id": listing.id, "title": "Replica Copy", "price": 2000,
+                "description": "Some description that is valid length",
+                "address": "", "date_created": "2022-01-01",
+                "last_modified_date": "2022-01-01", "owner_id": bob.id}])
+
+        with patch.object(database, "replica_engines",
+                          return_value=[replica]):
+            with app.app_context():
+                query = database.Listing.query.filter_by(id=listing.id)
+                assert query.one().title == "Title"
+
+            with app.app_context():
+                db.session.info["read_only"] = True
+                query = database.Listing.query.filter_by(id=listing.id)
+                assert query.one().title == "Replica Copy"
+
+            with app.app_context():
+                db.session.info["read_only"] = True
+                db.session.add(database.Review(date=1, listing_id=1))
+                db.session.commit()
+                query = database.Listing.query.filter_by(id=listing.id)
+                assert query.one().title == "Title"
+
+            with app.app_context():
+                db.session.info["read_only"] = True
+                database.use_primary()
+                query = database.Listing.query.filter_by(id=listing.id)
+                assert query.one().title == "Title"
+
+            with app.test_request_context():
+                session["primary_until"] = time() + 60
+                database.read_only(lambda: None)()
+                assert not db.session.info.get("read_only")
+
+    def test_listing_card_cache(self):
+        """Tests that rendered listing cards are reused until the listing
+        or its owner's username is edited.
+        """
+        bob, tim, listing = self.booking_helper()
+        listing = Listing.query_listing(listing.id)
+        card_cache.clear()
+        hits = card_cache.stats()["hits"]
+        card = listing_card(listing.database_obj, "home")
+        assert "Title" in card and "Owner: Bob" in card
+        assert listing_card(listing.database_obj, "home") is card
+        assert card_cache.stats()["hits"] == hits + 1
+
+        listing.update_title("New Title")
+        card = listing_card(listing.database_obj, "home")
+        assert "New Title" in card
+        assert listing.database_obj.last_modified_date == \
+            datetime.now().strftime("%Y-%m-%d")
+
+        listing.update_price(30)
+        assert "$30.0 / Night" in listing_card(listing.database_obj, "home")
+
+        bob.update_username("Bobby")
+        assert "Owner: Bobby" in listing_card(listing.database_obj, "home")
+        assert len(card_cache) == 1
+
+    def test_conditional_get(self):
+        """Tests that the home and booking pages answer a matching
+        If-None-Match with an empty 304 until something shown changes.
+        """
+        bob, tim, listing = self.booking_helper()
+        listing = Listing.query_listing(listing.id)
+        client = app.test_client()
+        with client.session_transaction() as cookie:
+            cookie["logged_in"] = tim.id
+
+        for url in ("/", f"/booking/{listing.id}"):
+            page = client.get(url)
+            assert page.status_code == 200 and page.headers["ETag"]
+            assert "private" in page.headers["Cache-Control"]
+            again = client.get(url, headers={
+                "If-None-Match": page.headers["ETag"]})
+            assert again.status_code == 304 and again.data == b""
+
+        home = client.get("/").headers["ETag"]
+        booking = client.get(f"/booking/{listing.id}").headers["ETag"]
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-05-01",
+                             "2030-05-03")
+        page = client.get(f"/booking/{listing.id}",
+                          headers={"If-None-Match": booking})
+        assert page.status_code == 200
+        assert b"2030-05-01 to 2030-05-03" in page.data
+
+        # The cached user's balance is stale once money moves
+        home = client.get("/").headers["ETag"]
+        ledger.record(tim.id, 5, "adjustment")
+        db.session.commit()
+        page = client.get("/", headers={"If-None-Match": home})
+        assert page.status_code == 200 and b"Balance: $65" in page.data
+
+        listing.update_price(30)
+        page = client.get("/", headers={"If-None-Match": home})
+        assert page.status_code == 200 and b"$30.0 / Night" in page.data
+
+    def test_json_api(self):
+        """Tests the JSON API: cursor pages with selected fields, a
+        listing's availability, and the logged in user's bookings.
+        """
+        bob, tim, first = self.booking_helper()
+        for title in ("Second", "Third"):
+            Listing.create_listing(title, "Some description that is valid "
+                                   "length", 20, bob, "")
+        client = app.test_client()
+
+        page = client.get("/api/v1/listings?limit=2&fields=id,title,owner")
+        assert page.status_code == 200
+        assert page.json["data"] == [
+            {"id": first.id, "title": "Title", "owner": "Bob"},
+            {"id": first.id + 1, "title": "Second", "owner": "Bob"}]
+        page = client.get(f"/api/v1/listings?after={page.json['next']}")
+        assert [item["title"] for item in page.json["data"]] == ["Third"]
+        assert page.json["data"][0]["price"] == 2000
+        assert page.json["next"] is None
+        assert client.get("/api/v1/listings?fields=id,secret"
+                          ).status_code == 400
+        assert client.get("/api/v1/listings?limit=1000").status_code == 400
+
+        assert client.get("/api/v1/me/bookings").status_code == 401
+        with client.session_transaction() as cookie:
+            cookie["logged_in"] = tim.id
+        booked = client.post("/api/v1/me/bookings", json={
+            "listing_id": first.id, "start_date": "2030-06-01",
+            "end_date": "2030-06-03"})
+        assert booked.status_code == 201
+        again = client.post("/api/v1/me/bookings", json={
+            "listing_id": first.id, "start_date": "2030-06-02",
+            "end_date": "2030-06-04"})
+        assert again.status_code == 400
+        assert again.json["error"] == \
+            "Given dates overlap with existing bookings!"
+
+        bookings = client.get("/api/v1/me/bookings?fields=listing_id,title")
+        assert bookings.json == {
+            "data": [{"listing_id": first.id, "title": "Title"}],
+            "next": None}
+        availability = client.get(
+            f"/api/v1/listings/{first.id}/availability").json
+        assert availability["booked"] == [["2030-06-01", "2030-06-03"]]
+        assert client.get("/api/v1/listings/9999/availability"
+                          ).status_code == 404
+
+    def test_search(self):
+        """Tests that search ranks title matches first, pages results and
+        follows listing edits, and that migration 5 indexes listings
+        created before search existed.
+        """
+        bob, tim, listing = self.booking_helper()
+        listing = Listing.query_listing(listing.id)
+        cottage = Listing.create_listing(
+            "Lakeside Cottage", "Quiet cabin with a view of the lake", 50,
+            bob, "1 Shore Road")
+        Listing.create_listing(
+            "Downtown Loft", "Walking distance to the lakeside park", 50,
+            bob, "2 King Street")
+        # Listings are indexed by background jobs
+        assert search_listings("lakeside") == ([], False)
+        jobs.run_pending()
+
+        results, has_next = search_listings("lakeside")
+        assert [r.title for r in results] == ["Lakeside Cottage",
+                                              "Downtown Loft"]
+        assert not has_next
+        results, has_next = search_listings("lakeside", page=1, limit=1)
+        assert len(results) == 1 and has_next
+        assert [r.title for r in search_listings("Shore, cottage!")[0]] == [
+            "Lakeside Cottage"]
+        assert search_listings("shore loft") == ([], False)
+        assert search_listings("") == ([], False)
+
+        # Title matches come first, however many newer matches there are
+        db.session.execute(text(
+            "INSERT INTO listings_fts (rowid, title, description, address) "
+            "VALUES (:id, 'Flat', 'Near the lakeside', '')"),
+            [{"id": 10000 + i} for i in range(2500)])
+        db.session.commit()
+        assert [r.title for r in search_listings("lakeside", limit=1)[0]] \
+            == ["Lakeside Cottage"]
+
+        listing.update_description("Now a lakeside retreat on the water")
+        jobs.run_pending()
+        assert listing.id in [r.id for r in search_listings("retreat")[0]]
+
+        db.session.execute(text("DROP TABLE listings_fts"))
+        db.session.commit()
+        migrations.migrate()
+        assert migrations.has_table("listings_fts")
+        assert cottage.id in [r.id for r in search_listings("cabin")[0]]
+
+        client = app.test_client()
+        with client.session_transaction() as cookie:
+            cookie["logged_in"] = tim.id
+        page = client.get("/search?q=king+street")
+        assert page.status_code == 200 and b"Downtown Loft" in page.data
+
+    def test_available_listings(self):
+        """Tests that the catalog-wide availability search only returns
+        listings with no booked night in the stay, within the price
+        bounds, page by page.
+        """
+        bob, tim, first = self.booking_helper()
+        second = Listing.create_listing("Second", "Some description that "
+                                        "is valid length", 50, bob, "")
+        third = Listing.create_listing("Third", "Some description that is "
+                                       "valid length", 80, bob, "")
+        Booking.book_listing(tim.id, bob.id, first.id, "2030-07-01",
+                             "2030-07-04")
+        Booking.book_listing(tim.id, bob.id, first.id, "2030-07-10",
+                             "2030-07-12")
+
+        def titles(*args, **kwargs):
+            return [listing.title for listing in
+                    Listing.query_available(*args, **kwargs)[0]]
+
+        assert titles("2030-07-03", "2030-07-05") == ["Second", "Third"]
+        assert titles("2030-06-28", "2030-07-01") == ["Title", "Second",
+                                                      "Third"]
+        assert titles("2030-07-04", "2030-07-10") == ["Title", "Second",
+                                                      "Third"]
+        assert titles("2030-07-05", "2030-07-15") == ["Second", "Third"]
+        assert titles("2030-07-04", "2030-07-10", min_price=30,
+                      max_price=60) == ["Second"]
+        listings, cursor = Listing.query_available("2030-07-04",
+                                                   "2030-07-10", limit=2)
+        assert cursor == second.id
+        assert titles("2030-07-04", "2030-07-10", after=cursor) == ["Third"]
+        with self.assertRaises(ValueError):
+            Listing.query_available("2030-07-10", "2030-07-04")
+
+        client = app.test_client()
+        page = client.get("/api/v1/listings?fields=id&available_from="
+                          "2030-07-02&available_to=2030-07-03&min_price=6000")
+        assert page.json["data"] == [{"id": third.id}]
+        assert client.get("/api/v1/listings?available_from=2030-07-02"
+                          ).status_code == 400
+        with client.session_transaction() as cookie:
+            cookie["logged_in"] = tim.id
+        page = client.get("/available?from=2030-07-02&to=2030-07-03")
+        assert page.status_code == 200
+        assert b"Second" in page.data and b"Title<br>" not in page.data
+
+    def test_next_available_date(self):
+        """Tests that the next available date stored with a listing follows
+        bookings covering it, and that only a date in the past is looked up.
+        """
+        bob, tim, listing = self.booking_helper()
+        listing = Listing.query_listing(listing.id)
+
+        def day(offset):
+            return (datetime.now() + timedelta(days=offset)
+                    ).strftime("%Y-%m-%d")
+
+        def stored():
+            db.session.refresh(listing.database_obj)
+            return listing.database_obj.next_available_date
+
+        assert stored() == day(0) == listing.find_min_booking_date()
+        statements = []
+
+        def executed(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", executed)
+        try:
+            Booking.book_listing(tim.id, bob.id, listing.id, day(2), day(3))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", executed)
+        # The first free night is not fetched while the stored one holds
+        assert not [s for s in statements
+                    if s.startswith("SELECT booked_ranges.end_date")]
+        assert stored() == day(0)
+        Booking.book_listing(tim.id, bob.id, listing.id, day(0), day(1))
+        assert stored() == day(1)
+        # Fills the gap, merging with the ranges on both sides
+        Booking.book_listing(tim.id, bob.id, listing.id, day(1), day(2))
+        assert stored() == day(3) == listing.find_min_booking_date()
+
+        listing.database_obj.next_available_date = "2020-01-01"
+        db.session.commit()
+        assert listing.find_min_booking_date() == day(3)
+        Booking.book_listing(tim.id, bob.id, listing.id, day(5), day(6))
+        assert stored() == day(3)
+
+        listing.database_obj.next_available_date = None
+        db.session.commit()
+        migrations.migrate()
+        assert stored() == day(3)
+
+    def test_year_bitmaps(self):
+        """Tests the yearly bitmaps of booked nights: set operations,
+        bookings across a new year, claims losing the race for a year's
+        row and the migration of per-night rows.
+        """
+        assert split_by_year("2030-12-30", "2031-01-02") == [
+            (2030, 363, 365), (2031, 0, 1)]
+        assert split_by_year("2032-12-31", "2033-01-01") == [
+            (2032, 365, 366)]
+        bits = YearBits(2030)
+        bits.set_range(3, 6)
+        assert len(bits) == 3 and bits.any_in(5, 9)
+        assert not bits.any_in(6, 9)
+        assert bits.test("2030-01-04") and not bits.test("2030-01-07")
+        assert YearBits.from_bytes(2030, bits.to_bytes()) == bits
+        assert len(bits.to_bytes()) == 46
+        assert len(~bits) == 365 - 3
+        bits.clear_range(4, 5)
+        assert bits.nights() == ["2030-01-04", "2030-01-06"]
+
+        bob, tim, listing = self.booking_helper()
+        second = Listing.create_listing("Second Listing",
+                                        "Another listing to book", 10, bob,
+                                        "2 Bitmap Street")
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-12-30",
+                             "2031-01-02")
+        assert listing.booked_dates == ["2030-12-30", "2030-12-31",
+                                        "2031-01-01"]
+        years = Availability(listing.id).year_bits()
+        assert sorted(years) == [2030, 2031]
+        assert len(Availability(listing.id).year_bits(since=2031)) == 1
+        with self.assertRaisesRegex(ValueError, "overlap"):
+            Availability(listing.id).claim("2031-01-01", "2031-01-03")
+        db.session.rollback()
+
+        # Another booking of the listing commits between the read and the
+        # write of the year's row
+        from_bytes = YearBits.from_bytes
+
+        def concurrent_booking(year, blob):
+            db.session.execute(text(
+                "UPDATE booked_years SET version = version + 1 "
+                "WHERE listing_id = :id AND year = :year"),
+                {"id": listing.id, "year": year})
+            return from_bytes(year, blob)
+        with patch.object(YearBits, "from_bytes",
+                          side_effect=concurrent_booking):
+            with self.assertRaisesRegex(ValueError, "at the same time"):
+                Availability(listing.id).claim("2030-06-01", "2030-06-03")
+        db.session.rollback()
+        assert listing.booked_dates == ["2030-12-30", "2030-12-31",
+                                        "2031-01-01"]
+
+        db.session.execute(text("CREATE TABLE booked_nights (listing_id "
+                                "INTEGER, night VARCHAR(10))"))
+        for night in ["2031-03-01", "2031-03-02", "2032-01-01"]:
+            db.session.execute(text("INSERT INTO booked_nights VALUES "
+                                    "(:id, :night)"),
+                               {"id": second.id, "night": night})
+        db.session.commit()
+        migrations.migrate()
+        assert not migrations.has_table("booked_nights")
+        assert Availability(second.id).nights() == [
+            "2031-03-01", "2031-03-02", "2032-01-01"]
+
+    def test_unique_keys(self):
+        """Tests that emails and listing titles are unique regardless of
+        case, enforced on insert, and that repeated sign ups with a taken
+        email are rejected through the Bloom filter without an insert.
+        """
+        bob, tim, listing = self.booking_helper()
+        assert database.User.query.get(bob.id).email_key == "bob@gmail.com"
+        assert User.email_taken("BOB@Gmail.com")
+        assert not User.email_taken("fred@gmail.com")
+
+        assert User.register("Bobby", "Bob@Gmail.com", "Password123!") \
+            is False
+        assert "bob@gmail.com" in signup_filter
+        with patch.object(User, "add_to_database") as add_to_database:
+            assert User.register("Bobby", "BOB@gmail.com", "Password123!") \
+                is False
+        add_to_database.assert_not_called()
+        assert database.User.query.count() == 2
+
+        with self.assertRaisesRegex(ValueError, "Email already exists"):
+            tim.update_email("Bob@gmail.com")
+        assert User.query_user(tim.id).email == "tim@gmail.com"
+
+        # Logging in matches the email like signing up does
+        assert User.login("BOB@Gmail.com", "Password123!").id == bob.id
+        with self.assertRaisesRegex(ValueError, "Incorrect email"):
+            User.login("BOB@Gmail.com", "Password123?")
+
+        with self.assertRaisesRegex(ValueError, "Title already exists"):
+            Listing.create_listing("TITLE", "Some description that is " +
+                                   "valid length", 20, bob, "Some Street")
+        assert Listing.valid_title("title") is False
+        second = Listing.create_listing("Second Title", "Some description " +
+                                        "that is valid length", 20, bob)
+        second = Listing.query_listing(second.id)
+        with patch.object(Listing, "valid_title", return_value=True):
+            with self.assertRaisesRegex(ValueError, "Title already exists"):
+                second.update_title("title")
+        assert Listing.query_listing(second.id).title == "Second Title"
+        assert database.Listing.query.count() == 2
+
+        bloom = BloomFilter(1024, 3)
+        bloom.add("bob@gmail.com")
+        assert "bob@gmail.com" in bloom and len(bloom) == 1
+        assert "tim@gmail.com" not in bloom
+
+        # Legacy rows equal but for case keep a NULL key
+        db.session.execute(text("UPDATE users SET email_key = NULL"))
+        db.session.execute(text("DROP INDEX ix_users_email_key"))
+        db.session.execute(text(
+            "INSERT INTO users (username, email, password, balance) "
+            "VALUES ('Legacy', 'BOB@gmail.com', 'Password123!', 100)"))
+        db.session.commit()
+        migrations.migrate()
+        keys = dict(db.session.execute(text(
+            "SELECT email, email_key FROM users")).all())
+        assert keys == {"bob@gmail.com": "bob@gmail.com",
+                        "tim@gmail.com": "tim@gmail.com",
+                        "BOB@gmail.com": None}
+        assert migrations.has_index("users", "ix_users_email_key")
+
+    def test_password_hashing(self):
+        """Tests that passwords are stored hashed, that logins rehash
+        legacy plaintext and outdated hashes, and that the migration
+        hashes plaintext passwords.
+        """
+        bob, tim, listing = self.booking_helper()
+        stored = User.query_user(bob.id).password
+        assert stored.startswith("$scrypt$n=16,r=8,p=1$")
+        assert passwords.is_hashed(stored)
+        assert not passwords.needs_rehash(stored)
+        assert verify_password("Password123!", stored)
+        assert not verify_password("Password321!", stored)
+        assert passwords.hash_password("Password123!") != stored
+        with self.assertRaisesRegex(ValueError, "Incorrect email or password"):
+            User.login("nobody@gmail.com", "Password123!")
+
+        def stored_password(user_id):
+            return db.session.execute(text(
+                "SELECT password FROM users WHERE id = :id"),
+                {"id": user_id}).scalar()
+
+        db.session.execute(text(
+            "UPDATE users SET password = '$Password123!' WHERE id = :id"),
+            {"id": tim.id})
+        db.session.commit()
+        assert not passwords.is_hashed(stored_password(tim.id))
+        with self.assertRaisesRegex(ValueError, "Incorrect email or password"):
+            User.login("tim@gmail.com", "Password123!")
+        assert User.login("tim@gmail.com", "$Password123!")
+        assert passwords.is_hashed(stored_password(tim.id))
+        assert User.login("tim@gmail.com", "$Password123!")
+
+        scheme = app.config["PASSWORD_SCHEME"]
+        try:
+            app.config["PASSWORD_SCHEME"] = "pbkdf2"
+            app.config["PASSWORD_PBKDF2_ITERATIONS"] = 1000
+            assert passwords.needs_rehash(stored)
+            assert User.login("bob@gmail.com", "Password123!")
+            assert stored_password(bob.id).startswith(
+                "$pbkdf2-sha256$i=1000$")
+            assert User.login("bob@gmail.com", "Password123!")
+        finally:
+            app.config["PASSWORD_SCHEME"] = scheme
+
+        db.session.execute(text(
+            "UPDATE users SET password = 'Password123!' WHERE id = :id"),
+            {"id": bob.id})
+        db.session.commit()
+        migrations.migrate()
+        assert stored_password(bob.id).startswith("$scrypt$")
+        assert verify_password("Password123!", stored_password(bob.id))
+
+    def test_rate_limits(self):
+        """Tests that login and booking attempts over their budgets, per
+        address and per account, are answered 429 without running the
+        route, and that spent buckets refill over time.
+        """
+        bob, tim, listing = self.booking_helper()
+        client = app.test_client()
+        ratelimit.store.clear()
+
+        def login(email):
+            return client.post("/login", data={"email": email,
+                                               "password": "Wrong123!"})
+
+        for _ in range(5):
+            assert login("bob@gmail.com").status_code == 200
+        response = login("BOB@gmail.com")
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        # Other accounts from the same address share its last 5 tokens,
+        # which the rejected attempt did not take from
+        with patch.object(User, "login", side_effect=ValueError("no")) \
+                as user_login:
+            for _ in range(5):
+                assert login("tim@gmail.com").status_code == 200
+            assert login("tim@gmail.com").status_code == 429
+            assert login("fred@gmail.com").status_code == 429
+        assert user_login.call_count == 5
+        assert ratelimit.stats()["rejected"]["login-ip"] >= 2
+
+        ratelimit.store.clear()
+        with client.session_transaction() as cookie:
+            cookie["logged_in"] = tim.id
+        with patch.object(Booking, "book_listing") as book_listing:
+            statuses = [client.post("/api/v1/me/bookings", json={
+                "listing_id": listing.id, "start_date": "2030-01-01",
+                "end_date": "2030-01-02"}).status_code for _ in range(11)]
+        assert statuses[-1] == 429 and 429 not in statuses[:-1]
+        assert book_listing.call_count == 10
+
+        store = ratelimit.MemoryStore(maxsize=2)
+        assert store.take("a", 1, 2, 0) == (True, 0.0)
+        assert store.take("a", 1, 2, 0) == (True, 0.0)
+        assert store.take("a", 1, 2, 0.5) == (False, 0.5)
+        assert store.take("a", 1, 2, 1)[0]
+        store.take("b", 1, 2, 1)
+        store.take("c", 1, 2, 1)
+        assert len(store) == 2
+        # A token from all the buckets or from none
+        both = [("b", 1, 2), ("c", 1, 2)]
+        assert store.take_all(both, 1) == (None, 0.0)
+        assert store.take("c", 1, 2, 2) == (True, 0.0)
+        assert store.take_all(both, 2) == (1, 1.0)
+        assert store.take("b", 1, 2, 2) == (True, 0.0)
+        ratelimit.store.clear()
+
+    def test_async_pages(self):
+        """Tests that the pages served on the event loop answer like their
+        threaded versions, ETags and redirects included.
+        """
+        for module in ("asgiref", "aiosqlite", "greenlet"):
+            pytest.importorskip(module)
+        import asyncio
+        from qbay import asgi
+
+        bob, tim, listing = self.booking_helper()
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-01-01",
+                             "2030-01-03")
+        client = app.test_client()
+        with client.session_transaction() as cookie:
+            cookie["logged_in"] = tim.id
+        session_cookie = "session=" + client.get_cookie("session").value
+
+        async def get(path, headers=()):
+            messages = []
+            scope = {"type": "http", "method": "GET", "path": path,
+                     "query_string": b"", "headers": list(headers)}
+
+            async def receive():
+                return {"type": "http.request", "body": b""}
+
+            async def send(message):
+                messages.append(message)
+
+            await asgi.application(scope, receive, send)
+            return (messages[0]["status"], dict(messages[0]["headers"]),
+                    b"".join(m.get("body", b"") for m in messages[1:]))
+
+        async def compare():
+            cookie = (b"cookie", session_cookie.encode())
+            for path in ["/", f"/booking/{listing.id}", "/user_bookings",
+                         "/user_listings"]:
+                expected = client.get(path)
+                status, headers, body = await get(path, [cookie])
+                assert status == expected.status_code == 200
+                assert body == expected.data
+                if "ETag" in expected.headers:
+                    etag = expected.headers["ETag"].encode()
+                    assert headers[b"etag"] == etag
+                    status, _, body = await get(
+                        path, [cookie, (b"if-none-match", etag)])
+                    assert status == 304 and body == b""
+            status, headers, _ = await get("/")
+            assert status == 302 and headers[b"location"] == b"/login"
+            await asgi.application.dispose()
+
+        asyncio.run(compare())
+
+    def test_jobs(self):
+        """Tests that jobs are stored only when their transaction commits,
+        that a claimed job is run again once its lease runs out, that
+        failing jobs are retried with backoff until out of attempts, and
+        that worker threads pay a booking's owner.
+        """
+        bob, tim, listing = self.booking_helper()
+        Job = database.Job
+        Job.query.delete()
+        db.session.commit()
+        flaky_jobs = Job.query.filter_by(kind="flaky")
+        calls = []
+
+        def flaky(fail):
+            calls.append(fail)
+            db.session.execute(text(
+                "UPDATE users SET balance = balance + 1 WHERE id = :id"),
+                {"id": tim.id})
+            if fail:
+                raise RuntimeError("flaky")
+
+        with patch.dict(jobs.HANDLERS, {"flaky": flaky}):
+            jobs.enqueue("flaky", fail=False)
+            db.session.rollback()
+            assert flaky_jobs.count() == 0
+            with self.assertRaises(ValueError):
+                jobs.enqueue("unknown")
+
+            # A worker dies holding the job: it is run again after the
+            # lease, and the first worker can no longer complete it
+            jobs.enqueue("flaky", fail=False)
+            db.session.commit()
+            now = time()
+            lease = app.config["JOB_LEASE_SECONDS"]
+            (first,) = jobs.claim(10, now)
+            db.session.expunge(first)  # as if claimed in another process
+            assert jobs.claim(10, now) == []
+            (second,) = jobs.claim(10, now + lease + 1)
+            assert second.attempts == 2
+            lost = jobs.counters["lost"]
+            jobs.run(first, now)
+            assert jobs.counters["lost"] == lost + 1
+            assert User.query_user(tim.id).balance == 100
+            jobs.run(second, now + lease + 1)
+            assert User.query_user(tim.id).balance == 101
+            assert flaky_jobs.count() == 0
+
+            # Failures roll the handler back and are retried later
+            jobs.enqueue("flaky", fail=True)
+            db.session.commit()
+            now = time()
+            assert jobs.run_pending(now=now) == 1
+            job = flaky_jobs.one()
+            assert job.status == "pending" and job.run_at > now
+            assert "RuntimeError: flaky" in job.last_error
+            assert jobs.run_pending(now=now) == 0
+            later = now
+            for _ in range(app.config["JOB_MAX_ATTEMPTS"] - 1):
+                later += app.config["JOB_BACKOFF_MAX"]
+                assert jobs.run_pending(now=later) == 1
+            job = flaky_jobs.one()
+            assert job.status == "failed"
+            assert job.attempts == app.config["JOB_MAX_ATTEMPTS"]
+            assert jobs.run_pending(now=later * 2) == 0
+            assert len(calls) == 2 + app.config["JOB_MAX_ATTEMPTS"]
+            assert User.query_user(tim.id).balance == 101
+            assert jobs.queue_sizes()["failed"] == 1
+            db.session.delete(job)
+            db.session.commit()
+
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-03-01",
+                             "2030-03-03")
+        workers = jobs.Workers(2)
+        workers.start()
+        try:
+            deadline = time() + 10
+            while payouts.pending(bob.id) and time() < deadline:
+                db.session.commit()
+        finally:
+            workers.stop()
+        # The workers committed through their own connections
+        db.session.commit()
+        assert User.query_user(bob.id).balance == 140
+        assert "failed" not in jobs.stats()["queued"]
+
+    def test_ledger(self):
+        """Tests that money movements are ledger entries, that balances
+        are the snapshot plus the unfolded entries, that snapshots fold
+        only settled entries, and count entries committed late, and that
+        migrations 11 and 14 open a ledger for existing balances.
+        """
+        bob, tim, listing = self.booking_helper()
+        tim_db = tim.database_obj
+        assert tim.balance == 100 and tim_db.balance_snapshot == 0
+        Booking.book_listing(tim.id, bob.id, listing.id, "2030-03-01",
+                             "2030-03-03")
+        booking = database.Booking.query.one()
+        payouts.settle()
+        db.session.commit()
+        assert [(e.kind, e.amount, e.booking_id)
+                for e in ledger.entries(tim.id)] == [
+            ("signup_bonus", 100, None), ("booking_debit", -40, booking.id)]
+        assert [(e.kind, e.amount) for e in ledger.entries(bob.id)] == [
+            ("signup_bonus", 100), ("payout", 40)]
+        assert User.query_user(bob.id).balance == 140
+
+        # One snapshot job per user, folding only entries old enough
+        snapshots = database.Job.query.filter_by(kind="snapshot_balance")
+        assert snapshots.filter_by(dedupe_key=f"balance:{tim.id}").count() \
+            == 1
+        assert ledger.snapshot(tim.id, before=time() - 60) == 0
+        assert ledger.snapshot(tim.id) == 2
+        db.session.commit()
+        assert tim_db.balance_snapshot == 60 and tim_db.balance == 60
+        assert all(e.folded for e in ledger.entries(tim.id))
+        tim.update_balance(75)
+        assert ledger.entries(tim.id)[-1].amount == 15
+        assert User.query_user(tim.id).balance == 75
+
+        # An entry with a lower id and an older time, whose transaction
+        # commits only after a snapshot, is still counted and folded later
+        gap = ledger.record(bob.id, 0, "adjustment")
+        db.session.flush()
+        gap_id = gap.id
+        ledger.record(tim.id, 5, "adjustment")
+        db.session.delete(gap)
+        db.session.commit()
+        assert ledger.snapshot(tim.id) == 2
+        db.session.commit()
+        db.session.add(database.LedgerEntry(
+            id=gap_id, user_id=tim.id, amount=-5, kind="adjustment",
+            created_at=time() - 120))
+        db.session.commit()
+        assert ledger.balance(tim.id) == 75
+        assert ledger.snapshot(tim.id, before=time() - 60) == 1
+        db.session.commit()
+        assert tim_db.balance_snapshot == tim_db.balance == 75
+
+        with patch.dict(app.config, {"LEDGER_SNAPSHOT_DELAY": 0}):
+            jobs.run_pending(now=time() + 120)
+        assert snapshots.count() == 0
+        for user in (bob, tim):
+            user_db = db.session.get(database.User, user.id)
+            assert user_db.balance_snapshot == user_db.balance == sum(
+                e.amount for e in ledger.entries(user.id))
+        with self.assertRaises(ValueError):
+            ledger.record(tim.id, 10, "gift")
+
+        # Balances from before the ledger become opening entries
+        db.session.execute(text("DELETE FROM ledger"))
+        db.session.execute(text(
+            "UPDATE users SET balance = 30"))
+        db.session.execute(text("DELETE FROM schema_version "
+                                "WHERE version IN (11, 14)"))
+        db.session.commit()
+        migrations.migrate()
+        assert [(e.kind, e.amount) for e in ledger.entries(tim.id)] == [
+            ("opening_balance", 30)]
+        assert User.query_user(tim.id).balance == 30
+
+    def test_concurrent_debits(self):
+        """Tests that two bookings of the same buyer made at the same
+        time, each affordable on its own, cannot both spend the balance.
+        """
+        bob, tim, listing = self.booking_helper()
+        second = Listing.create_listing(
+            "Second Title", "Another description of valid length", 20,
+            bob.database_obj, "1001 Some Street")
+        ids = (tim.id, bob.id)
+        listing_ids = (listing.id, second.id)
+        db.session.commit()
+        # Both bookings pass the early balance check before either debits
+        barrier = threading.Barrier(2, timeout=10)
+        valid_booking_date = Listing.valid_booking_date
+
+        def after_barrier(self, booked_dates):
+            barrier.wait()
+            return valid_booking_date(self, booked_dates)
+
+        outcomes = []
+
+        def book(listing_id):
+            with app.app_context():
+                try:
+                    outcomes.append(Booking.book_listing(
+                        *ids, listing_id, "2030-06-01", "2030-06-04"))
+                except ValueError as e:
+                    outcomes.append(str(e))
+
+        with patch.object(Listing, "valid_booking_date", after_barrier):
+            threads = [threading.Thread(target=book, args=(listing_id,))
+                       for listing_id in listing_ids]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert sorted(outcomes, key=str) == [
+            "Buyer's balance is too low for this booking!", True]
+        db.session.commit()
+        assert ledger.balance(ids[0]) == 40
+        assert database.Booking.query.count() == 1
+
+    def test_payouts(self):
+        """Tests that bookings leave owners a pending payout, that the
+        periodic settler pays each owner's payouts with one ledger entry
+        and queues its next run, and that migration 12 turns owner credit
+        jobs into payouts.
+        """
+        bob, tim, listing = self.booking_helper()
+        User.register("Fred", "fred@gmail.com", "Password123!")
+        fred = User.query_user(User.login("fred@gmail.com",
+                                          "Password123!").id)
+        second = Listing.create_listing(
+            "Second Title", "Another description of valid length", 30,
+            bob.database_obj, "1001 Some Street")
+        third = Listing.create_listing(
+            "Third Title", "Yet another description of valid length", 10,
+            fred.database_obj, "1002 Some Street")
+        tim.update_balance(1000)
+        for booked in (listing, second, third):
+            Booking.book_listing(tim.id, booked.seller.id, booked.id,
+                                 "2030-03-01", "2030-03-03")
+        assert User.query_user(tim.id).balance == 880
+        assert User.query_user(bob.id).balance == 100
+        assert payouts.pending(bob.id) == 100
+        assert payouts.pending(fred.id) == 20
+
+        Job = database.Job
+        Job.query.delete()
+        jobs.schedule_all()
+        jobs.schedule_all()
+        settles = Job.query.filter_by(kind="settle_payouts")
+        assert settles.count() == 1
+        assert jobs.run_pending() == 1
+        assert User.query_user(bob.id).balance == 200
+        assert User.query_user(fred.id).balance == 120
+        assert payouts.pending(bob.id) == 0
+        assert [(e.kind, e.amount) for e in ledger.entries(bob.id)] == [
+            ("signup_bonus", 100), ("payout", 100)]
+        assert database.Payout.query.filter_by(entry_id=None).count() == 0
+        assert settles.one().run_at >= time() + \
+            app.config["PAYOUT_SETTLE_INTERVAL"] - 5
+
+        # A full batch is followed right away by another one
+        for night in ("2030-04-01", "2030-04-02"):
+            Booking.book_listing(tim.id, bob.id, listing.id, night,
+                                 night[:-1] + str(int(night[-1]) + 1))
+        Job.query.delete()
+        db.session.commit()
+        with patch.dict(app.config, {"PAYOUT_BATCH": 1}):
+            payouts.settle_job()
+            db.session.commit()
+            assert payouts.pending(bob.id) == 20
+            assert settles.one().run_at <= time()
+            payouts.settle_job()
+            db.session.commit()
+        assert payouts.pending(bob.id) == 0
+        assert User.query_user(bob.id).balance == 240
+
+        # Owner credits queued before payouts existed
+        db.session.execute(text(
+            "INSERT INTO jobs (kind, payload, status, attempts, run_at, "
+            "created_at) VALUES ('credit_owner', :payload, 'pending', 0, "
+            "0, 0)"), {"payload": '{"owner_id": %d, "amount": 15}' % fred.id})
+        db.session.execute(text("DELETE FROM schema_version "
+                                "WHERE version = 12"))
+        db.session.commit()
+        migrations.migrate()
+        assert Job.query.filter_by(kind="credit_owner").count() == 0
+        assert payouts.pending(fred.id) == 15
+
+    def test_edit_conflicts(self):
+        """Tests that an edit of a listing or a profile based on a version
+        that was changed since is refused instead of overwriting it, and
+        that the edit pages answer it with a 409 and the current details.
+        """
+        bob, tim, listing = self.booking_helper()
+        first = Listing.query_listing(listing.id)
+        second = Listing.query_listing(listing.id)
+        version = first.version
+        assert second.version == version
+        first.update_address("2000 Other Street")
+        first.update_price(25)
+        assert first.version == version + 2
+        with pytest.raises(database.EditConflict):
+            second.update_address("3000 Third Street")
+        listing = Listing.query_listing(listing.id)
+        assert listing.database_obj.address == "2000 Other Street"
+        assert listing.version == version + 2
+        second.version = listing.version
+        second.update_address("3000 Third Street")
+        assert Listing.query_listing(listing.id).database_obj.address == \
+            "3000 Third Street"
+
+        first, second = User.query_user(bob.id), User.query_user(bob.id)
+        assert first.version == second.version == 1
+        first.update_postal_code("K7L3N6")
+        with pytest.raises(database.EditConflict):
+            second.update_billing_address("1 Queen Street")
+        bob = User.query_user(bob.id)
+        assert bob.billing_address != "1 Queen Street"
+        assert bob.postal_code == "K7L3N6" and bob.version == 2
+
+        client = app.test_client()
+        with client.session_transaction() as cookie:
+            cookie["logged_in"] = bob.id
+        page = client.get(f"/update_listing/{listing.id}")
+        assert f'name="version" value="{version + 3}"'.encode() in page.data
+        form = {"title": "Title", "description": "Some description that "
+                "is valid length", "price": "25", "address": "Stale Street",
+                "version": str(version + 2)}
+        page = client.post(f"/update_listing/{listing.id}", data=form)
+        assert page.status_code == 409
+        assert b"changed by someone else" in page.data
+        assert b'value="3000 Third Street"' in page.data
+        assert Listing.query_listing(listing.id).database_obj.address == \
+            "3000 Third Street"
+        form["version"] = str(version + 3)
+        page = client.post(f"/update_listing/{listing.id}", data=form)
+        assert page.status_code == 200
+        assert f'name="version" value="{version + 4}"'.encode() in page.data
+        assert Listing.query_listing(listing.id).database_obj.address == \
+            "Stale Street"
+
+        form = {"email": "bob@gmail.com", "username": "Bob",
+                "billing_address": "1 Queen Street", "postal_code": "K7L3N6",
+                "version": "1"}
+        page = client.post("/user_update", data=form)
+        assert page.status_code == 409
+        assert User.query_user(bob.id).billing_address != "1 Queen Street"
+        assert b'name="version" value="2"' in client.get("/user_update").data
+        form["version"] = "2"
+        assert client.post("/user_update", data=form).status_code == 200
+        assert User.query_user(bob.id).billing_address == "1 Queen Street"
+
 
 if __name__ == "__main__":
     unittest.main()